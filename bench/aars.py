@@ -0,0 +1,157 @@
+"""
+Benchmarks of the AARS record operations against the in-process Aleph stand-in.
+
+    python -m bench.aars --sizes 1000 10000 100000 --latency 0.005 --output bench_output.json
+
+For each number of records, a fresh stand-in is filled and each scenario reports its throughput, p50/p99 latency,
+the number of remote calls it made and the peak of the memory it allocated, as JSON. Memory is traced with
+tracemalloc, which slows down every operation; pass --no-memory for timings without it.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from src.aars import Record, Index, RecordCache, set_cache, set_default_client, set_trusted_reads
+from src.aars.testing import LocalAlephClient
+from src.aars.utils import map_bounded
+
+SIZES = [1_000, 10_000, 100_000]
+# number of operations of the per-record read scenarios, independent of the number of records
+READ_OPS = 1_000
+
+
+class Book(Record):
+    title: str
+    author: str
+    year: int
+
+
+def peak_memory(baseline: int) -> Optional[int]:
+    """Peak of the memory allocated since the peak was reset, beyond `baseline`, in bytes, if memory is traced."""
+    if not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[1] - baseline
+
+
+def percentile(latencies: List[float], q: float) -> float:
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+async def measure(name: str,
+                  client: LocalAlephClient,
+                  records: int,
+                  op: Callable[[Any], Awaitable[Any]],
+                  args: List[Any],
+                  concurrency: int) -> Dict[str, Any]:
+    latencies = []
+
+    async def timed(arg):
+        start = time.perf_counter()
+        await op(arg)
+        latencies.append(time.perf_counter() - start)
+
+    calls = client.calls.copy()
+    # the peak of this scenario only, above the memory which is held already
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    await map_bounded(timed, args, concurrency)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'scenario': name,
+        'records': records,
+        'ops': len(args),
+        'seconds': round(elapsed, 6),
+        'ops_per_sec': round(len(args) / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'remote_calls': dict(client.calls - calls),
+        'peak_memory_bytes': peak_memory(baseline),
+    }
+
+
+async def run(size: int, latency: float, page_size: int, concurrency: int) -> List[Dict[str, Any]]:
+    client = LocalAlephClient(latency=latency, max_page_size=page_size)
+    set_default_client(client)
+    Index(Book, 'author')
+    authors = max(1, size // 100)
+    results = []
+    books: List[Book] = []
+
+    async def create(i: int):
+        books.append(await Book.create(title=f'Book {i}', author=f'Author {i % authors}', year=1900 + i % 120))
+
+    async def upsert(book: Book):
+        book.year += 1
+        await book.upsert()
+
+    async def query(author: str):
+        await Book.query(author=author)
+
+    async def fetch_all(_):
+        await Book.fetch_all()
+
+    async def fetch_revision(book: Book):
+        await book.fetch_revision(rev_no=0)
+
+    reads = min(size, READ_OPS)
+    results.append(await measure('create', client, size, create, list(range(size)), concurrency))
+    results.append(await measure('upsert', client, size, upsert, books, concurrency))
+    results.append(await measure('query', client, size, query,
+                                 [f'Author {i % authors}' for i in range(reads)], concurrency))
+    results.append(await measure('fetch_all', client, size, fetch_all, [None], 1))
+    results.append(await measure('fetch_revision', client, size, fetch_revision, books[:reads], concurrency))
+    return results
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    if args.cache:
+        set_cache(RecordCache())
+    set_trusted_reads(args.trusted)
+    if args.memory:
+        tracemalloc.start()
+    results = []
+    for size in args.sizes:
+        results += await run(size, args.latency, args.page_size, args.concurrency)
+    return {
+        'benchmark': 'aars',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency': args.latency,
+        'page_size': args.page_size,
+        'concurrency': args.concurrency,
+        'cache': args.cache,
+        'trusted': args.trusted,
+        'memory': args.memory,
+        'results': results,
+    }
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='numbers of records to benchmark with')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of latency of each remote call')
+    parser.add_argument('--page-size', type=int, default=200, help='maximum page size of the stand-in')
+    parser.add_argument('--concurrency', type=int, default=16, help='operations running at the same time')
+    parser.add_argument('--cache', action='store_true', help='enable the in-process record cache')
+    parser.add_argument('--trusted', action='store_true', help='build fetched records without validation')
+    parser.add_argument('--memory', action=argparse.BooleanOptionalAction, default=True,
+                        help='trace the peak memory of each scenario')
+    parser.add_argument('--output', help='file to write the JSON results to, instead of stdout')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    report = asyncio.run(main(arguments))
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
@@ -0,0 +1,63 @@
+"""
+Benchmark of the import time of the AARS package.
+
+    python -m bench.imports --runs 10 --max-seconds 0.5
+
+Each run imports the package in a fresh interpreter. The median time and the heavy modules which were loaded by the
+import are reported as JSON. With `--max-seconds`, the benchmark exits with an error if the median is slower, e.g. to
+guard the startup time in CI.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List
+
+MODULE = 'src.aars'
+# modules which are slow to import and should only be loaded on first use
+HEAVY_MODULES = ['aleph_client', 'eth_account', 'aiohttp', 'pkg_resources']
+
+SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+'''
+
+
+def measure(module: str, runs: int) -> Dict[str, Any]:
+    script = SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    results: List[Dict[str, Any]] = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    seconds = sorted(result['seconds'] for result in results)
+    return {
+        'module': module,
+        'runs': runs,
+        'median_seconds': statistics.median(seconds),
+        'min_seconds': seconds[0],
+        'max_seconds': seconds[-1],
+        'heavy_modules_loaded': results[-1]['loaded'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default=MODULE)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help='fail if the median import time exceeds this threshold')
+    args = parser.parse_args()
+
+    result = measure(args.module, args.runs)
+    print(json.dumps(result, indent=2))
+    if args.max_seconds is not None and result['median_seconds'] > args.max_seconds:
+        sys.exit(f'importing {args.module} took {result["median_seconds"]:.3f}s, '
+                 f'more than the threshold of {args.max_seconds:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark of bulk writes with signed messages against the in-process Aleph stand-in.
+
+    python -m bench.signing --posts 2000 --workers 1 2 4 8 --accounts 4 --output signing_output.json
+
+Records are created with `Record.create_many()` by a client which serializes, hashes and signs each message, on the
+event loop and in thread and process pools of each number of workers. Each scenario reports the posts per second, so
+that the scaling with the number of cores can be compared with `cpu_count`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from aleph_client.chains.common import generate_key
+from aleph_client.chains.ethereum import ETHAccount
+
+from src.aars import Record, AccountPool
+from src.aars.testing import LocalAlephClient
+
+WORKERS = [1, 2, 4]
+
+
+class Trade(Record):
+    symbol: str
+    price: float
+    amount: float
+
+
+async def measure(name: str,
+                  workers: int,
+                  accounts: AccountPool,
+                  executor: Optional[Executor],
+                  posts: int,
+                  max_in_flight: int) -> Dict[str, Any]:
+    client = LocalAlephClient(account=accounts, signing_executor=executor)
+    Trade.bind(client)
+    items = [{'symbol': 'BTCUSDT', 'price': 20000.0 + i, 'amount': i / 1000} for i in range(posts)]
+    # warms up the workers, e.g. starts the processes and loads the accounts in them
+    await Trade.create_many(items[:max_in_flight], max_in_flight=max_in_flight)
+    start = time.perf_counter()
+    results = await Trade.create_many(items, max_in_flight=max_in_flight)
+    elapsed = time.perf_counter() - start
+    return {
+        'scenario': name,
+        'workers': workers,
+        'accounts': len(accounts),
+        'posts': posts,
+        'failed': sum(not result.ok for result in results),
+        'seconds': round(elapsed, 6),
+        'posts_per_sec': round(posts / elapsed, 2),
+    }
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    accounts = AccountPool([ETHAccount(generate_key()) for _ in range(args.accounts)])
+    results = [await measure('event_loop', 0, accounts, None, args.posts, args.max_in_flight)]
+    for workers in args.workers:
+        with ThreadPoolExecutor(workers) as executor:
+            results.append(await measure('threads', workers, accounts, executor, args.posts, args.max_in_flight))
+        with ProcessPoolExecutor(workers) as executor:
+            results.append(await measure('processes', workers, accounts, executor, args.posts, args.max_in_flight))
+    return {
+        'benchmark': 'signing',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'max_in_flight': args.max_in_flight,
+        'results': results,
+    }
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=2000, help='number of records to create per scenario')
+    parser.add_argument('--workers', type=int, nargs='+', default=WORKERS, help='sizes of the pools to sign in')
+    parser.add_argument('--accounts', type=int, default=4, help='number of accounts which sign in turn')
+    parser.add_argument('--max-in-flight', type=int, default=64, help='posts being signed and sent at the same time')
+    parser.add_argument('--output', help='file to write the JSON results to, instead of stdout')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    report = asyncio.run(main(arguments))
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
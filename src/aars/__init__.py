@@ -1,11 +1,22 @@
 from src.aars.core import *
-from pkg_resources import get_distribution, DistributionNotFound
+from src.aars.cache import RecordCache, CacheStats
+from src.aars.client import ClientStats
+from src.aars.metrics import metrics, set_call_budget
+from src.aars.feed import ChangeFeed, Change, FeedCursor
+from src.aars.signing import AccountPool, MessageSigner
 
-try:
-    # Change here if project is renamed and does not equal the package name
-    dist_name = "aleph-ars"
-    __version__ = get_distribution(dist_name).version
-except DistributionNotFound:
-    __version__ = "unknown"
-finally:
-    del get_distribution, DistributionNotFound
+
+def __getattr__(name):
+    # resolved on first access, as both are slow: the version lookup reads the metadata of the installed distribution,
+    # the fallback account is loaded from or created as a key file
+    if name == '__version__':
+        from importlib.metadata import version, PackageNotFoundError
+        try:
+            # Change here if project is renamed and does not equal the package name
+            return version("aleph-ars")
+        except PackageNotFoundError:
+            return "unknown"
+    if name == 'FALLBACK_ACCOUNT':
+        from src.aars.core import get_fallback_account
+        return get_fallback_account()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
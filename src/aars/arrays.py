@@ -0,0 +1,150 @@
+import base64
+import zlib
+from typing import Any, ClassVar, Dict, Optional, Tuple, Type
+
+import numpy as np
+
+COMPRESSIONS = ('zlib', 'zstd')
+
+
+def compress(data: bytes, compression: Optional[str]) -> bytes:
+    if compression is None:
+        return data
+    if compression == 'zlib':
+        return zlib.compress(data)
+    if compression == 'zstd':
+        return _zstandard().ZstdCompressor().compress(data)
+    raise ValueError(f'Unknown compression {compression!r}, expected one of {COMPRESSIONS}')
+
+
+def decompress(data: bytes, compression: Optional[str]) -> bytes:
+    if compression is None:
+        return data
+    if compression == 'zlib':
+        return zlib.decompress(data)
+    if compression == 'zstd':
+        return _zstandard().ZstdDecompressor().decompress(data)
+    raise ValueError(f'Unknown compression {compression!r}, expected one of {COMPRESSIONS}')
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstd compression requires the zstandard package') from None
+    return zstandard
+
+
+def _is_delta_encodable(dtype: np.dtype) -> bool:
+    return dtype.kind in 'iuMm'
+
+
+def encode_array(array: np.ndarray, compression: str = None, delta: bool = False) -> Dict[str, Any]:
+    """
+    Encodes an array as its dtype, shape and base64 encoded bytes, which are optionally compressed.
+    :param array: The array to encode.
+    :param compression: 'zlib', 'zstd' or None.
+    :param delta: Whether to store the differences between consecutive values instead of the values, which makes
+        monotonic integer and datetime arrays, like timestamps, compress much better. Applies to the flattened array.
+    """
+    array = np.ascontiguousarray(array)
+    if delta and not _is_delta_encodable(array.dtype):
+        raise ValueError(f'Delta encoding needs an integer or datetime array, not {array.dtype}')
+    data = array
+    if delta and array.size:
+        # datetimes and timedeltas are subtracted as the integers they are stored as, integers wrap around on overflow
+        values = array.reshape(-1).view(np.int64) if array.dtype.kind in 'Mm' else array.reshape(-1)
+        data = np.empty_like(values)
+        data[0] = values[0]
+        np.subtract(values[1:], values[:-1], out=data[1:])
+    return {
+        'dtype': array.dtype.str,
+        'shape': list(array.shape),
+        'compression': compression,
+        'delta': delta,
+        'data': base64.b64encode(compress(data.tobytes(), compression)).decode('ascii'),
+    }
+
+
+def decode_array(encoded: Dict[str, Any]) -> np.ndarray:
+    """
+    Decodes an array encoded by `encode_array()`. Unless the array was delta encoded, it is a read-only view of the
+    decoded bytes, without copying them again.
+    """
+    dtype = np.dtype(encoded['dtype'])
+    data = decompress(base64.b64decode(encoded['data']), encoded.get('compression'))
+    array = np.frombuffer(data, dtype=dtype)
+    if encoded.get('delta') and array.size:
+        # datetimes and timedeltas are summed as the integers they are stored as
+        integers = array.view(np.int64) if dtype.kind in 'Mm' else array
+        array = np.cumsum(integers, dtype=integers.dtype).view(dtype)
+    return array.reshape(encoded['shape'])
+
+
+class Array:
+    """
+    Field type of NumPy arrays, which are stored on Aleph in the compact binary encoding of `encode_array()` instead of
+    as JSON lists. Fields of this type accept arrays, lists and encoded arrays, and hold arrays. Use `ArrayField()` to
+    fix the dtype or shape, or to compress or delta encode the stored arrays.
+
+    >>> class Series(Record):
+    ...     timestamps: ArrayField(dtype='int64', delta=True, compression='zlib')
+    ...     values: ArrayField(dtype='float32')
+    """
+    dtype: ClassVar[Optional[np.dtype]] = None
+    shape: ClassVar[Optional[Tuple[Optional[int], ...]]] = None
+    compression: ClassVar[Optional[str]] = None
+    delta: ClassVar[bool] = False
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def __modify_schema__(cls, field_schema: Dict[str, Any]):
+        field_schema.update(type='object', properties={'dtype': {'type': 'string'}, 'shape': {'type': 'array'},
+                                                       'data': {'type': 'string'}})
+
+    @classmethod
+    def validate(cls, value: Any) -> np.ndarray:
+        if isinstance(value, dict):
+            value = decode_array(value)
+        array = np.asarray(value, dtype=cls.dtype)
+        if cls.dtype is not None and array.dtype != cls.dtype:
+            array = array.astype(cls.dtype)
+        if cls.shape is not None:
+            if len(cls.shape) != array.ndim or any(size is not None and size != actual
+                                                     for size, actual in zip(cls.shape, array.shape)):
+                raise ValueError(f'Expected an array of shape {cls.shape}, got {array.shape}')
+        return array
+
+    @classmethod
+    def to_content(cls, value: np.ndarray) -> Dict[str, Any]:
+        """Returns the value as it is stored in the content of posts."""
+        return encode_array(np.asarray(value, dtype=cls.dtype), compression=cls.compression, delta=cls.delta)
+
+
+_array_types: Dict[tuple, Type[Array]] = {}
+
+
+def ArrayField(dtype: Any = None,
+               shape: Tuple[Optional[int], ...] = None,
+               compression: str = None,
+               delta: bool = False) -> Type[Array]:
+    """
+    Returns the field type of arrays with the given encoding, to annotate fields of records with.
+    :param dtype: The dtype which values are converted to. If None, the dtype of the value is kept.
+    :param shape: The shape of the arrays, where None allows any size of the dimension.
+    :param compression: 'zlib', 'zstd' (which requires the zstandard package) or None.
+    :param delta: Whether to delta encode the arrays, for monotonic integer or datetime arrays like timestamps.
+    """
+    dtype = None if dtype is None else np.dtype(dtype)
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError(f'Unknown compression {compression!r}, expected one of {COMPRESSIONS}')
+    if delta and dtype is not None and not _is_delta_encodable(dtype):
+        raise ValueError(f'Delta encoding needs an integer or datetime dtype, not {dtype}')
+    key = (dtype, None if shape is None else tuple(shape), compression, delta)
+    if key not in _array_types:
+        _array_types[key] = type('ArrayField', (Array,), {'dtype': key[0], 'shape': key[1],
+                                                         'compression': compression, 'delta': delta})
+    return _array_types[key]
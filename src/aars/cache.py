@@ -0,0 +1,153 @@
+import json
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+
+class Cache(ABC):
+    """
+    Interface of the cache used by `fetch_records` and `fetch_revisions`.
+
+    Posts are identified by their type and item_hash. As the content of a post never changes, they can be kept
+    as long as the cache wants. The list of revisions of a record grows with each amend, so implementations should
+    only consider it fresh for a short time. An expired list is still a prefix of the current one, so it should be
+    kept to fetch only the newer revisions.
+    """
+
+    @abstractmethod
+    def get_post(self, post_type: str, item_hash: str) -> Optional[Dict[str, Any]]:
+        """Returns the raw post with given type and item_hash, or None if it is not cached."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def put_post(self, post: Dict[str, Any]) -> None:
+        """Caches a raw post, as returned by Aleph."""
+        raise NotImplementedError
+
+    def put_posts(self, posts: Iterable[Dict[str, Any]]) -> None:
+        """Caches multiple raw posts at once."""
+        for post in posts:
+            self.put_post(post)
+
+    @abstractmethod
+    def get_revisions(self, post_type: str, ref: str, stale: bool = False) -> Optional[List[str]]:
+        """
+        Returns the item_hashes of all amendments of given record, oldest first, or None if they are not cached.
+        If `stale` is set, an expired or invalidated list is returned too, as it is a prefix of the current one.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def put_revisions(self, post_type: str, ref: str, revisions: List[str]) -> None:
+        """Caches the item_hashes of all amendments of given record, oldest first."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def invalidate(self, post_type: str, item_hash: str) -> None:
+        """Removes everything cached about given post and expires its list of revisions."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear(self) -> None:
+        raise NotImplementedError
+
+
+class RecordCache(Cache):
+    """
+    In-memory LRU cache of raw Aleph posts and revision lists.
+
+    Posts are kept until they are evicted, revision lists expire after `revisions_ttl` seconds. The least recently
+    used entries are evicted once more than `max_entries` entries or more than `max_bytes` bytes of (JSON-encoded)
+    data are cached.
+    """
+
+    def __init__(self,
+                 max_entries: int = 10_000,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 revisions_ttl: float = 5.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.revisions_ttl = revisions_ttl
+        self.clock = clock
+        self.stats = CacheStats()
+        # key -> (value, size in bytes, expiry time or None)
+        self._entries: 'OrderedDict[Hashable, Tuple[Any, int, Optional[float]]]' = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_post(self, post_type: str, item_hash: str) -> Optional[Dict[str, Any]]:
+        return self._get(('post', post_type, item_hash))
+
+    def put_post(self, post: Dict[str, Any]) -> None:
+        self._put(('post', post['type'], post['item_hash']), post)
+
+    def get_revisions(self, post_type: str, ref: str, stale: bool = False) -> Optional[List[str]]:
+        revisions = self._get(('revisions', post_type, ref), stale=stale)
+        return None if revisions is None else list(revisions)
+
+    def put_revisions(self, post_type: str, ref: str, revisions: List[str]) -> None:
+        self._put(('revisions', post_type, ref), tuple(revisions), ttl=self.revisions_ttl)
+
+    def invalidate(self, post_type: str, item_hash: str) -> None:
+        if ('post', post_type, item_hash) in self._entries:
+            self._remove(('post', post_type, item_hash))
+        key = ('revisions', post_type, item_hash)
+        if key in self._entries:
+            value, size, _ = self._entries[key]
+            self._entries[key] = (value, size, float('-inf'))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.stats.entries = 0
+        self.stats.bytes = 0
+
+    def _get(self, key: Hashable, stale: bool = False) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        value, _, expires = entry
+        if expires is not None and expires <= self.clock() and not stale:
+            # expired entries are kept until they are evicted, to be asked for with `stale`
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    def _put(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        expires = None if ttl is None else self.clock() + ttl
+        self._entries[key] = (value, size, expires)
+        self.stats.entries += 1
+        self.stats.bytes += size
+        while self.stats.entries > self.max_entries or self.stats.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.stats.evictions += 1
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.stats.entries -= 1
+        self.stats.bytes -= size
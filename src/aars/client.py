@@ -0,0 +1,331 @@
+import asyncio
+import time
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Set, Union, TYPE_CHECKING
+
+from src.aars.metrics import record_remote_call
+from src.aars.signing import AccountPool, MessageSigner
+from src.aars.utils import retry
+
+# aiohttp and aleph_client take most of the import time of the package, they are imported on first use
+if TYPE_CHECKING:
+    import aiohttp
+    from aleph_client.types import Account
+
+
+def _aleph():
+    import aleph_client.asynchronous
+    return aleph_client.asynchronous
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Whether a failed request to Aleph is worth retrying: connection problems, timeouts, rate limiting and server
+    errors are, client errors are not.
+    """
+    from aiohttp import ClientError, ClientResponseError
+    if isinstance(error, ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (ClientError, asyncio.TimeoutError, ConnectionError))
+
+
+@dataclass
+class ClientStats:
+    requests: int = 0
+    retries: int = 0
+    errors: int = 0
+    connections_created: int = 0
+    connections_reused: int = 0
+
+    @property
+    def reuse_ratio(self) -> float:
+        connections = self.connections_created + self.connections_reused
+        return self.connections_reused / connections if connections else 0.0
+
+
+@dataclass
+class SignedMessage:
+    """A message which has been signed by the client and broadcast to the API server."""
+    item_hash: str
+    type: str
+    channel: str
+    sender: str
+    time: float
+    signature: str
+    content: Dict[str, Any]
+
+
+class TokenBucket:
+    """
+    Limits the rate of requests to `rate` per second on average, allowing bursts of up to `burst` requests.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, clock=time.monotonic):
+        assert rate > 0 and burst > 0
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    async def acquire(self):
+        while True:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AlephClient:
+    """
+    Session with an Aleph API server, used by records to post, amend, forget and fetch their data.
+
+    It owns one pooled aiohttp session with keep-alive connections, limits the number of concurrent requests and
+    optionally their rate, applies a timeout to each request and retries failed reads. Posts and forgets are not
+    retried, as they are not idempotent; `Record.upsert_many()` retries them explicitly.
+
+    Messages are signed by aleph_client on the event loop. Given a `signing_executor`, or an `AccountPool` whose
+    accounts sign in turn, the client serializes, hashes and signs them itself, in the executor if there is one.
+
+    >>> async with AlephClient(account, channel='MY_CHANNEL') as client:
+    ...     MyRecord.bind(client)
+
+    :param account: The account to sign messages with, or a pool of accounts.
+    :param channel: The channel to post to and to read from, if no other is given.
+    :param api_server: URL of the Aleph API server. If None, the one configured for aleph_client is used.
+    :param max_connections: Maximum number of concurrent requests and open connections to the server.
+    :param rate_limit: Maximum number of requests per second on average. If None, the rate is not limited.
+    :param burst: Number of requests that may exceed the rate limit at once.
+    :param timeout: Total timeout of a request in seconds.
+    :param retries: Number of retries of a read on transient errors.
+    :param keepalive_timeout: Seconds for which idle connections are kept open.
+    :param signing_executor: Thread or process pool to sign messages in. It is not shut down by the client.
+    """
+
+    def __init__(self,
+                 account: Union['Account', AccountPool],
+                 channel: str,
+                 api_server: str = None,
+                 max_connections: int = 16,
+                 rate_limit: Optional[float] = None,
+                 burst: int = 10,
+                 timeout: float = 30.0,
+                 retries: int = 3,
+                 keepalive_timeout: float = 30.0,
+                 signing_executor: Executor = None):
+        self.account = account
+        self.channel = channel
+        if api_server is None:
+            from aleph_client.conf import settings
+            api_server = settings.API_HOST
+        self.api_server = api_server
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.retries = retries
+        self.keepalive_timeout = keepalive_timeout
+        self.rate_limiter = None if rate_limit is None else TokenBucket(rate_limit, burst)
+        self.stats = ClientStats()
+        self.signer = MessageSigner(signing_executor) \
+            if signing_executor is not None or isinstance(account, AccountPool) else None
+        self._session: Optional['aiohttp.ClientSession'] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # closing of the sessions of previous event loops, referenced until they are done
+        self._closing: Set[asyncio.Future] = set()
+
+    async def __aenter__(self) -> 'AlephClient':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def session(self) -> 'aiohttp.ClientSession':
+        """The pooled session, created on first use in the running event loop."""
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        if self._session is not None and not self._session.closed and self._loop is not loop:
+            self._close_stale_session(loop)
+        if self._session is None or self._session.closed or self._loop is not loop:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._on_connection_created)
+            trace.on_connection_reuseconn.append(self._on_connection_reused)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.max_connections,
+                                               keepalive_timeout=self.keepalive_timeout),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs=[trace],
+            )
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+            self._loop = loop
+        return self._session
+
+    def _close_stale_session(self, loop: asyncio.AbstractEventLoop):
+        # the session of another event loop cannot be used in this one, but its connections still need to be closed
+        session, session_loop = self._session, self._loop
+        self._session = None
+        if session_loop.is_running():
+            closing = asyncio.wrap_future(asyncio.run_coroutine_threadsafe(session.close(), session_loop), loop=loop)
+        else:
+            closing = loop.create_task(session.close())
+        self._closing.add(closing)
+        closing.add_done_callback(self._closing.discard)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            if self._loop is asyncio.get_running_loop():
+                await self._session.close()
+            else:
+                self._close_stale_session(asyncio.get_running_loop())
+        self._session = None
+        if self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)
+
+    async def get_posts(self,
+                        types: Iterable[str] = None,
+                        refs: Iterable[str] = None,
+                        addresses: Iterable[str] = None,
+                        hashes: Iterable[str] = None,
+                        channels: Iterable[str] = None,
+                        start_date: float = None,
+                        pagination: int = 200,
+                        page: int = 1) -> Dict[str, Any]:
+        return await self._request('get_posts', lambda: _aleph().get_posts(
+            types=types, refs=refs, addresses=addresses, hashes=hashes, channels=channels, start_date=start_date,
+            pagination=pagination, page=page, session=self.session, api_server=self.api_server
+        ), retries=self.retries)
+
+    async def get_messages(self,
+                           message_types: Iterable[str] = None,
+                           channels: Iterable[str] = None,
+                           start_date: float = None,
+                           pagination: int = 200,
+                           page: int = 1) -> Dict[str, Any]:
+        """Returns a page of messages of all kinds, e.g. POST and FORGET messages, newest first."""
+        # the API takes a single message type, others are filtered locally
+        message_types = None if message_types is None else list(message_types)
+        message_type = message_types[0] if message_types is not None and len(message_types) == 1 else None
+        resp = await self._request('get_messages', lambda: _aleph().get_messages(
+            message_type=message_type, channels=channels, start_date=start_date, pagination=pagination, page=page,
+            session=self.session, api_server=self.api_server
+        ), retries=self.retries)
+        if message_types is not None:
+            resp['messages'] = [message for message in resp['messages'] if message['type'] in message_types]
+        return resp
+
+    def watch_messages(self,
+                       channels: Iterable[str] = None,
+                       start_date: float = None) -> AsyncIterator[Dict[str, Any]]:
+        """Iterates over the messages since `start_date` and all future messages, as the API server streams them."""
+        return _aleph().watch_messages(channels=channels, start_date=start_date, session=self.session,
+                                    api_server=self.api_server)
+
+    async def create_post(self,
+                          post_content: Any,
+                          post_type: str,
+                          ref: str = None,
+                          account: 'Account' = None,
+                          channel: str = None):
+        if self.signer is not None:
+            content = {'type': post_type, 'address': self._address(account), 'content': post_content,
+                       'time': time.time()}
+            if ref is not None:
+                content['ref'] = ref
+            return await self._submit('create_post', 'POST', content, account, channel)
+        return await self._request('create_post', lambda: _aleph().create_post(
+            account or self.account, post_content, post_type=post_type, ref=ref, channel=channel or self.channel,
+            session=self.session, api_server=self.api_server
+        ))
+
+    async def forget(self,
+                     hashes: List[str],
+                     reason: str = None,
+                     account: 'Account' = None,
+                     channel: str = None):
+        if self.signer is not None:
+            content = {'hashes': list(hashes), 'address': self._address(account), 'time': time.time()}
+            if reason is not None:
+                content['reason'] = reason
+            return await self._submit('forget', 'FORGET', content, account, channel)
+        return await self._request('forget', lambda: _aleph().forget(
+            account or self.account, hashes, reason=reason, channel=channel or self.channel,
+            session=self.session, api_server=self.api_server
+        ))
+
+    def _address(self, account: Optional['Account']) -> str:
+        # the owner's address for accounts of the pool, so that delegates post on its behalf
+        return (account or self.account).get_address()
+
+    def _signing_account(self, account: Optional['Account']) -> 'Account':
+        account = account or self.account
+        return account.next() if isinstance(account, AccountPool) else account
+
+    async def _sign(self,
+                    message_type: str,
+                    content: Dict[str, Any],
+                    account: 'Account' = None,
+                    channel: str = None) -> Dict[str, Any]:
+        """Signs a message with the given account, or the next one of the client's account(s)."""
+        account = self._signing_account(account)
+        channel = channel or self.channel
+        message = await self.signer.sign(account, message_type, content, channel)
+        if message is None:
+            item_hash = await self._storage_push(content)
+            message = await self.signer.sign(account, message_type, content, channel, item_hash=item_hash)
+        return message
+
+    async def _storage_push(self, content: Dict[str, Any]) -> str:
+        return await self._request('storage_push', lambda: _aleph().storage_push(
+            content, session=self.session, api_server=self.api_server
+        ))
+
+    async def _submit(self,
+                      method: str,
+                      message_type: str,
+                      content: Dict[str, Any],
+                      account: 'Account' = None,
+                      channel: str = None) -> SignedMessage:
+        message = await self._sign(message_type, content, account, channel)
+        await self._request(method, lambda: _aleph().broadcast(
+            message, session=self.session, api_server=self.api_server
+        ))
+        return SignedMessage(item_hash=message['item_hash'], type=message_type, channel=message['channel'],
+                             sender=message['sender'], time=message['time'], signature=message['signature'],
+                             content=content)
+
+    async def _request(self, method: str, func, retries: int = 0):
+        self.session  # creates the session and the semaphore in the running loop, if needed
+
+        async def attempt():
+            # held per attempt only, so that the backoff before a retry does not block other requests
+            async with self._semaphore:
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.acquire()
+                self.stats.requests += 1
+                start = time.perf_counter()
+                try:
+                    result = await func()
+                except Exception:
+                    record_remote_call(method, time.perf_counter() - start, error=True)
+                    raise
+                record_remote_call(method, time.perf_counter() - start)
+                return result
+
+        try:
+            result, attempts = await retry(attempt, retries=retries, should_retry=is_transient)
+        except Exception as error:
+            self.stats.errors += 1
+            self.stats.retries += error.attempts - 1
+            raise
+        self.stats.retries += attempts - 1
+        return result
+
+    async def _on_connection_created(self, session, context, params):
+        self.stats.connections_created += 1
+
+    async def _on_connection_reused(self, session, context, params):
+        self.stats.connections_reused += 1
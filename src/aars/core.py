@@ -1,25 +1,85 @@
 from abc import ABC
 import asyncio
-import warnings
+import json
+import time
+from dataclasses import dataclass
 from collections import OrderedDict
+from bisect import bisect_left, bisect_right, insort
+from itertools import chain
+from weakref import WeakKeyDictionary
 from operator import itemgetter, attrgetter
 
-from src.aars.utils import subslices
+from src.aars.utils import chunks, prefetch, retry, map_bounded, BatchLoader
 
-from aleph_client.types import Account
-from pydantic import BaseModel
-from typing import Type, TypeVar, Dict, ClassVar, List, Optional, Set, Any, Union, Tuple
+from pydantic import BaseModel, PrivateAttr
+from pydantic.json import pydantic_encoder
+from typing import Type, TypeVar, Dict, ClassVar, List, Optional, Set, Any, Union, Tuple, AsyncIterator, Iterator, \
+    Iterable, Callable, AsyncIterable, Collection, FrozenSet, TYPE_CHECKING
 
-import aleph_client.asynchronous as client
-from aleph_client.chains.ethereum import get_fallback_account
 
-from src.aars.exceptions import AlreadyForgottenError
+from src.aars.cache import Cache
+from src.aars.client import AlephClient, is_transient
+from src.aars.store import PostStore
+from src.aars.exceptions import AlreadyForgottenError, RefNotResolvedError
+from src.aars.planner import QueryPlan, plan_query
+from src.aars.metrics import span, traced
+from src.aars.hydration import content_serializer, trusted_constructor
 
-FALLBACK_ACCOUNT = get_fallback_account()
 AARS_TEST_CHANNEL = "AARS_TEST"
+DEFAULT_PAGE_SIZE = 200
+DEFAULT_MAX_PAGES_IN_FLIGHT = 2
+DEFAULT_MAX_POSTS_IN_FLIGHT = 16
+DEFAULT_RETRIES = 3
+# sorts after any item_hash, used as upper bound when bisecting (key, item_hash) entries
+MAX_HASH = chr(0x10FFFF)
+# version of the format of published index snapshots
+SNAPSHOT_FORMAT_VERSION = 1
+# number of (key, item_hash) entries per posted chunk of an index snapshot
+DEFAULT_SNAPSHOT_CHUNK_SIZE = 5_000
+# seconds of posts before the high-water mark of an index which are replayed again, in case of clock skew of writers
+HIGH_WATER_MARK_MARGIN = 60.0
+# batches of more entries are merged into a RangeIndex in one pass, instead of inserting or deleting them one by one,
+# which moves all entries behind each of them
+RANGE_INDEX_MERGE_THRESHOLD = 512
+# fields of records which are not part of the content posted to Aleph
+CONTENT_EXCLUDE = frozenset({'item_hash', 'current_revision', 'revision_hashes', 'indices', 'forgotten'})
+
+_fallback_account: Optional['Account'] = None
+_default_client: Optional[AlephClient] = None
+_clients: Dict[type, AlephClient] = {}
+_cache: Optional[Cache] = None
+_store: Optional[PostStore] = None
+_trusted_reads = False
+# seconds for which fetches by item_hash are collected into one request, or None to disable it
+_coalescing_delay: Optional[float] = 0.0
+_loaders: 'WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[type, str], BatchLoader]]' = WeakKeyDictionary()
 
 T = TypeVar('T', bound='AlephRecord')
 
+# aleph_client's accounts take most of the import time of the package, they are imported on first use
+if TYPE_CHECKING:
+    from aleph_client.types import Account
+    from src.aars.feed import ChangeFeed, FeedCursor
+
+
+def get_fallback_account() -> 'Account':
+    """
+    Returns the fallback account of aleph_client, which signs the posts of the default client. It is loaded, or
+    created with a new key file, on first use.
+    """
+    global _fallback_account
+    if _fallback_account is None:
+        from aleph_client.chains.ethereum import get_fallback_account as load_fallback_account
+        _fallback_account = load_fallback_account()
+    return _fallback_account
+
+
+def __getattr__(name: str) -> Any:
+    # FALLBACK_ACCOUNT is resolved on first access
+    if name == 'FALLBACK_ACCOUNT':
+        return get_fallback_account()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 class Record(BaseModel, ABC):
     """
@@ -40,6 +100,8 @@ class Record(BaseModel, ABC):
     current_revision: int = None
     revision_hashes: List[str] = []
     __indices: ClassVar[Dict[str, 'Index']] = {}
+    # names of the fields that were fetched, if the record was fetched with a projection
+    _projection: Optional[FrozenSet[str]] = PrivateAttr(default=None)
 
     def __repr__(self):
         return f'{type(self).__name__}({self.item_hash})'
@@ -49,17 +111,21 @@ class Record(BaseModel, ABC):
         """
         :return: content dictionary of the object, as it is to be stored on Aleph.
         """
-        return self.dict(exclude={'item_hash', 'current_revision', 'revision_hashes', 'indices', 'forgotten'})
+        return content_serializer(type(self), CONTENT_EXCLUDE)(self)
 
     async def update_revision_hashes(self: T):
         """
-        Updates the list of available revision hashes, in order to fetch these.
+        Updates the list of available revision hashes, in order to fetch these. Only revisions newer than the last
+        known one are fetched.
         """
-        self.revision_hashes = [self.item_hash] + await fetch_revisions(type(self), ref=self.item_hash)
+        revisions = await fetch_revisions_many(type(self), refs=[self.item_hash],
+                                               known={self.item_hash: self.revision_hashes[1:]})
+        self.revision_hashes = [self.item_hash] + revisions[self.item_hash]
 
     async def fetch_revision(self: T, rev_no: int = None, rev_hash: str = None) -> T:
         """
-        Fetches a revision of the object by revision number (0 => original) or revision hash.
+        Fetches a revision of the object by revision number (0 => original) or revision hash. The content of the
+        revision is served from the cache, if it has been fetched before.
         :param rev_no: the revision number of the revision to fetch.
         :param rev_hash: the hash of the revision to fetch.
         """
@@ -68,30 +134,54 @@ class Record(BaseModel, ABC):
                 rev_no = len(self.revision_hashes) + rev_no
             if self.current_revision == rev_no:
                 return self
-            elif rev_no > len(self.revision_hashes):
+            if not 0 <= rev_no < len(self.revision_hashes):
+                await self.update_revision_hashes()
+            if not 0 <= rev_no < len(self.revision_hashes):
                 raise IndexError(f'No revision no. {rev_no} found for {self}')
-            else:
-                self.current_revision = rev_no
+            rev_hash = self.revision_hashes[rev_no]
         elif rev_hash is not None:
-            try:
-                self.current_revision = self.revision_hashes.index(rev_hash)
-            except ValueError:
+            if rev_hash not in self.revision_hashes:
+                await self.update_revision_hashes()
+            if rev_hash not in self.revision_hashes:
                 raise IndexError(f'{rev_hash} is not a revision of {self}')
+            rev_no = self.revision_hashes.index(rev_hash)
         else:
             raise ValueError('Either rev or hash must be provided')
 
-        # always fetch from aleph
-        self.__dict__.update((await fetch_records(type(self), item_hashes=[self.item_hash]))[0].content)
-
+        post = (await fetch_posts(type(self), [rev_hash])).get(rev_hash)
+        if post is None:
+            raise IndexError(f'Revision {rev_hash} of {self} could not be fetched')
+        revision = type(self)(**post['content'])
+        self.__dict__.update((key, getattr(revision, key)) for key in revision.content.keys())
+        self.current_revision = rev_no
         return self
 
+    async def iter_revisions(self: T, page_size: int = DEFAULT_PAGE_SIZE) -> AsyncIterator[T]:
+        """
+        Iterates over all revisions of the object, oldest first, as separate objects. The revision chain is updated
+        with the newer revisions first. Their contents are fetched lazily in pages, while the previous page is
+        consumed, and served from the cache if they have been fetched before.
+        :param page_size: Number of revisions to fetch per request.
+        """
+        await self.update_revision_hashes()
+        revision_hashes = list(self.revision_hashes)
+
+        async def fetch_page(hashes: List[str]) -> List[T]:
+            posts = await fetch_posts(type(self), hashes, page_size=page_size)
+            return [type(self).from_post_and_revisions(posts[item_hash], revision_hashes[1:])
+                    for item_hash in hashes if item_hash in posts]
+
+        async for revisions in prefetch((fetch_page(hashes) for hashes in chunks(revision_hashes, page_size)),
+                                       DEFAULT_MAX_PAGES_IN_FLIGHT):
+            for revision in revisions:
+                yield revision
+
     async def upsert(self):
         """
         Posts a new item to Aleph or amends it, if it was already posted. Will add the new revision
         """
         await post_or_amend_object(self)
-        if self.current_revision == 0:
-            [index.add(self) for index in self.get_indices()]
+        [index.add(self) for index in self.get_indices()]
         return self
 
     async def forget(self):
@@ -101,6 +191,7 @@ class Record(BaseModel, ABC):
         """
         if not self.forgotten:
             await forget_objects([self])
+            [index.remove(self) for index in self.get_indices()]
             self.forgotten = True
         else:
             raise AlreadyForgottenError(self)
@@ -113,41 +204,133 @@ class Record(BaseModel, ABC):
         obj = cls(**kwargs)
         return await obj.upsert()
 
+    @classmethod
+    async def create_many(cls: Type[T],
+                          items: Union[Iterable[Dict[str, Any]], AsyncIterable[Dict[str, Any]]],
+                          max_in_flight: int = DEFAULT_MAX_POSTS_IN_FLIGHT,
+                          retries: int = DEFAULT_RETRIES) -> List['WriteResult']:
+        """
+        Initializes and uploads new items from an iterable of property dictionaries. See `upsert_many()`.
+        """
+        async def create(properties: Dict[str, Any]) -> 'WriteResult':
+            try:
+                obj = cls(**properties)
+            except Exception as error:
+                return WriteResult(record=None, error=error, attempts=0)
+            return await _write_with_retries(obj, retries)
+
+        results = await map_bounded(create, items, max_in_flight)
+        _index_written(results)
+        return results
+
+    @classmethod
+    async def upsert_many(cls: Type[T],
+                          objs: Union[Iterable[T], AsyncIterable[T]],
+                          max_in_flight: int = DEFAULT_MAX_POSTS_IN_FLIGHT,
+                          retries: int = DEFAULT_RETRIES) -> List['WriteResult']:
+        """
+        Posts or amends many items, with at most `max_in_flight` posts being sent at the same time. The iterable is
+        consumed lazily, so it can be a generator over more items than fit in memory. Transient errors are retried
+        with exponential backoff and jitter. A failing item does not stop the others: the returned results tell for
+        each item, in input order, whether it was written. The indices are updated once, after all items are written.
+        :param objs: The records to upsert.
+        :param max_in_flight: Maximum number of posts being sent at the same time.
+        :param retries: Number of retries per item on transient errors.
+        """
+        results = await map_bounded(lambda obj: _write_with_retries(obj, retries), objs, max_in_flight)
+        _index_written(results)
+        return results
+
     @classmethod
     async def from_post(cls: Type[T], post: Dict[str, Any]) -> T:
         """
         Initializes a record object from its raw Aleph data.
         :post: Raw Aleph data.
         """
-        obj = cls(**post['content'])
-        if post.get('ref') is None:
-            obj.item_hash = post['item_hash']
-            obj.revision_hashes.append(post['item_hash'])
+        return (await cls.from_posts([post]))[0]
+
+    @classmethod
+    @traced('from_post')
+    async def from_posts(cls: Type[T], posts: List[Dict[str, Any]], fields: Collection[str] = None) -> List[T]:
+        """
+        Initializes record objects from a list of raw Aleph posts. The revisions of all posts are resolved with one
+        request, instead of one request per post.
+        :posts: Raw Aleph data.
+        :fields: Names of the fields to materialize. If None, all fields are.
+        """
+        refs = list(OrderedDict.fromkeys(post.get('ref') or post['item_hash'] for post in posts))
+        revisions = await fetch_revisions_many(cls, refs=refs)
+        with span('hydrate'):
+            return [cls.from_post_and_revisions(post, revisions.get(post.get('ref') or post['item_hash'], []), fields)
+                    for post in posts]
+
+    @classmethod
+    def from_post_and_revisions(cls: Type[T],
+                                post: Dict[str, Any],
+                                revisions: List[str],
+                                fields: Collection[str] = None) -> T:
+        """
+        Initializes a record object from its raw Aleph data and the already known hashes of its amendments. The data is
+        only validated if trusted reads are disabled and all fields are materialized.
+        :post: Raw Aleph data.
+        :revisions: item_hashes of all amendments of the original post, oldest first.
+        :fields: Names of the fields to materialize. If None, all fields are.
+        """
+        if fields is not None:
+            obj = trusted_constructor(cls)(post['content'], fields)
+            obj._projection = frozenset(fields)
+        elif _trusted_reads:
+            obj = trusted_constructor(cls)(post['content'])
         else:
-            obj.item_hash = post['ref']
-            obj.revision_hashes = await fetch_revisions(cls, ref=obj.item_hash)
+            obj = cls(**post['content'])
         obj.item_hash = post['item_hash'] if post.get('ref') is None else post['ref']
-        await obj.update_revision_hashes()
+        obj.revision_hashes = [obj.item_hash] + revisions
         obj.current_revision = obj.revision_hashes.index(post['item_hash'])
         return obj
 
     @classmethod
-    async def get(cls: Type[T], hashes: Union[str, List[str]]) -> List[T]:
+    async def get(cls: Type[T],
+                  hashes: Union[str, List[str]],
+                  fields: Collection[str] = None,
+                  resolve: int = 0) -> List[T]:
         """
         Fetches one or more objects of given type by its/their item_hash[es].
+        :param fields: Names of the fields to materialize. If None, all fields are.
+        :param resolve: Levels of references to other records to resolve, see `resolve_refs()`.
         """
         if not isinstance(hashes, List):
             hashes = [hashes]
-        return await fetch_records(cls, list(hashes))
+        return await fetch_records(cls, list(hashes), fields=fields, resolve=resolve)
 
     @classmethod
-    async def fetch_all(cls: Type[T]) -> List[T]:
+    async def fetch_all(cls: Type[T], fields: Collection[str] = None, resolve: int = 0) -> List[T]:
         """
         Fetches all objects of given type.
+        :param fields: Names of the fields to materialize. If None, all fields are. Objects fetched with a projection
+        are built without validation and cannot be upserted.
+        :param resolve: Levels of references to other records to resolve, see `resolve_refs()`.
+        """
+        return await fetch_records(cls, fields=fields, resolve=resolve)
+
+    @classmethod
+    def iter_all(cls: Type[T],
+                 page_size: int = DEFAULT_PAGE_SIZE,
+                 max_pages_in_flight: int = DEFAULT_MAX_PAGES_IN_FLIGHT,
+                 fields: Collection[str] = None,
+                 resolve: int = 0) -> AsyncIterator[T]:
+        """
+        Iterates over all objects of given type, fetching them page by page. The next pages are prefetched while the
+        current one is consumed.
+        :param page_size: Number of objects to fetch per request.
+        :param max_pages_in_flight: Maximum number of pages being fetched or buffered at the same time.
+        :param fields: Names of the fields to materialize. If None, all fields are.
+        :param resolve: Levels of references to other records to resolve per page, see `resolve_refs()`.
         """
-        return await fetch_records(cls)
+        return iter_records(cls, page_size=page_size, max_pages_in_flight=max_pages_in_flight, fields=fields,
+                            resolve=resolve)
 
     @classmethod
+    @traced('query')
     async def query(cls: Type[T], **kwargs) -> List[T]:
         """
         Queries an object by given properties through an index, in order to fetch applicable records.
@@ -164,38 +347,118 @@ class Record(BaseModel, ABC):
 
         If only a part of the keys is indexed for the given query, a fallback index is used and locally filtered.
         """
-        #Atlas Shrugged3
-        sorted_items = OrderedDict(sorted(kwargs.items()))
-        # OrderedDict([('author', 'Ayn Rand'), ('title', 'Atlas Shrugged1')])
-        sorted_keys = sorted_items.keys()
-        # dict_keys(['author', 'title']) sortedKeys  Sort the keys
-        full_index_name = cls.__name__ + '.' + '.'.join(sorted_keys)
-        # Concatinate with the the class name book   Book.author.title
-        if cls.__indices.get(full_index_name) is None:
-            key_subslices = subslices(list(sorted_items.keys()))
-            # returns all plausible combinations of keys
-            key_subslices = sorted(key_subslices, key=lambda x: len(x), reverse=True)
-            for keys in key_subslices:
-                name = cls.__name__ + '.' + '.'.join(keys)
-                # cls.indices Book
-                if cls.__indices.get(name):
-                    warnings.warn(f'No index {full_index_name} found. Using {name} instead.')
-                    list_of_items_returned_from_fetch = await cls.__indices[name].fetch(
-                        OrderedDict({key: sorted_items.get(key) for key in keys})
-                    )
-                    final_items = list()
-                    for item in list_of_items_returned_from_fetch:
-                        # eliminate the item which does not fulfill this properties
-                        class_properties = vars(item)
-                        required_class_properties = {key: class_properties.get(key) for key in sorted_keys}
-                        if required_class_properties == dict(sorted_items):
-                            final_items.append(item)
-                    return final_items
-            raise IndexError(f'No index {full_index_name} found.')
-        else:
-            return await cls.__indices[full_index_name].fetch(
-                OrderedDict({key: sorted_items.get(key) for key in sorted_keys})
-            )
+        return [record async for record in cls.iter_query(**kwargs)]
+
+    @classmethod
+    async def iter_query(cls: Type[T],
+                         page_size: int = DEFAULT_PAGE_SIZE,
+                         max_pages_in_flight: int = DEFAULT_MAX_PAGES_IN_FLIGHT,
+                         **kwargs) -> AsyncIterator[T]:
+        """
+        Same as `query()`, but iterates over the applicable records page by page, instead of fetching all at once.
+        :param page_size: Number of objects to fetch per request.
+        :param max_pages_in_flight: Maximum number of pages being fetched or buffered at the same time.
+        """
+        plan = plan_query(cls.__name__, cls.get_indices(), kwargs)
+        async for record in cls._execute(plan, page_size, max_pages_in_flight):
+            yield record
+
+    @classmethod
+    async def explain(cls: Type[T], **kwargs) -> QueryPlan:
+        """
+        Runs a query like `query()` and returns its plan: the chosen indices, the properties filtered locally, and
+        the estimated and actual number of rows.
+
+        >>> print(await MyRecord.explain(property1='value1', property2='value2'))
+        """
+        plan = plan_query(cls.__name__, cls.get_indices(), kwargs)
+        async for _ in cls._execute(plan):
+            pass
+        return plan
+
+    @classmethod
+    async def _execute(cls: Type[T],
+                       plan: QueryPlan,
+                       page_size: int = DEFAULT_PAGE_SIZE,
+                       max_pages_in_flight: int = DEFAULT_MAX_PAGES_IN_FLIGHT) -> AsyncIterator[T]:
+        post_filter = plan.post_filter()
+        record_filter = plan.record_filter()
+        plan.fetched_rows = 0
+        plan.actual_rows = 0
+
+        def count_fetched(post: Dict[str, Any]) -> bool:
+            plan.fetched_rows += 1
+            return post_filter is None or post_filter(post)
+
+        async for record in iter_records(cls, plan.hashes, page_size=page_size,
+                                         max_pages_in_flight=max_pages_in_flight, post_filter=count_fetched):
+            if record_filter is None or record_filter(record):
+                plan.actual_rows += 1
+                yield record
+
+    @classmethod
+    async def query_range(cls: Type[T],
+                          field: str,
+                          lo: Any = None,
+                          hi: Any = None,
+                          limit: int = None,
+                          reverse: bool = False) -> List[T]:
+        """
+        Queries the records whose property `field` lies between `lo` and `hi` (both inclusive), ordered by that
+        property. Requires a RangeIndex on the property, otherwise an IndexError is raised.
+
+        >>> RangeIndex(MyRecord, 'timestamp')
+        >>> MyRecord.query_range('timestamp', lo=start, hi=end)
+
+        :param field: The indexed property.
+        :param lo: The lowest value to include. If None, the range is open downwards.
+        :param hi: The highest value to include. If None, the range is open upwards.
+        :param limit: The maximum number of records to return.
+        :param reverse: Whether to return the records with the highest values first.
+        """
+        return [record async for record in cls.iter_query_range(field, lo, hi, limit=limit, reverse=reverse)]
+
+    @classmethod
+    def iter_query_range(cls: Type[T],
+                         field: str,
+                         lo: Any = None,
+                         hi: Any = None,
+                         limit: int = None,
+                         reverse: bool = False,
+                         page_size: int = DEFAULT_PAGE_SIZE,
+                         max_pages_in_flight: int = DEFAULT_MAX_PAGES_IN_FLIGHT) -> AsyncIterator[T]:
+        """
+        Same as `query_range()`, but iterates over the matching records page by page.
+        :param page_size: Number of objects to fetch per request.
+        :param max_pages_in_flight: Maximum number of pages being fetched or buffered at the same time.
+        """
+        index = cls.__indices.get(cls.__name__ + '.' + field)
+        if not isinstance(index, RangeIndex):
+            raise IndexError(f'No range index {cls.__name__}.{field} found.')
+        hashes = list(index.range(lo, hi, limit=limit, reverse=reverse))
+        return iter_records(cls, hashes, page_size=page_size, max_pages_in_flight=max_pages_in_flight)
+
+    @classmethod
+    def watch(cls: Type[T], cursor: 'FeedCursor' = None, **kwargs) -> 'ChangeFeed[T]':
+        """
+        Subscribes to the new posts, amends and forgets of objects of given type, which are applied to its indices and
+        the cache as they arrive. See `ChangeFeed` for the options.
+
+        >>> async for change in Book.watch():
+        ...     print(change.kind, change.record)
+
+        :param cursor: The `cursor` of a previous feed, to resume after the last change it handed out.
+        """
+        from src.aars.feed import ChangeFeed
+        return ChangeFeed(cls, cursor=cursor, **kwargs)
+
+    @classmethod
+    def bind(cls: Type[T], client: AlephClient) -> None:
+        """
+        Binds this record type and its subclasses to a client, which is then used to post, amend, forget and fetch
+        them, with the client's account and channel.
+        """
+        _clients[cls] = client
 
     @classmethod
     def add_index(cls: Type[T], index: 'Index') -> None:
@@ -206,18 +469,167 @@ class Record(BaseModel, ABC):
         return [index for index in cls.__indices.values() if index.datatype == cls]
 
 
+@dataclass
+class WriteResult:
+    """Outcome of writing a single record with `Record.create_many()` or `Record.upsert_many()`."""
+    record: Optional[Record]
+    error: Optional[Exception] = None
+    attempts: int = 1
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+async def _write_with_retries(obj: T, retries: int) -> WriteResult:
+    try:
+        _, attempts = await retry(lambda: post_or_amend_object(obj), retries=retries, should_retry=is_transient)
+    except Exception as error:
+        return WriteResult(record=obj, error=error, attempts=getattr(error, 'attempts', 1))
+    return WriteResult(record=obj, attempts=attempts)
+
+
+def _index_written(results: List[WriteResult]) -> None:
+    # by the type of each record, as the items of `Record.upsert_many()` may be of different subclasses
+    written: Dict[Type[Record], List[Record]] = {}
+    for result in results:
+        if result.ok:
+            written.setdefault(type(result.record), []).append(result.record)
+    for datatype, records in written.items():
+        for index in datatype.get_indices():
+            index.add_many(records)
+
+
+class Ref(str):
+    """
+    Reference to another record, which is stored as the item_hash of the record only, instead of its whole content.
+
+    >>> class Library(Record):
+    ...     name: str
+    ...     books: List[Ref[Book]]
+
+    >>> library = await Library.create(name='Babel', books=[book])
+    >>> (await library.books[0].fetch()).title
+
+    References are resolved lazily with `fetch()`, or for many records at once with `resolve_refs()` or the `resolve`
+    argument of `get()`, `fetch_all()` and `iter_all()`, which fetch all referenced records of a type together.
+    """
+    datatype: ClassVar[Optional[Type[Record]]] = None
+    __types: ClassVar[Dict[type, Type['Ref']]] = {}
+
+    def __new__(cls, item_hash: str, record: Record = None):
+        ref = super(Ref, cls).__new__(cls, item_hash)
+        ref._record = record
+        return ref
+
+    def __class_getitem__(cls, datatype: Type[Record]) -> Type['Ref']:
+        if datatype not in cls.__types:
+            cls.__types[datatype] = type(f'Ref[{datatype.__name__}]', (cls,), {'datatype': datatype})
+        return cls.__types[datatype]
+
+    def __repr__(self):
+        return f'{type(self).__name__}({str(self)})'
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value: Any) -> 'Ref':
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, Record):
+            if cls.datatype is not None and not isinstance(value, cls.datatype):
+                raise TypeError(f'{type(value).__name__} is not a {cls.datatype.__name__}')
+            if value.item_hash is None:
+                raise ValueError(f'{value!r} needs to be posted before it can be referenced')
+            return cls(value.item_hash, value)
+        if isinstance(value, str):
+            return cls(value, value._record if isinstance(value, Ref) else None)
+        raise TypeError(f'{cls.__name__} expects a record or an item_hash')
+
+    @property
+    def item_hash(self) -> str:
+        return str(self)
+
+    @property
+    def resolved(self) -> bool:
+        return self._record is not None
+
+    @property
+    def record(self) -> Record:
+        """
+        The referenced record, if it has been resolved.
+        """
+        if self._record is None:
+            raise RefNotResolvedError(self)
+        return self._record
+
+    async def fetch(self) -> Optional[Record]:
+        """
+        Fetches the referenced record, unless it has been resolved before.
+        :return: The record, or None if it does not exist (anymore).
+        """
+        if self._record is None:
+            assert self.datatype is not None, 'Only references of a known type, like Ref[Book], can be fetched'
+            records = await self.datatype.get(str(self))
+            self._record = records[0] if records else None
+        return self._record
+
+
+class IndexSnapshotChunk(Record):
+    """A part of the entries of a published index snapshot, as [key, [item_hashes]] pairs."""
+    index: str
+    entries: List[List[Any]]
+
+
+class IndexSnapshot(Record):
+    """
+    A published snapshot of an index, which clients load with `Index.bootstrap()` instead of scanning all records.
+    All posts up to `high_water_mark` are reflected in its entries, which are posted in chunks.
+    """
+    index: str
+    format_version: int = SNAPSHOT_FORMAT_VERSION
+    high_water_mark: float
+    entries: int
+    chunks: List[Ref[IndexSnapshotChunk]]
+
+    @classmethod
+    async def latest(cls, index: str, channel: str = None, owner: str = None) -> Optional['IndexSnapshot']:
+        """
+        Fetches the latest snapshot of the index with given name, e.g. 'Book.title'.
+        :param owner: Address of the publisher of the snapshot. It should be given, as anyone can publish snapshots.
+        """
+        latest = None
+        async for snapshot in iter_records(cls, channel=channel, owner=owner,
+                                           post_filter=lambda post: post['content'].get('index') == index):
+            if snapshot.format_version == SNAPSHOT_FORMAT_VERSION and \
+                    (latest is None or snapshot.high_water_mark > latest.high_water_mark):
+                latest = snapshot
+        return latest
+
+
 class Index(Record):
     """
     Class to define Indices.
+
+    An index maps each key (the value of the indexed property, or a tuple of values for multiple properties) to the
+    item_hashes of all records with that key. If a persistent store is set, the index is loaded from it when created
+    and every change is written through to it.
     """
     datatype: Type[T]
     index_on: List[str]
-    hashmap: Dict[Union[str, Tuple], str] = {}
+    hashmap: Dict[Union[str, Tuple], Set[str]] = {}
+    keys_by_hash: Dict[str, Union[str, Tuple]] = {}
+    # time of the newest post which is known to be reflected in the index, if any
+    high_water_mark: Optional[float] = None
 
     def __init__(self, datatype: Type[T], on: Union[str, List[str], Tuple[str]]):
         if isinstance(on, str):
             on = [on]
         super(Index, self).__init__(datatype=datatype, index_on=sorted(on))
+        if _store is not None:
+            self._insert([(self._parse_key(key), item_hash) for key, item_hash in _store.get_index_entries(repr(self))])
         datatype.add_index(self)
 
     def __str__(self):
@@ -226,88 +638,655 @@ class Index(Record):
     def __repr__(self):
         return f"{self.datatype.__name__}.{'.'.join(self.index_on)}"
 
+    @traced('Index.fetch')
     async def fetch(self, keys: Union[OrderedDict, List[OrderedDict]] = None) -> List[Record]:
         """
         Fetches records with given hash(es) from the index.
         """
-        hashes: Set[str]
+        return await fetch_records(self.datatype, list(self.lookup(keys)))
+
+    def lookup(self, keys: Union[OrderedDict, List[OrderedDict]] = None) -> Set[str]:
+        """
+        Looks up the item_hashes of the records with given key(s), without fetching them.
+        """
         if keys is None:
-            hashes = set(self.hashmap.values())
-        elif isinstance(keys, OrderedDict):
-            if len(keys.values()) == 1:
-                hashes = {self.hashmap.get(list(keys.values())[0])}
-            else:
-                hashes = set([self.hashmap.get(tuple(keys.values())), ])
-        elif isinstance(keys, List):
-            hashes = set([self.hashmap.get(tuple(key.values())) for key in keys])
-        else:
-            hashes = set()
+            return set(self.keys_by_hash.keys())
+        if isinstance(keys, OrderedDict):
+            keys = [keys]
+        if not isinstance(keys, List):
+            return set()
+        hashes: Set[str] = set()
+        for key in keys:
+            values = tuple(key.values())
+            hashes.update(self.hashmap.get(values[0] if len(values) == 1 else values, ()))
+        return hashes
+
+    def statistics(self) -> Dict[str, float]:
+        """
+        Returns the cardinality statistics of the index: the number of distinct keys, the number of indexed records and
+        the average number of records per key.
+        """
+        keys = len(self.hashmap)
+        entries = len(self.keys_by_hash)
+        return {'keys': keys, 'entries': entries, 'rows_per_key': entries / keys if keys else 0.0}
 
-        return await fetch_records(self.datatype, list(hashes))
+    def key_of(self, obj: T) -> Union[str, Tuple]:
+        return attrgetter(*self.index_on)(obj)
 
-    def get(self, obj):
-        return self.hashmap.get(attrgetter(*self.index_on)(obj))
+    def get(self, obj: T) -> Set[str]:
+        return set(self.hashmap.get(self.key_of(obj), ()))
 
     def add(self, obj: T):
-        assert isinstance(obj, Record)
-        self.hashmap[attrgetter(*self.index_on)(obj)] = obj.item_hash
+        """
+        Adds a record to the index. If the record was indexed under another key before, e.g. because an indexed
+        property was amended, the old entry is removed.
+        """
+        self.add_many([obj])
+
+    def add_many(self, objs: List[T]):
+        """
+        Adds multiple records to the index at once.
+        """
+        entries = []
+        for obj in objs:
+            assert isinstance(obj, Record)
+            entries.append((self.key_of(obj), obj.item_hash))
+        stale = [(self.keys_by_hash[item_hash], item_hash) for key, item_hash in entries
+                 if item_hash in self.keys_by_hash and self.keys_by_hash[item_hash] != key]
+        self._delete(stale)
+        self._insert(entries)
+        if _store is not None:
+            _store.delete_index_entries(repr(self), stale)
+            _store.put_index_entries(repr(self), entries)
 
+    def remove(self, obj: T):
+        """
+        Removes a record from the index.
+        """
+        self.discard([obj.item_hash])
 
+    def discard(self, item_hashes: Iterable[str]):
+        """
+        Removes the records with given item_hashes from the index, if they are indexed.
+        """
+        entries = [(self.keys_by_hash[item_hash], item_hash) for item_hash in item_hashes
+                   if item_hash in self.keys_by_hash]
+        if entries:
+            self._delete(entries)
+            if _store is not None:
+                _store.delete_index_entries(repr(self), entries)
+
+    async def rebuild(self, page_size: int = DEFAULT_PAGE_SIZE):
+        """
+        Rebuilds the whole index from a single paginated scan over all records of the indexed type. Only the latest
+        revision of each record is indexed.
+        """
+        started = time.time()
+        entries = {}
+        async for record in iter_records(self.datatype, page_size=page_size):
+            if record.current_revision == len(record.revision_hashes) - 1:
+                entries[record.item_hash] = self.key_of(record)
+        if _store is not None:
+            _store.delete_index_entries(repr(self), self.entries())
+        self._reset()
+        self._insert([(key, item_hash) for item_hash, key in entries.items()])
+        if _store is not None:
+            _store.put_index_entries(repr(self), self.entries())
+        self.high_water_mark = started
+
+    async def catch_up(self, page_size: int = DEFAULT_PAGE_SIZE) -> int:
+        """
+        Applies the posts, amends and forgets since the high-water mark of the index, and advances it. Without a
+        high-water mark, the index is rebuilt instead.
+        :return: Number of replayed messages.
+        """
+        if self.high_water_mark is None:
+            await self.rebuild(page_size=page_size)
+            return 0
+        client = get_client(self.datatype)
+        since = self.high_water_mark - HIGH_WATER_MARK_MARGIN
+        posts = []
+        page = 1
+        while True:
+            resp = await client.get_posts(types=[self.datatype.__name__], channels=[client.channel],
+                                          start_date=since, pagination=page_size, page=page)
+            posts += resp['posts']
+            if _is_last_page(resp, page, page_size):
+                break
+            page += 1
+        forgets = []
+        page = 1
+        while True:
+            resp = await client.get_messages(message_types=['FORGET'], channels=[client.channel], start_date=since,
+                                             pagination=page_size, page=page)
+            forgets += resp['messages']
+            if _is_last_page(resp, page, page_size, 'messages'):
+                break
+            page += 1
+        # oldest first, so that the latest amend of a record wins
+        posts.sort(key=itemgetter('time'))
+        self.add_many([self.datatype.from_post_and_revisions(post, [post['item_hash']] if post.get('ref') else [])
+                       for post in posts])
+        self.discard([item_hash for message in forgets for item_hash in message['content'].get('hashes', [])])
+        self.high_water_mark = max([self.high_water_mark] + [item['time'] for item in posts + forgets])
+        return len(posts) + len(forgets)
+
+    async def publish_snapshot(self, chunk_size: int = DEFAULT_SNAPSHOT_CHUNK_SIZE) -> IndexSnapshot:
+        """
+        Publishes a snapshot of the index, in chunks of at most `chunk_size` entries, for other clients to bootstrap
+        from. The index is caught up with the newest posts first.
+        """
+        await self.catch_up()
+        entries = sorted(self.entries(), key=lambda entry: (repr(entry[0]), entry[1]))
+        chunks_content = []
+        for chunk in chunks(entries, chunk_size):
+            grouped: Dict[Any, List[str]] = OrderedDict()
+            for key, item_hash in chunk:
+                grouped.setdefault(key, []).append(item_hash)
+            chunks_content.append({'index': repr(self),
+                                   'entries': [[list(key) if isinstance(key, tuple) else key, hashes]
+                                               for key, hashes in grouped.items()]})
+        results = await IndexSnapshotChunk.create_many(chunks_content)
+        failed = [result.error for result in results if not result.ok]
+        if failed:
+            raise failed[0]
+        return await IndexSnapshot.create(index=repr(self), high_water_mark=self.high_water_mark,
+                                          entries=len(entries), chunks=[result.record for result in results])
+
+    async def publish_every(self, interval: float, chunk_size: int = DEFAULT_SNAPSHOT_CHUNK_SIZE):
+        """
+        Publishes a snapshot every `interval` seconds, until the task running it is cancelled.
+
+        >>> task = asyncio.ensure_future(index.publish_every(3600))
+        """
+        while True:
+            await self.publish_snapshot(chunk_size=chunk_size)
+            await asyncio.sleep(interval)
+
+    async def bootstrap(self, snapshot: Union[IndexSnapshot, str] = None, owner: str = None) -> int:
+        """
+        Loads a published snapshot into the index and replays only the posts after its high-water mark. Without a
+        snapshot, the whole index is rebuilt.
+        :param snapshot: The snapshot or its item_hash, e.g. from `DatabaseSchema.snapshots`. If None, the latest
+        snapshot of the index published by `owner` is used.
+        :param owner: Address of the publisher of the snapshot, if `snapshot` is None.
+        :return: Number of replayed messages.
+        """
+        if snapshot is None:
+            snapshot = await IndexSnapshot.latest(repr(self), owner=owner)
+        elif isinstance(snapshot, str):
+            snapshot = next(iter(await IndexSnapshot.get(snapshot)), None)
+        if snapshot is None:
+            await self.rebuild()
+            return 0
+        if snapshot.index != repr(self):
+            raise ValueError(f'Snapshot of {snapshot.index} cannot be loaded into {repr(self)}')
+        await resolve_refs([snapshot])
+        if _store is not None:
+            _store.delete_index_entries(repr(self), self.entries())
+        self.load_snapshot({'index': snapshot.index,
+                            'entries': [entry for chunk in snapshot.chunks for entry in chunk.record.entries]})
+        if _store is not None:
+            _store.put_index_entries(repr(self), self.entries())
+        self.high_water_mark = snapshot.high_water_mark
+        return await self.catch_up()
+
+    def entries(self) -> List[Tuple[Union[str, Tuple], str]]:
+        return [(key, item_hash) for item_hash, key in self.keys_by_hash.items()]
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Returns a JSON-serializable snapshot of the index, which can be loaded with `load_snapshot()`.
+        """
+        return json.loads(json.dumps({
+            'index': repr(self),
+            'entries': [[list(key) if isinstance(key, tuple) else key, sorted(hashes)]
+                        for key, hashes in self.hashmap.items()],
+        }, default=pydantic_encoder))
+
+    def load_snapshot(self, snapshot: Dict[str, Any]):
+        """
+        Replaces the entries of the index with those of a snapshot created by `snapshot()`.
+        """
+        if snapshot['index'] != repr(self):
+            raise ValueError(f"Snapshot of {snapshot['index']} cannot be loaded into {repr(self)}")
+        self._reset()
+        self._insert([(self._parse_key(tuple(key) if isinstance(key, list) else key), item_hash)
+                      for key, hashes in snapshot['entries'] for item_hash in hashes])
+
+    def _parse_key(self, key: Any) -> Union[str, Tuple]:
+        """Restores a key loaded from its serialized form, e.g. a datetime from its ISO 8601 string."""
+        if isinstance(key, tuple):
+            return tuple(self._parse_value(name, value) for name, value in zip(self.index_on, key))
+        return self._parse_value(self.index_on[0], key)
+
+    def _parse_value(self, name: str, value: Any) -> Any:
+        if value is None:
+            return value
+        parsed, errors = self.datatype.__fields__[name].validate(value, {}, loc=name)
+        return value if errors else parsed
+
+    def _reset(self):
+        self.hashmap = {}
+        self.keys_by_hash = {}
+
+    def _insert(self, entries: List[Tuple[Union[str, Tuple], str]]):
+        for key, item_hash in entries:
+            self.hashmap.setdefault(key, set()).add(item_hash)
+            self.keys_by_hash[item_hash] = key
+
+    def _delete(self, entries: List[Tuple[Union[str, Tuple], str]]):
+        for key, item_hash in entries:
+            hashes = self.hashmap.get(key)
+            if hashes is not None:
+                hashes.discard(item_hash)
+                if not hashes:
+                    del self.hashmap[key]
+            if self.keys_by_hash.get(item_hash) == key:
+                del self.keys_by_hash[item_hash]
+
+
+class RangeIndex(Index):
+    """
+    Index on a single ordered property, e.g. a number or datetime, which additionally keeps its entries sorted by
+    key. Besides exact matches, it answers range queries through `Record.query_range()`:
+
+    >>> RangeIndex(MyRecord, 'timestamp')
+    >>> MyRecord.query_range('timestamp', lo=start, hi=end, limit=100)
+
+    Records whose indexed property is None are only available for exact matches.
+    """
+    sorted_entries: List[Tuple[Any, str]] = []
+
+    def __init__(self, datatype: Type[T], on: str):
+        assert isinstance(on, str), 'A RangeIndex can only be defined on a single property'
+        super(RangeIndex, self).__init__(datatype, on)
+
+    def __str__(self):
+        return f"RangeIndex({self.datatype.__name__}.{self.index_on[0]})"
+
+    def range(self, lo: Any = None, hi: Any = None, limit: int = None, reverse: bool = False) -> Iterator[str]:
+        """
+        Iterates over the item_hashes of the records whose key lies between `lo` and `hi` (both inclusive), ordered by
+        key. Bounds that are None are open.
+        :param lo: The lowest key to include.
+        :param hi: The highest key to include.
+        :param limit: The maximum number of item_hashes to return.
+        :param reverse: Whether to iterate from the highest key downwards.
+        """
+        start = 0 if lo is None else bisect_left(self.sorted_entries, (lo,))
+        # a one-element tuple sorts before all entries with the same key, so the next key is bisected
+        stop = len(self.sorted_entries) if hi is None else bisect_right(self.sorted_entries, (hi, MAX_HASH))
+        positions = range(stop - 1, start - 1, -1) if reverse else range(start, stop)
+        if limit is not None:
+            positions = positions[:limit]
+        return (self.sorted_entries[i][1] for i in positions)
+
+    def _reset(self):
+        super(RangeIndex, self)._reset()
+        self.sorted_entries = []
+
+    def _insert(self, entries: List[Tuple[Any, str]]):
+        # the hashmap tells which entries are indexed already, before it is updated
+        new = {entry for entry in entries if entry[0] is not None and entry[1] not in self.hashmap.get(entry[0], ())}
+        super(RangeIndex, self)._insert(entries)
+        if len(new) > RANGE_INDEX_MERGE_THRESHOLD:
+            # both parts are sorted, so sorting their concatenation merges them in linear time
+            self.sorted_entries = self.sorted_entries + sorted(new)
+            self.sorted_entries.sort()
+        else:
+            for entry in new:
+                insort(self.sorted_entries, entry)
+
+    def _delete(self, entries: List[Tuple[Any, str]]):
+        stale = {entry for entry in entries if entry[0] is not None and entry[1] in self.hashmap.get(entry[0], ())}
+        super(RangeIndex, self)._delete(entries)
+        if len(stale) > RANGE_INDEX_MERGE_THRESHOLD:
+            self.sorted_entries = [entry for entry in self.sorted_entries if entry not in stale]
+        else:
+            for entry in stale:
+                i = bisect_left(self.sorted_entries, entry)
+                if i < len(self.sorted_entries) and self.sorted_entries[i] == entry:
+                    del self.sorted_entries[i]
+
+
+def get_client(datatype: Type[T] = None) -> AlephClient:
+    """
+    Returns the client bound to given record type or one of its base classes, or the default client, which posts
+    to the TEST channel with the fallback account.
+    """
+    global _default_client
+    for klass in getattr(datatype, '__mro__', ()):
+        if klass in _clients:
+            return _clients[klass]
+    if _default_client is None:
+        _default_client = AlephClient(account=get_fallback_account(), channel=AARS_TEST_CHANNEL)
+    return _default_client
+
+
+def set_default_client(client: Optional[AlephClient]) -> None:
+    """
+    Sets the client used by all record types that are not bound to another one.
+    """
+    global _default_client
+    _default_client = client
+
+
+def set_cache(cache: Optional[Cache]) -> None:
+    """
+    Sets the cache used to look up posts and revisions before requesting them from Aleph. Caching is disabled
+    with `set_cache(None)`.
+
+    >>> set_cache(RecordCache(max_entries=1000, revisions_ttl=1.0))
+    """
+    global _cache
+    _cache = cache
+
+
+def get_cache() -> Optional[Cache]:
+    return _cache
+
+
+def set_trusted_reads(enabled: bool) -> None:
+    """
+    Enables or disables trusted reads. Fetched posts are then turned into records without validating the values of
+    immutable JSON types again, which is considerably faster for large records. Only enable it if all posts of the
+    record types were written by records of the same version, e.g. on a channel only your application writes to.
+    """
+    global _trusted_reads
+    _trusted_reads = enabled
+
+
+def set_coalescing(delay: Optional[float]) -> None:
+    """
+    Sets for how many seconds concurrent fetches of records and revisions by item_hash are collected, e.g. by
+    `Record.get()` or `Index.fetch()`, before they are fetched together. Identical concurrent fetches share one
+    request. With 0, the default, the fetches made within the same iteration of the event loop are collected.
+    None disables coalescing.
+    """
+    global _coalescing_delay
+    _coalescing_delay = delay
+    _loaders.clear()
+
+
+def _loader(datatype: Type[T], kind: str) -> BatchLoader:
+    loaders = _loaders.setdefault(asyncio.get_running_loop(), {})
+    loader = loaders.get((datatype, kind))
+    if loader is None:
+        if kind == 'posts':
+            batch = lambda item_hashes: _fetch_posts_remote(datatype, item_hashes)
+        else:
+            batch = lambda refs: _fetch_revisions_remote(datatype, refs)
+        loader = loaders[(datatype, kind)] = BatchLoader(batch, max_batch_size=DEFAULT_PAGE_SIZE,
+                                                         delay=_coalescing_delay)
+    return loader
+
+
+def set_store(store: Optional[PostStore]) -> None:
+    """
+    Sets the persistent store which `fetch_records` reads through, after looking into the cache. Scans over all posts
+    of a type are served from the store, after fetching the posts that are newer than the last scan.
+
+    >>> set_store(PostStore('aars.db'))
+    """
+    global _store
+    _store = store
+
+
+def get_store() -> Optional[PostStore]:
+    return _store
+
+
+def _tiers() -> List[Cache]:
+    return [tier for tier in (_cache, _store) if tier is not None]
+
+
+def _lookup_post(post_type: str, item_hash: str) -> Optional[Dict[str, Any]]:
+    tiers = _tiers()
+    for i, tier in enumerate(tiers):
+        post = tier.get_post(post_type, item_hash)
+        if post is not None:
+            for upper in tiers[:i]:
+                upper.put_post(post)
+            return post
+    return None
+
+
+def _lookup_revisions(post_type: str, ref: str) -> Optional[List[str]]:
+    tiers = _tiers()
+    for i, tier in enumerate(tiers):
+        revisions = tier.get_revisions(post_type, ref)
+        if revisions is not None:
+            for upper in tiers[:i]:
+                upper.put_revisions(post_type, ref, revisions)
+            return revisions
+    return None
+
+
+def _lookup_stale_revisions(post_type: str, ref: str) -> Optional[List[str]]:
+    """Returns the longest known revision chain of a record, even if it is stale, as it is a prefix of the current."""
+    known = [tier.get_revisions(post_type, ref, stale=True) for tier in _tiers()]
+    return max((revisions for revisions in known if revisions is not None), key=len, default=None)
+
+
+def _remember_posts(posts: List[Dict[str, Any]]) -> None:
+    for tier in _tiers():
+        tier.put_posts(posts)
+
+
+def _remember_revisions(post_type: str, ref: str, revisions: List[str]) -> None:
+    for tier in _tiers():
+        tier.put_revisions(post_type, ref, revisions)
+
+
+def _invalidate(post_type: str, item_hash: str) -> None:
+    for tier in _tiers():
+        tier.invalidate(post_type, item_hash)
+
+
+@traced('post_or_amend_object')
 async def post_or_amend_object(obj: T, account=None, channel=None):
     """
     Posts or amends an object to Aleph. If the object is already posted, it's list of revision hashes is updated and the
     object receives the latest revision number.
     :param obj: The object to post or amend.
-    :param account: The account to post the object with. If None, will use the fallback account.
-    :param channel: The channel to post the object to. If None, will use the TEST channel of the object.
+    :param account: The account to post the object with. If None, will use the account of the object's client.
+    :param channel: The channel to post the object to. If None, will use the channel of the object's client.
     :return: The object, as it is now on Aleph.
     """
-    if account is None:
-        account = FALLBACK_ACCOUNT
-    if channel is None:
-        channel = AARS_TEST_CHANNEL
+    if obj._projection is not None:
+        raise ValueError(f'{obj!r} was fetched with the fields {sorted(obj._projection)} only and cannot be upserted')
     name = type(obj).__name__
-    resp = await client.create_post(account, obj.content, post_type=name, channel=channel, ref=obj.item_hash)
+    resp = await get_client(type(obj)).create_post(obj.content, post_type=name, ref=obj.item_hash, account=account,
+                                                   channel=channel)
+    if obj.item_hash is not None:
+        _invalidate(name, obj.item_hash)
     if obj.item_hash is None:
         obj.item_hash = resp.item_hash
     obj.revision_hashes.append(resp.item_hash)
     obj.current_revision = len(obj.revision_hashes) - 1
 
 
-async def forget_objects(objs: List[T], account: Account = None, channel: str = None):
+@traced('forget_objects')
+async def forget_objects(objs: List[T], account: 'Account' = None, channel: str = None):
     """
     Forgets multiple objects from Aleph. All related revisions will be forgotten too.
     :param objs: The objects to forget.
-    :param account: The account to delete the object with. If None, will use the fallback account.
-    :param channel: The channel to delete the object from. If None, will use the TEST channel of the object.
+    :param account: The account to delete the object with. If None, will use the account of the objects' client.
+    :param channel: The channel to delete the object from. If None, will use the channel of the objects' client.
     """
-    if account is None:
-        account = FALLBACK_ACCOUNT
-    if channel is None:
-        channel = AARS_TEST_CHANNEL
+    if not objs:
+        return
     hashes = []
     for obj in objs:
         hashes += [obj.item_hash] + obj.revision_hashes
-    await client.forget(account, hashes, reason=None, channel=channel)
+    await get_client(type(objs[0])).forget(hashes, reason=None, account=account, channel=channel)
+    for obj in objs:
+        for item_hash in [obj.item_hash] + obj.revision_hashes:
+            _invalidate(type(obj).__name__, item_hash)
+        if _store is not None:
+            _store.delete_posts(type(obj).__name__, [obj.item_hash] + obj.revision_hashes)
+
 
+def _per_page(resp: Dict[str, Any], page_size: int) -> int:
+    # API servers cap the page size, so pages are counted in the size they returned rather than the requested one
+    return resp.get('pagination_per_page') or page_size
 
+
+def _is_last_page(resp: Dict[str, Any], page: int, page_size: int, item: str = 'posts') -> bool:
+    """Whether a paginated response of `get_posts` or `get_messages` is the last page."""
+    per_page = _per_page(resp, page_size)
+    return len(resp[item]) < per_page or page * per_page >= resp.get('pagination_total', 0)
+
+
+@traced('fetch_records')
 async def fetch_records(datatype: Type[T],
                         item_hashes: List[str] = None,
                         channel: str = None,
-                        owner: str = None) -> List[T]:
-    """Retrieves posts as objects by its aleph item_hash.
+                        owner: str = None,
+                        page_size: int = DEFAULT_PAGE_SIZE,
+                        fields: Collection[str] = None,
+                        resolve: int = 0) -> List[T]:
+    """Retrieves posts as objects by its aleph item_hash. All pages of the response are fetched.
     :param datatype: The type of the objects to retrieve.
     :param item_hashes: Aleph item_hashes of the objects to fetch.
     :param channel: Channel in which to look for it.
-    :param owner: Account that owns the object."""
+    :param owner: Account that owns the object.
+    :param page_size: Number of objects to fetch per request.
+    :param fields: Names of the fields to materialize. If None, all fields are.
+    :param resolve: Levels of references to other records to resolve, see `resolve_refs()`."""
+    return [record async for record in iter_records(datatype, item_hashes, channel, owner, page_size=page_size,
+                                                    fields=fields, resolve=resolve)]
+
+
+async def iter_records(datatype: Type[T],
+                       item_hashes: Iterable[str] = None,
+                       channel: str = None,
+                       owner: str = None,
+                       page_size: int = DEFAULT_PAGE_SIZE,
+                       max_pages_in_flight: int = DEFAULT_MAX_PAGES_IN_FLIGHT,
+                       post_filter: Callable[[Dict[str, Any]], bool] = None,
+                       fields: Collection[str] = None,
+                       resolve: int = 0) -> AsyncIterator[T]:
+    """Iterates over posts as objects, fetching them page by page. While the caller consumes a page, the following
+    pages are prefetched, so that at most `max_pages_in_flight` pages are held in memory.
+    :param datatype: The type of the objects to retrieve.
+    :param item_hashes: Aleph item_hashes of the objects to fetch. If given, they are consumed lazily and requested in
+    chunks of `page_size`, and the objects are returned in the same order.
+    :param channel: Channel in which to look for it.
+    :param owner: Account that owns the object.
+    :param page_size: Number of objects to fetch per request.
+    :param max_pages_in_flight: Maximum number of pages being fetched or buffered at the same time.
+    :param post_filter: Predicate on the raw posts. Only posts for which it is true are turned into objects.
+    :param fields: Names of the fields to materialize. If None, all fields are.
+    :param resolve: Levels of references to other records to resolve, once per page, see `resolve_refs()`."""
     assert issubclass(datatype, Record)
+    assert page_size > 0 and max_pages_in_flight > 0
     channels = None if channel is None else [channel]
     owners = None if owner is None else [owner]
     if item_hashes is None and channels is None and owners is None:
-        channels = [AARS_TEST_CHANNEL]
-    resp = await client.get_posts(hashes=item_hashes, channels=channels, types=[datatype.__name__], addresses=owners)
-    tasks = [datatype.from_post(post) for post in resp['posts']]
-    return list(await asyncio.gather(*tasks))
+        channels = [get_client(datatype).channel]
+
+    async def hydrate(posts: List[Dict[str, Any]]) -> List[T]:
+        if post_filter is not None:
+            posts = [post for post in posts if post_filter(post)]
+        records = await datatype.from_posts(posts, fields)
+        if resolve:
+            await resolve_refs(records, resolve, page_size=page_size)
+        return records
+
+    async def fetch_page(page: int, hashes: List[str] = None) -> Tuple[Dict[str, Any], List[T]]:
+        # records requested by hash are returned in the requested order
+        order = None if hashes is None else {item_hash: i for i, item_hash in enumerate(hashes)}
+        cached = []
+        if hashes is not None:
+            for item_hash in hashes:
+                post = _lookup_post(datatype.__name__, item_hash)
+                if post is not None and (channels is None or post.get('channel') in channels) \
+                        and (owners is None or post.get('address') in owners):
+                    cached.append(post)
+            if cached:
+                cached_hashes = {post['item_hash'] for post in cached}
+                hashes = [item_hash for item_hash in hashes if item_hash not in cached_hashes]
+            if not hashes:
+                cached.sort(key=lambda post: order[post['item_hash']])
+                return {'posts': []}, await hydrate(cached)
+        if hashes is not None and channels is None and owners is None and _coalescing_delay is not None:
+            resp = {'posts': list((await _loader(datatype, 'posts').load_many(hashes)).values())}
+        else:
+            resp = await get_client(datatype).get_posts(hashes=hashes, channels=channels, types=[datatype.__name__],
+                                                        addresses=owners, pagination=page_size, page=page)
+            _remember_posts(resp['posts'])
+            # a chunk of hashes which is larger than the page size cap of the server spans several pages
+            more_page = page
+            while hashes is not None and not _is_last_page(resp, more_page, page_size):
+                more_page += 1
+                more = await get_client(datatype).get_posts(hashes=hashes, channels=channels,
+                                                            types=[datatype.__name__], addresses=owners,
+                                                            pagination=page_size, page=more_page)
+                _remember_posts(more['posts'])
+                resp = {**more, 'posts': resp['posts'] + more['posts']}
+        posts = cached + resp['posts']
+        if order is not None:
+            posts.sort(key=lambda post: order.get(post['item_hash'], len(order)))
+        return resp, await hydrate(posts)
+
+    async def fetched(page: Tuple[Dict[str, Any], List[T]]) -> Tuple[Dict[str, Any], List[T]]:
+        return page
+
+    if item_hashes is None and _store is not None:
+        if not _store.offline:
+            await sync_store(datatype, channel, owner, page_size=page_size)
+        for posts in _store.iter_posts(datatype.__name__, channels, owners, page_size=page_size):
+            for record in await hydrate(posts):
+                yield record
+        return
+
+    if item_hashes is not None:
+        pages = (fetch_page(1, chunk) for chunk in chunks(item_hashes, page_size))
+    else:
+        # the first page tells how many pages there are
+        first_page = await fetch_page(1)
+        last_page = 1
+        if not _is_last_page(first_page[0], 1, page_size):
+            last_page = -(-first_page[0]['pagination_total'] // _per_page(first_page[0], page_size))
+        pages = chain([fetched(first_page)], (fetch_page(page) for page in range(2, last_page + 1)))
+
+    async for _, records in prefetch(pages, max_pages_in_flight):
+        for record in records:
+            yield record
+
+
+async def sync_store(datatype: Type[T],
+                     channel: str = None,
+                     owner: str = None,
+                     page_size: int = DEFAULT_PAGE_SIZE) -> int:
+    """Fetches all posts of given type which are newer than the last sync into the persistent store.
+    :param datatype: The type of the objects to sync.
+    :param channel: Channel in which to look for them.
+    :param owner: Account that owns the objects.
+    :param page_size: Number of posts to fetch per request.
+    :return: Number of fetched posts."""
+    assert _store is not None, 'No store set, use set_store() first'
+    channels = None if channel is None else [channel]
+    owners = None if owner is None else [owner]
+    if channels is None and owners is None:
+        channels = [get_client(datatype).channel]
+    since = _store.last_synced(datatype.__name__, channels, owners)
+    last_time = since or 0
+    count = 0
+    page = 1
+    while True:
+        resp = await get_client(datatype).get_posts(channels=channels, types=[datatype.__name__], addresses=owners,
+                                                    start_date=since, pagination=page_size, page=page)
+        _store.put_scan_page(datatype.__name__, resp['posts'], full_scan=since is None)
+        last_time = max([last_time] + [post.get('time') or 0 for post in resp['posts']])
+        count += len(resp['posts'])
+        if _is_last_page(resp, page, page_size):
+            break
+        page += 1
+    _store.mark_synced(datatype.__name__, last_time, channels, owners)
+    return count
 
 
 async def fetch_revisions(datatype: Type[T],
@@ -319,11 +1298,159 @@ async def fetch_revisions(datatype: Type[T],
     :param ref: item_hash of the object, whose revisions to fetch.
     :param channel: Channel in which to look for it.
     :param owner: Account that owns the object."""
+    return (await fetch_revisions_many(datatype, refs=[ref], channel=channel, owner=owner))[ref]
+
+
+@traced('fetch_revisions')
+async def fetch_revisions_many(datatype: Type[T],
+                               refs: List[str],
+                               channel: str = None,
+                               owner: str = None,
+                               page_size: int = DEFAULT_PAGE_SIZE,
+                               known: Dict[str, List[str]] = None) -> Dict[str, List[str]]:
+    """Retrieves the revision hashes of multiple objects with one request per page of revisions.
+
+    Revision chains only grow, so a stale chain from the cache or from `known` is a prefix of the current one. As
+    Aleph returns the newest revisions first, only the revisions newer than the last known one are fetched.
+    :param datatype: The type of the objects to retrieve.
+    :param refs: item_hashes of the objects, whose revisions to fetch.
+    :param channel: Channel in which to look for them.
+    :param owner: Account that owns the objects.
+    :param page_size: Number of revisions to fetch per request.
+    :param known: Possibly stale revision hashes of some of the objects, oldest first.
+    :return: Dictionary mapping each ref to its revision hashes, oldest first."""
+    revisions: Dict[str, List[str]] = {}
+    for ref in refs:
+        cached = _lookup_revisions(datatype.__name__, ref)
+        if cached is not None:
+            revisions[ref] = cached
+    missing = [ref for ref in refs if ref not in revisions]
+    if not missing:
+        return revisions
+    if channel is None and owner is None and known is None and _coalescing_delay is not None:
+        revisions.update(await _loader(datatype, 'revisions').load_many(missing))
+    else:
+        revisions.update(await _fetch_revisions_remote(datatype, missing, channel, owner, page_size, known))
+    return revisions
+
+
+async def _fetch_revisions_remote(datatype: Type[T],
+                                  missing: List[str],
+                                  channel: str = None,
+                                  owner: str = None,
+                                  page_size: int = DEFAULT_PAGE_SIZE,
+                                  known: Dict[str, List[str]] = None) -> Dict[str, List[str]]:
+    revisions: Dict[str, List[str]] = {}
+    prefixes: Dict[str, List[str]] = {}
+    for ref in missing:
+        prefix = max([(known or {}).get(ref) or [], _lookup_stale_revisions(datatype.__name__, ref) or []], key=len)
+        if prefix:
+            prefixes[ref] = prefix
+    # the last known revision of each ref with a prefix, until it has been seen
+    anchors = {prefix[-1]: ref for ref, prefix in prefixes.items()}
     owners = None if owner is None else [owner]
     channels = None if channel is None else [channel]
     if owners is None and channels is None:
-        channels = [AARS_TEST_CHANNEL]
-    resp = await client.get_posts(refs=[ref], channels=channels, types=[datatype.__name__], addresses=owners)
-    return list(reversed([post['item_hash'] for post in resp['posts']]))  # reverse to get the oldest first
+        channels = [get_client(datatype).channel]
+    newer: Dict[str, List[str]] = {ref: [] for ref in missing}
+    complete: Set[str] = set()
+    page = 1
+    while True:
+        resp = await get_client(datatype).get_posts(refs=missing, channels=channels, types=[datatype.__name__],
+                                                    addresses=owners, pagination=page_size, page=page)
+        for post in resp['posts']:
+            ref = post['ref']
+            if ref in complete:
+                continue
+            if anchors.get(post['item_hash']) == ref:
+                complete.add(ref)
+                continue
+            newer.setdefault(ref, []).append(post['item_hash'])
+        _remember_posts(resp['posts'])
+        if _is_last_page(resp, page, page_size):
+            break
+        if len(complete) == len(missing):
+            break
+        page += 1
+    for ref, hashes in newer.items():
+        # reverse to get the oldest first
+        revisions[ref] = (prefixes[ref] if ref in complete else []) + list(reversed(hashes))
+        _remember_revisions(datatype.__name__, ref, revisions[ref])
+    return revisions
+
+
+async def fetch_posts(datatype: Type[T],
+                      item_hashes: List[str],
+                      page_size: int = DEFAULT_PAGE_SIZE) -> Dict[str, Dict[str, Any]]:
+    """Retrieves raw posts by their item_hashes, from the cache if possible and with one request per page otherwise.
+    :param datatype: The type of the posts to retrieve.
+    :param item_hashes: Aleph item_hashes of the posts.
+    :param page_size: Number of posts to fetch per request.
+    :return: Dictionary mapping the item_hashes of all found posts to the posts."""
+    posts: Dict[str, Dict[str, Any]] = {}
+    for item_hash in item_hashes:
+        post = _lookup_post(datatype.__name__, item_hash)
+        if post is not None:
+            posts[item_hash] = post
+    missing = [item_hash for item_hash in item_hashes if item_hash not in posts]
+    if _coalescing_delay is not None:
+        posts.update(await _loader(datatype, 'posts').load_many(missing))
+    else:
+        for chunk in chunks(missing, page_size):
+            posts.update(await _fetch_posts_remote(datatype, chunk))
+    return posts
+
+
+async def _fetch_posts_remote(datatype: Type[T], item_hashes: List[str]) -> Dict[str, Dict[str, Any]]:
+    posts = {}
+    page = 1
+    while True:
+        resp = await get_client(datatype).get_posts(hashes=item_hashes, types=[datatype.__name__],
+                                                    pagination=len(item_hashes), page=page)
+        _remember_posts(resp['posts'])
+        posts.update((post['item_hash'], post) for post in resp['posts'])
+        if _is_last_page(resp, page, len(item_hashes)):
+            break
+        page += 1
+    return posts
+
+
+def _iter_refs(value: Any) -> Iterator[Ref]:
+    if isinstance(value, Ref):
+        yield value
+    elif isinstance(value, BaseModel):
+        for item in value.__dict__.values():
+            yield from _iter_refs(item)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            yield from _iter_refs(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _iter_refs(item)
+
 
+async def resolve_refs(records: Iterable[Record], depth: int = 1, page_size: int = DEFAULT_PAGE_SIZE) -> None:
+    """Resolves the references of records to other records. All unresolved references to records of the same type are
+    fetched together, no matter how many records refer to them.
+    :param records: The records whose references to resolve.
+    :param depth: How many levels of references to resolve, i.e. 2 also resolves the references of the referenced
+    records.
+    :param page_size: Number of records to fetch per request."""
+    level = list(records)
+    for _ in range(depth):
+        unresolved: Dict[Type[Record], Dict[str, List[Ref]]] = {}
+        for record in level:
+            for ref in _iter_refs(record):
+                if not ref.resolved and ref.datatype is not None:
+                    unresolved.setdefault(ref.datatype, {}).setdefault(str(ref), []).append(ref)
+        if not unresolved:
+            return
+        fetched = await asyncio.gather(*(fetch_records(datatype, list(refs), page_size=page_size)
+                                         for datatype, refs in unresolved.items()))
+        level = []
+        for refs, children in zip(unresolved.values(), fetched):
+            for child in children:
+                for ref in refs.get(child.item_hash, []):
+                    ref._record = child
+            level += children
 
@@ -41,3 +41,22 @@ class SchemaAlreadyExists(AlephError):
         self.owner = schema['owner']
         self.message = f"{message.format(self.channel, self.owner)}"
         super().__init__(self.message)
+
+
+class RefNotResolvedError(AlephError):
+    """Exception raised when the record of a reference is accessed before the reference was resolved."""
+
+    def __init__(self, ref, message="Reference '{0}' has not been resolved yet. Use fetch() or resolve_refs() first."):
+        self.item_hash = str(ref)
+        self.message = f"{message.format(self.item_hash)}"
+        super().__init__(self.message)
+
+
+class CallBudgetExceeded(AlephError):
+    """Exception raised when an operation makes more remote calls than allowed by `set_call_budget(strict=True)`."""
+    pass
+
+
+class CallBudgetWarning(UserWarning):
+    """Warning issued when an operation makes more remote calls than allowed by `set_call_budget()`."""
+    pass
@@ -0,0 +1,215 @@
+import asyncio
+import inspect
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Generic, List, Optional, Type, Union
+
+from src.aars.core import T, DEFAULT_PAGE_SIZE, fetch_revisions_many, get_client, get_store, _invalidate, \
+    _remember_posts, _remember_revisions, _is_last_page
+
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_MAX_PENDING = 100
+
+
+@dataclass(frozen=True)
+class FeedCursor:
+    """
+    Position in the change feed of a channel, to resume watching after the last applied message. Messages are ordered
+    by time, and the hashes of the applied messages with the latest time tell apart messages with the same time.
+    """
+    time: float = 0.0
+    item_hashes: FrozenSet[str] = frozenset()
+
+    def covers(self, message: Dict[str, Any]) -> bool:
+        return message['time'] < self.time or message['time'] == self.time and message['item_hash'] in self.item_hashes
+
+    def advance(self, message: Dict[str, Any]) -> 'FeedCursor':
+        if message['time'] > self.time:
+            return FeedCursor(message['time'], frozenset([message['item_hash']]))
+        return FeedCursor(self.time, self.item_hashes | {message['item_hash']})
+
+
+@dataclass
+class Change(Generic[T]):
+    """
+    A change of the records of a type, as yielded by `Record.watch()`. New records and amends carry the record as
+    it is now, forgets carry the item_hashes of the forgotten posts.
+    """
+    kind: str  # 'post', 'amend' or 'forget'
+    item_hash: str  # of the message
+    time: float
+    record: Optional[T] = None
+    forgotten: List[str] = field(default_factory=list)
+
+
+class ChangeFeed(Generic[T]):
+    """
+    Subscription to the new posts, amends and forgets of the records of a type, as returned by `Record.watch()`.
+
+    Messages are read from the message stream of the API server or, if `stream` is False or the stream fails, by
+    polling for messages since the last one. Each change is applied to the indices of the type and to the cache and
+    store before it is handed out, so that they stay fresh with O(changes) instead of O(records) work.
+
+    At most `max_pending` changes are read ahead. If the consumer is slower, reading pauses until it catches up. The
+    cursor only advances once the consumer asks for the next change, or once the callback of `run()` returned, so
+    that a feed resumed from `cursor` does not miss changes that were not processed.
+
+    >>> async with Book.watch(cursor=saved_cursor) as feed:
+    ...     async for change in feed:
+    ...         print(change.kind, change.record)
+    ...         saved_cursor = feed.cursor
+    """
+
+    def __init__(self,
+                 datatype: Type[T],
+                 cursor: FeedCursor = None,
+                 channel: str = None,
+                 stream: bool = True,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 max_pending: int = DEFAULT_MAX_PENDING,
+                 page_size: int = DEFAULT_PAGE_SIZE):
+        self.datatype = datatype
+        self.cursor = cursor or FeedCursor()
+        self.channels = [channel or get_client(datatype).channel]
+        self.stream = stream
+        self.poll_interval = poll_interval
+        self.page_size = page_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._max_pending = max_pending
+        self._reader: Optional[asyncio.Task] = None
+        self._last: Optional[Dict[str, Any]] = None
+
+    def __aiter__(self) -> 'ChangeFeed[T]':
+        return self
+
+    async def __anext__(self) -> Change[T]:
+        self._commit()
+        if self._reader is None:
+            self._queue = asyncio.Queue(self._max_pending)
+            self._reader = asyncio.ensure_future(self._read())
+        getter = asyncio.ensure_future(self._queue.get())
+        done, _ = await asyncio.wait([getter, self._reader], return_when=asyncio.FIRST_COMPLETED)
+        if getter not in done:
+            getter.cancel()
+            # the reader only stops because of an error
+            self._reader.result()
+        message = getter.result()
+        change = await self._apply(message)
+        # the cursor only moves past changes which have been handed out
+        self._last = message
+        return change
+
+    async def __aenter__(self) -> 'ChangeFeed[T]':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def run(self, callback: Callable[[Change[T]], Union[Awaitable[Any], Any]]):
+        """
+        Calls `callback` with each change, until the feed is closed. The next change is only handed out once the
+        callback returned, or the returned awaitable finished.
+        """
+        async for change in self:
+            result = callback(change)
+            if inspect.isawaitable(result):
+                await result
+
+    async def close(self):
+        self._commit()
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._reader = None
+
+    def _commit(self):
+        if self._last is not None:
+            self.cursor = self.cursor.advance(self._last)
+            self._last = None
+
+    async def _read(self):
+        position = self.cursor
+        if self.stream:
+            try:
+                async for message in get_client(self.datatype).watch_messages(channels=self.channels,
+                                                                              start_date=position.time or None):
+                    if not position.covers(message):
+                        position = position.advance(message)
+                        await self._offer(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # e.g. no websocket support, continue by polling from where the stream stopped
+                pass
+        while True:
+            for message in await self._poll(position):
+                position = position.advance(message)
+                await self._offer(message)
+            await asyncio.sleep(self.poll_interval)
+
+    async def _poll(self, position: FeedCursor) -> List[Dict[str, Any]]:
+        messages = []
+        page = 1
+        while True:
+            resp = await get_client(self.datatype).get_messages(message_types=['POST', 'FORGET'],
+                                                                channels=self.channels,
+                                                                start_date=position.time or None,
+                                                                pagination=self.page_size, page=page)
+            messages += [message for message in resp['messages'] if not position.covers(message)]
+            if _is_last_page(resp, page, self.page_size, 'messages'):
+                break
+            page += 1
+        # pages are newest first
+        return sorted(messages, key=lambda message: message['time'])
+
+    async def _offer(self, message: Dict[str, Any]):
+        if message['type'] == 'POST' and message['content'].get('type') != self.datatype.__name__:
+            return
+        if message['type'] not in ('POST', 'FORGET'):
+            return
+        # waits while the consumer is `max_pending` changes behind
+        await self._queue.put(message)
+
+    async def _apply(self, message: Dict[str, Any]) -> Change[T]:
+        name = self.datatype.__name__
+        if message['type'] == 'FORGET':
+            hashes = list(message['content'].get('hashes', []))
+            for item_hash in hashes:
+                _invalidate(name, item_hash)
+            for index in self.datatype.get_indices():
+                index.discard(hashes)
+            if get_store() is not None:
+                get_store().delete_posts(name, hashes)
+            return Change('forget', message['item_hash'], message['time'], forgotten=hashes)
+
+        content = message['content']
+        post = {
+            'item_hash': message['item_hash'],
+            'type': content['type'],
+            'ref': content.get('ref'),
+            'address': content.get('address') or message.get('sender'),
+            'channel': message.get('channel'),
+            'content': content['content'],
+            'time': message['time'],
+        }
+        _remember_posts([post])
+        ref = post['ref']
+        if ref is None:
+            _remember_revisions(name, post['item_hash'], [])
+            record = self.datatype.from_post_and_revisions(post, [])
+            kind = 'post'
+        else:
+            # only the revisions after the last known one are fetched, as revision chains only grow
+            _invalidate(name, ref)
+            revisions = (await fetch_revisions_many(self.datatype, [ref], channel=post['channel']))[ref]
+            if post['item_hash'] not in revisions:
+                # the amend may not be listed yet by the node the revisions are fetched from
+                revisions = revisions + [post['item_hash']]
+                _remember_revisions(name, ref, revisions)
+            record = self.datatype.from_post_and_revisions(post, revisions)
+            kind = 'amend'
+        for index in self.datatype.get_indices():
+            index.add(record)
+        return Change(kind, message['item_hash'], message['time'], record=record)
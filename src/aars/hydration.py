@@ -0,0 +1,108 @@
+import json
+from functools import lru_cache
+from typing import Any, Callable, Collection, Dict, FrozenSet, Optional, Type
+
+from pydantic import BaseModel, ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.fields import ModelField, SHAPE_LIST, SHAPE_SINGLETON
+
+# types whose values are immutable and can be taken over from posts or records as they are
+IMMUTABLE_TYPES = (str, int, float, bool)
+
+
+def _is_model(type_: Any) -> bool:
+    return isinstance(type_, type) and issubclass(type_, BaseModel)
+
+
+def _converter(model: Type[BaseModel], field: ModelField) -> Optional[Callable[[Any], Any]]:
+    """Returns how to convert a raw value of given field without validation, or None to take it as it is."""
+    if field.shape == SHAPE_SINGLETON and field.sub_fields is None:
+        if field.type_ in IMMUTABLE_TYPES:
+            return None
+        if _is_model(field.type_):
+            construct = trusted_constructor(field.type_)
+            return lambda value: value if value is None or isinstance(value, BaseModel) else construct(value)
+    if field.shape == SHAPE_LIST and field.sub_fields[0].sub_fields is None:
+        if field.type_ in IMMUTABLE_TYPES:
+            # copied, so that changes to the record do not change cached posts
+            return lambda value: value if value is None else list(value)
+        if _is_model(field.type_):
+            construct = trusted_constructor(field.type_)
+            return lambda value: value if value is None else [construct(item) for item in value]
+
+    # e.g. datetimes, which need to be parsed from their JSON representation
+    def validate(value: Any) -> Any:
+        value, errors = field.validate(value, {}, loc=field.alias, cls=model)
+        if errors:
+            raise ValidationError([errors] if isinstance(errors, ErrorWrapper) else errors, model)
+        return value
+
+    return validate
+
+
+@lru_cache(maxsize=None)
+def trusted_constructor(model: Type[BaseModel]) -> Callable[..., BaseModel]:
+    """
+    Returns a function which builds instances of `model` from raw data which is known to be valid, e.g. because it has
+    been written by a record of the same type. Values of immutable JSON types are not validated again, nested models
+    are built recursively, and only values of other types are validated.
+
+    The function takes the raw data and optionally the names of the fields to materialize. Other fields are left
+    unset, or set to their default.
+    """
+    converters = [(name, field.alias, field, _converter(model, field)) for name, field in model.__fields__.items()]
+
+    def construct(data: Dict[str, Any], fields: Collection[str] = None) -> BaseModel:
+        # like BaseModel.construct(), without its overhead for fields that are given
+        values = {}
+        fields_set = set()
+        for name, alias, field, convert in converters:
+            if alias in data and (fields is None or name in fields):
+                values[name] = data[alias] if convert is None else convert(data[alias])
+                fields_set.add(name)
+            elif not field.required:
+                values[name] = field.get_default()
+        obj = model.__new__(model)
+        object.__setattr__(obj, '__dict__', values)
+        object.__setattr__(obj, '__fields_set__', fields_set)
+        obj._init_private_attributes()
+        return obj
+
+    return construct
+
+
+@lru_cache(maxsize=None)
+def content_serializer(model: Type[BaseModel], exclude: FrozenSet[str]) -> Callable[[BaseModel], Dict[str, Any]]:
+    """
+    Returns a function which serializes instances of `model` to a JSON-compatible dictionary without the fields in
+    `exclude`, like `json.loads(BaseModel.json(exclude=exclude))`. Values of immutable types are copied directly, values
+    of types with a `to_content()` class method are serialized with it, and only the other fields are serialized by
+    pydantic, e.g. datetimes as ISO 8601 strings.
+    """
+    plain = set()
+    # types with their own representation in posts, e.g. arrays, which define a `to_content()` class method
+    custom = {}
+    for name, field in model.__fields__.items():
+        if field.shape == SHAPE_SINGLETON and field.sub_fields is None and field.type_ in IMMUTABLE_TYPES:
+            plain.add(name)
+        elif field.shape == SHAPE_SINGLETON and isinstance(field.type_, type) and hasattr(field.type_, 'to_content'):
+            custom[name] = field.type_.to_content
+    names = [name for name in model.__fields__ if name not in exclude]
+    others = {name for name in names if name not in plain and name not in custom}
+
+    def serialize(obj: BaseModel) -> Dict[str, Any]:
+        values = obj.__dict__
+        serialized = json.loads(obj.json(include=others)) if others else {}
+        content = {}
+        for name in names:
+            if name not in values:
+                continue
+            if name in plain:
+                content[name] = values[name]
+            elif name in custom:
+                content[name] = None if values[name] is None else custom[name](values[name])
+            else:
+                content[name] = serialized[name]
+        return content
+
+    return serialize
@@ -0,0 +1,170 @@
+import functools
+import time
+import warnings
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from src.aars.exceptions import CallBudgetExceeded, CallBudgetWarning
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# buckets of histograms that count remote calls per operation instead of seconds
+CALL_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Operation:
+    """A running span, counting the remote calls made while it is active, including those of nested spans."""
+
+    def __init__(self, name: str, parent: Optional['Operation']):
+        self.name = name
+        self.parent = parent
+        self.calls: Counter = Counter()
+
+    @property
+    def remote_calls(self) -> int:
+        return sum(self.calls.values())
+
+
+class Metrics:
+    """
+    Registry of counters and histograms, exportable in the Prometheus text format.
+
+    Hooks added with `add_hook()` are called at the end of each span with its name, duration in seconds and the remote
+    calls made during it, by method.
+    """
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.hooks: List[Callable[[str, float, Dict[str, int]], None]] = []
+        self.call_budget: Optional[int] = None
+        self.strict_call_budget = False
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def add_hook(self, hook: Callable[[str, float, Dict[str, int]], None]):
+        self.hooks.append(hook)
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f'# TYPE {name} counter')
+            for (counter, labels), value in sorted(self.counters.items()):
+                if counter == name:
+                    lines.append(f'{name}{_format_labels(labels)} {value:g}')
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f'# TYPE {name} histogram')
+            for (histogram_name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {histogram.sum:g}')
+                lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+metrics = Metrics()
+_operation: ContextVar[Optional[Operation]] = ContextVar('aars_operation', default=None)
+
+
+def set_call_budget(max_calls: Optional[int], strict: bool = False):
+    """
+    Debug mode which flags operations that make more than `max_calls` remote calls, typically because of an N+1
+    pattern. A CallBudgetWarning is issued, or a CallBudgetExceeded error raised if `strict` is set. The budget
+    applies to the outermost span, e.g. a whole `Record.query()`. It is disabled with `set_call_budget(None)`.
+    """
+    metrics.call_budget = max_calls
+    metrics.strict_call_budget = strict
+
+
+@contextmanager
+def span(name: str) -> Iterator[Operation]:
+    """
+    Times a block as operation `name` and counts the remote calls made in it, including in tasks it starts.
+    """
+    parent = _operation.get()
+    operation = Operation(name, parent)
+    token = _operation.set(operation)
+    start = time.perf_counter()
+    try:
+        yield operation
+    finally:
+        duration = time.perf_counter() - start
+        _operation.reset(token)
+        metrics.inc('aars_operations_total', operation=name)
+        metrics.observe('aars_operation_seconds', duration, operation=name)
+        metrics.observe('aars_operation_remote_calls', operation.remote_calls, buckets=CALL_BUCKETS, operation=name)
+        for hook in metrics.hooks:
+            hook(name, duration, dict(operation.calls))
+        if parent is None and metrics.call_budget is not None and operation.remote_calls > metrics.call_budget:
+            message = (f'{name} made {operation.remote_calls} remote calls ({dict(operation.calls)}), '
+                       f'exceeding the budget of {metrics.call_budget}. Is there an N+1 pattern?')
+            if metrics.strict_call_budget:
+                raise CallBudgetExceeded(message)
+            warnings.warn(message, CallBudgetWarning)
+
+
+def traced(name: str):
+    """Decorates a coroutine function to run it in a `span()` named `name`."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_remote_call(method: str, duration: float, error: bool = False):
+    """Counts a remote call to Aleph towards the metrics and all running spans."""
+    metrics.inc('aars_remote_calls_total', method=method)
+    if error:
+        metrics.inc('aars_remote_call_errors_total', method=method)
+    metrics.observe('aars_remote_call_seconds', duration, method=method)
+    operation = _operation.get()
+    while operation is not None:
+        operation.calls[method] += 1
+        operation = operation.parent
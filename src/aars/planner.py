@@ -0,0 +1,101 @@
+import warnings
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from pydantic import BaseModel
+
+# values that compare equal to their JSON representation, so they can be checked against raw post content
+JSON_NATIVE = (str, int, float, bool, type(None))
+
+
+class QueryPlan(BaseModel):
+    """
+    The plan chosen for a query by `plan_query()`, as returned by `Record.explain()`.
+
+    The item_hashes of all used indices are intersected before any record is fetched, and the properties that are
+    not covered by an index are checked on the raw posts before records are constructed from them.
+    """
+    datatype: str
+    filters: Dict[str, Any]
+    indices: List[str] = []
+    index_rows: Dict[str, int] = {}
+    index_statistics: Dict[str, Dict[str, float]] = {}
+    residual: List[str] = []
+    estimated_rows: int = 0
+    fetched_rows: Optional[int] = None
+    actual_rows: Optional[int] = None
+    hashes: Set[str] = set()
+
+    def __str__(self):
+        lines = [f"Query {self.datatype} where {', '.join(f'{key}={value!r}' for key, value in self.filters.items())}"]
+        for name in self.indices:
+            statistics = ', '.join(f'{key}={value:g}' for key, value in self.index_statistics.get(name, {}).items())
+            lines.append(f'  lookup index {name}: {self.index_rows[name]} rows ({statistics})')
+        if len(self.indices) > 1:
+            lines.append(f'  intersect: {len(self.hashes)} rows')
+        if self.residual:
+            lines.append(f"  filter {', '.join(self.residual)} before hydration")
+        lines.append(f'  estimated rows: {self.estimated_rows}')
+        if self.fetched_rows is not None:
+            lines.append(f'  fetched rows: {self.fetched_rows}')
+        if self.actual_rows is not None:
+            lines.append(f'  actual rows: {self.actual_rows}')
+        return '\n'.join(lines)
+
+    def post_filter(self) -> Optional[Callable[[Dict[str, Any]], bool]]:
+        """Returns a predicate on raw posts for the residual properties with JSON-native values, if there are any."""
+        checks = {key: self.filters[key] for key in self.residual if isinstance(self.filters[key], JSON_NATIVE)}
+        if not checks:
+            return None
+        return lambda post: all(post['content'].get(key) == value for key, value in checks.items())
+
+    def record_filter(self) -> Optional[Callable[[Any], bool]]:
+        """Returns a predicate on records for the residual properties with other values, e.g. datetimes."""
+        checks = {key: self.filters[key] for key in self.residual if not isinstance(self.filters[key], JSON_NATIVE)}
+        if not checks:
+            return None
+        return lambda record: all(getattr(record, key, None) == value for key, value in checks.items())
+
+
+def plan_query(datatype_name: str, indices: List[Any], filters: Dict[str, Any]) -> QueryPlan:
+    """
+    Chooses the indices to answer a query with. Applicable are all indices whose properties are a subset of the
+    queried properties. Starting with the most selective one, the item_hashes of each index that covers a not yet
+    covered property are intersected. The remaining properties are filtered locally.
+    :param datatype_name: Name of the queried record type.
+    :param indices: The indices defined on the record type.
+    :param filters: The queried properties and their values.
+    """
+    filters = OrderedDict(sorted(filters.items()))
+    plan = QueryPlan(datatype=datatype_name, filters=filters)
+    candidates = []
+    for index in indices:
+        if not set(index.index_on).issubset(filters.keys()):
+            continue
+        hashes = index.lookup(OrderedDict((key, filters[key]) for key in index.index_on))
+        candidates.append((len(hashes), repr(index), index, hashes))
+    if not candidates:
+        raise IndexError(f"No index {datatype_name}.{'.'.join(filters.keys())} found.")
+
+    covered: Set[str] = set()
+    hashes: Optional[Set[str]] = None
+    # most selective first, preferring indices that cover more properties
+    candidates.sort(key=lambda candidate: (candidate[0], -len(candidate[2].index_on), candidate[1]))
+    for rows, name, index, index_hashes in candidates:
+        if covered.issuperset(index.index_on):
+            continue
+        covered.update(index.index_on)
+        plan.indices.append(name)
+        plan.index_rows[name] = rows
+        plan.index_statistics[name] = index.statistics()
+        hashes = index_hashes if hashes is None else hashes & index_hashes
+        if not hashes:
+            break
+
+    plan.hashes = hashes
+    plan.residual = [key for key in filters.keys() if key not in covered]
+    plan.estimated_rows = len(hashes)
+    if len(plan.indices) > 1 or plan.residual:
+        warnings.warn(f"No index {datatype_name}.{'.'.join(filters.keys())} found. "
+                      f"Using {', '.join(plan.indices)} instead.")
+    return plan
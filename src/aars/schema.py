@@ -1,12 +1,15 @@
-from typing import Type, Set
+from typing import Type, List, Dict, Union
 
-from src.aars import Record, fetch_records, Index
+from src.aars import Record, fetch_records, Index, IndexSnapshot, Ref, T
 
 
 class DatabaseSchema(Record):
     channel: str
     owner: str
-    types: Set[Type[Record]]
+    # names of the record types, as classes cannot be posted
+    types: List[str] = []
+    # latest published snapshot of each index, by index name, e.g. 'Book.title'
+    snapshots: Dict[str, Ref[IndexSnapshot]] = {}
     version: int = 1
 
     @classmethod
@@ -19,6 +22,8 @@ class DatabaseSchema(Record):
         :return: Instance of AARSSchema
         """
         schemas = (await fetch_records(datatype=cls, channel=channel, owner=owner))
+        if not schemas:
+            return None
         if version is None:
             schemas.sort(key=lambda x: x.version)
             return schemas[-1]
@@ -30,11 +35,28 @@ class DatabaseSchema(Record):
         schema = await self.fetch_schema(channel=self.channel, owner=self.owner)
         if schema is not None:
             self.version = schema.version + 1
-        return self
+        return await super(DatabaseSchema, self).upsert()
 
     def add_type(self, type_: Type[Record]):
-        if type_ in self.types():
-            return
-        self.types[type_.__name__] = type_
-        name = type_.__name__ + '_id'
-        self.indices[name] = Index(datatype=type_, name=name)
+        if type_.__name__ not in self.types:
+            self.types.append(type_.__name__)
+
+    async def publish_snapshot(self, index: Index) -> IndexSnapshot:
+        """
+        Publishes a snapshot of an index and points the schema at it. The schema needs to be upserted afterwards.
+        """
+        self.add_type(index.datatype)
+        snapshot = await index.publish_snapshot()
+        self.snapshots[repr(index)] = Ref[IndexSnapshot](snapshot.item_hash, snapshot)
+        return snapshot
+
+    async def bootstrap(self, index: Index) -> int:
+        """
+        Loads the latest snapshot of an index which the schema points at, and replays the posts after it.
+        :return: Number of replayed messages.
+        """
+        snapshot: Union[Ref, None] = self.snapshots.get(repr(index))
+        if snapshot is None:
+            await index.rebuild()
+            return 0
+        return await index.bootstrap(await snapshot.fetch())
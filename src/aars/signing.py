@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import lru_cache
+from typing import Any, Coroutine, Dict, Iterable, Optional, TYPE_CHECKING
+
+from src.aars.metrics import metrics
+
+if TYPE_CHECKING:
+    from aleph_client.types import Account
+
+# content up to this size is sent inline with the message, larger content is pushed to the storage of the API server
+MAX_INLINE_SIZE = 50000
+
+
+class AccountPool:
+    """
+    Accounts which sign messages in turn, e.g. an owner and delegates which it authorized to post on its behalf.
+
+    Posts and forgets take the address of the owner, so that they are found by queries for its records, while the
+    sender of each message is the next account of the pool.
+
+    >>> client = AlephClient(AccountPool([owner, *delegates]), channel='MY_CHANNEL', signing_executor=executor)
+
+    :param accounts: The accounts to sign with, round-robin.
+    :param address: Address of the owner of the posts. If None, the address of the first account is used.
+    """
+
+    def __init__(self, accounts: Iterable['Account'], address: str = None):
+        self.accounts = list(accounts)
+        if not self.accounts:
+            raise ValueError('An account pool needs at least one account')
+        self.address = address or self.accounts[0].get_address()
+        self._accounts = itertools.cycle(self.accounts)
+
+    def __len__(self) -> int:
+        return len(self.accounts)
+
+    def next(self) -> 'Account':
+        """Returns the account to sign the next message with."""
+        return next(self._accounts)
+
+    def get_address(self) -> str:
+        return self.address
+
+
+def _run_sync(coroutine: Coroutine) -> Any:
+    # the sign_message() coroutines of aleph_client's accounts never suspend, so they are run without an event loop
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coroutine.close()
+    raise RuntimeError('Signing suspended, the account cannot sign outside of an event loop')
+
+
+@lru_cache(maxsize=None)
+def _load_account(account_type: type, private_key: bytes) -> 'Account':
+    return account_type(private_key=private_key)
+
+
+def sign_message(account: 'Account',
+                 message_type: str,
+                 content: Dict[str, Any],
+                 channel: str,
+                 item_hash: str = None) -> Optional[Dict[str, Any]]:
+    """
+    Serializes, hashes and signs a message like aleph_client does. As it takes no event loop, it can run in a thread
+    or process pool.
+
+    :param account: The account to sign with, or its type and private key to run in another process.
+    :param message_type: The type of the message, e.g. 'POST' or 'FORGET'.
+    :param content: The content of the message.
+    :param channel: The channel of the message.
+    :param item_hash: Hash of the content in the storage of the API server, if it has been pushed there.
+    :return: The signed message, or None if the content is too large to be sent inline and needs to be pushed first.
+    """
+    if isinstance(account, tuple):
+        account = _load_account(*account)
+    message = {
+        'chain': account.CHAIN,
+        'channel': channel,
+        'sender': account.get_address(),
+        'type': message_type,
+        'time': time.time(),
+    }
+    if item_hash is None:
+        # serialized like aleph_client does, so that both reject the same content
+        item_content = json.dumps(content, separators=(',', ':'))
+        if len(item_content) >= MAX_INLINE_SIZE:
+            return None
+        message['item_content'] = item_content
+        message['item_hash'] = hashlib.sha256(item_content.encode('utf-8')).hexdigest()
+    else:
+        message['item_hash'] = item_hash
+    return _run_sync(account.sign_message(message))
+
+
+class MessageSigner:
+    """
+    Signs messages on the event loop, or in `executor` to take the serialization, hashing and signing of bulk writes
+    off the event loop. Signing holds the GIL for most of its time, so a `ProcessPoolExecutor` scales with the cores,
+    while a `ThreadPoolExecutor` mostly keeps the event loop responsive. Accounts are sent to worker processes as
+    their type and private key.
+    """
+
+    def __init__(self, executor: Executor = None):
+        self.executor = executor
+
+    async def sign(self,
+                   account: 'Account',
+                   message_type: str,
+                   content: Dict[str, Any],
+                   channel: str,
+                   item_hash: str = None) -> Optional[Dict[str, Any]]:
+        start = time.perf_counter()
+        if self.executor is None:
+            message = sign_message(account, message_type, content, channel, item_hash)
+        else:
+            if isinstance(self.executor, ProcessPoolExecutor):
+                account = (type(account), account.private_key)
+            message = await asyncio.get_running_loop().run_in_executor(
+                self.executor, sign_message, account, message_type, content, channel, item_hash)
+        metrics.observe('aars_signing_seconds', time.perf_counter() - start)
+        return message
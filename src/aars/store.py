@@ -0,0 +1,225 @@
+import json
+import sqlite3
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from src.aars.cache import Cache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    item_hash TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    channel TEXT,
+    address TEXT,
+    ref TEXT,
+    time REAL,
+    post TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS posts_by_type ON posts (type, channel, time);
+CREATE INDEX IF NOT EXISTS posts_by_ref ON posts (type, ref);
+CREATE TABLE IF NOT EXISTS revisions (
+    type TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    hashes TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (type, ref)
+);
+CREATE TABLE IF NOT EXISTS index_entries (
+    index_name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    item_hash TEXT NOT NULL,
+    PRIMARY KEY (index_name, key, item_hash)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    type TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    address TEXT NOT NULL,
+    last_time REAL NOT NULL,
+    PRIMARY KEY (type, channel, address)
+);
+"""
+
+
+def encode_key(key: Any) -> str:
+    return json.dumps(key, default=str)
+
+
+def decode_key(key: str) -> Any:
+    key = json.loads(key)
+    return tuple(key) if isinstance(key, list) else key
+
+
+class PostStore(Cache):
+    """
+    Persistent local store of raw Aleph posts, revision chains and index entries, backed by SQLite in WAL mode.
+
+    When set with `set_store()`, `fetch_records` reads through it: posts that are already stored are not requested
+    from Aleph again, and a scan over all posts of a type only fetches posts newer than the last scan.
+
+    :param path: Path of the SQLite database file.
+    :param revisions_ttl: Seconds after which a stored revision chain is refreshed from Aleph. If None, stored chains
+    are used until they are invalidated by an upsert or updated by a scan.
+    :param offline: If True, scans are served from the store only, without asking Aleph for newer posts.
+    """
+
+    def __init__(self,
+                 path: str = 'aars.db',
+                 revisions_ttl: Optional[float] = 60.0,
+                 offline: bool = False,
+                 clock: Callable[[], float] = time.time):
+        self.path = path
+        self.revisions_ttl = revisions_ttl
+        self.offline = offline
+        self.clock = clock
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def get_post(self, post_type: str, item_hash: str) -> Optional[Dict[str, Any]]:
+        row = self.connection.execute('SELECT post FROM posts WHERE type = ? AND item_hash = ?',
+                                      (post_type, item_hash)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put_post(self, post: Dict[str, Any]) -> None:
+        self.put_posts([post])
+
+    def put_posts(self, posts: Iterable[Dict[str, Any]]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO posts (item_hash, type, channel, address, ref, time, post) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(post['item_hash'], post['type'], post.get('channel'), post.get('address'), post.get('ref'),
+                  post.get('time'), json.dumps(post, default=str)) for post in posts]
+            )
+
+    def iter_posts(self,
+                   post_type: str,
+                   channels: List[str] = None,
+                   owners: List[str] = None,
+                   page_size: int = 200) -> Iterator[List[Dict[str, Any]]]:
+        """Iterates over pages of stored posts of given type, newest first."""
+        query = 'SELECT post FROM posts WHERE type = ?'
+        params: List[Any] = [post_type]
+        if channels is not None:
+            query += f" AND channel IN ({', '.join('?' * len(channels))})"
+            params += channels
+        if owners is not None:
+            query += f" AND address IN ({', '.join('?' * len(owners))})"
+            params += owners
+        cursor = self.connection.execute(query + ' ORDER BY time DESC', params)
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                return
+            yield [json.loads(row[0]) for row in rows]
+
+    def get_revisions(self, post_type: str, ref: str, stale: bool = False) -> Optional[List[str]]:
+        row = self.connection.execute('SELECT hashes, updated FROM revisions WHERE type = ? AND ref = ?',
+                                      (post_type, ref)).fetchone()
+        if row is None:
+            return None
+        hashes, updated = row
+        if not stale and not self.offline and (updated < 0 or self.revisions_ttl is not None
+                                               and updated + self.revisions_ttl <= self.clock()):
+            return None
+        return json.loads(hashes)
+
+    def put_revisions(self, post_type: str, ref: str, revisions: List[str]) -> None:
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO revisions (type, ref, hashes, updated) VALUES (?, ?, ?, ?)',
+                (post_type, ref, json.dumps(revisions), self.clock())
+            )
+
+    def invalidate(self, post_type: str, item_hash: str) -> None:
+        with self.connection:
+            # a negative update time marks the chain as stale, it is kept as prefix of the current one
+            self.connection.execute('UPDATE revisions SET updated = -1 WHERE type = ? AND ref = ?',
+                                    (post_type, item_hash))
+
+    def delete_posts(self, post_type: str, item_hashes: List[str]) -> None:
+        with self.connection:
+            self.connection.executemany('DELETE FROM posts WHERE type = ? AND item_hash = ?',
+                                        [(post_type, item_hash) for item_hash in item_hashes])
+            self.connection.executemany('DELETE FROM revisions WHERE type = ? AND ref = ?',
+                                        [(post_type, item_hash) for item_hash in item_hashes])
+            self.connection.executemany('DELETE FROM index_entries WHERE item_hash = ?',
+                                        [(item_hash,) for item_hash in item_hashes])
+
+    def clear(self) -> None:
+        with self.connection:
+            for table in ('posts', 'revisions', 'index_entries', 'sync_state'):
+                self.connection.execute(f'DELETE FROM {table}')
+
+    def put_scan_page(self, post_type: str, posts: List[Dict[str, Any]], full_scan: bool = False) -> None:
+        """
+        Stores a page of posts returned by a scan and rebuilds the revision chains of the records they amend. Chains
+        of records which are not stored yet are only built during a full scan, otherwise they are fetched on demand.
+        Amendments are always newer than the post they amend, so they have been stored before it.
+        """
+        self.put_posts(posts)
+        refs = {post['ref'] for post in posts if post.get('ref') is not None}
+        if full_scan:
+            refs.update(post['item_hash'] for post in posts if post.get('ref') is None)
+        with self.connection:
+            for ref in refs:
+                known = self.connection.execute('SELECT 1 FROM revisions WHERE type = ? AND ref = ?',
+                                                 (post_type, ref)).fetchone()
+                if known is None and not full_scan:
+                    continue
+                hashes = [row[0] for row in self.connection.execute(
+                    'SELECT item_hash FROM posts WHERE type = ? AND ref = ? ORDER BY time', (post_type, ref)
+                )]
+                # only considered fresh once the whole scan has been stored
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO revisions (type, ref, hashes, updated) VALUES (?, ?, ?, 0)',
+                    (post_type, ref, json.dumps(hashes))
+                )
+
+    def mark_synced(self, post_type: str, last_time: float, channels: List[str] = None,
+                    owners: List[str] = None) -> None:
+        """
+        Advances the high-water mark of a completed scan. As all posts since the previous scan have been stored, the
+        revision chains of this type are known to be complete.
+        """
+        with self.connection:
+            self.connection.execute('UPDATE revisions SET updated = ? WHERE type = ?', (self.clock(), post_type))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO sync_state (type, channel, address, last_time) VALUES (?, ?, ?, ?)',
+                (post_type, self._scope(channels), self._scope(owners), last_time)
+            )
+
+    def last_synced(self, post_type: str, channels: List[str] = None, owners: List[str] = None) -> Optional[float]:
+        """Returns the time of the newest post seen by a scan with given filters, or None if it never ran."""
+        row = self.connection.execute(
+            'SELECT last_time FROM sync_state WHERE type = ? AND channel = ? AND address = ?',
+            (post_type, self._scope(channels), self._scope(owners))
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def get_index_entries(self, index_name: str) -> List[Tuple[Any, str]]:
+        rows = self.connection.execute('SELECT key, item_hash FROM index_entries WHERE index_name = ?',
+                                       (index_name,)).fetchall()
+        return [(decode_key(key), item_hash) for key, item_hash in rows]
+
+    def put_index_entries(self, index_name: str, entries: Iterable[Tuple[Any, str]]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO index_entries (index_name, key, item_hash) VALUES (?, ?, ?)',
+                [(index_name, encode_key(key), item_hash) for key, item_hash in entries]
+            )
+
+    def delete_index_entries(self, index_name: str, entries: Iterable[Tuple[Any, str]]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM index_entries WHERE index_name = ? AND key = ? AND item_hash = ?',
+                [(index_name, encode_key(key), item_hash) for key, item_hash in entries]
+            )
+
+    @staticmethod
+    def _scope(values: Optional[List[str]]) -> str:
+        return '' if values is None else ','.join(sorted(values))
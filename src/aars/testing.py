@@ -0,0 +1,235 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import Counter
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Union, TYPE_CHECKING
+
+from src.aars.client import AlephClient
+from src.aars.metrics import record_remote_call
+
+if TYPE_CHECKING:
+    from aleph_client.types import Account
+
+
+@dataclass
+class LocalPostMessage:
+    """The part of a posted message that records use."""
+    item_hash: str
+    item_content: str
+    channel: str
+    sender: str
+    time: float
+
+
+class LocalAlephClient(AlephClient):
+    """
+    In-process stand-in for an Aleph API server, for tests and benchmarks. It keeps posts in memory and answers
+    `get_posts`, `create_post` and `forget` like the API does: posts are filtered by the given arguments, sorted
+    newest first and paginated.
+
+    >>> client = LocalAlephClient(latency=0.05, max_page_size=200)
+    >>> set_default_client(client)
+
+    :param account: The account whose address is set as sender of the posts. If None, a fixed address is used.
+    :param channel: The channel to post to, if no other is given.
+    :param latency: Seconds each call waits before it is answered, or a function returning them.
+    :param max_page_size: Upper bound of the `pagination` argument of `get_posts`, as enforced by API servers.
+    :param signing_executor: If given, or if `account` is an `AccountPool`, messages are signed like by `AlephClient`.
+    """
+
+    def __init__(self,
+                 account: Optional['Account'] = None,
+                 channel: str = 'AARS_TEST',
+                 latency: Union[float, Callable[[], float]] = 0.0,
+                 max_page_size: int = 200,
+                 clock: Callable[[], float] = time.time,
+                 signing_executor: Executor = None):
+        super(LocalAlephClient, self).__init__(account=account, channel=channel, api_server='local',
+                                               signing_executor=signing_executor)
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.clock = clock
+        self.calls: Counter = Counter()
+        self.posts: Dict[str, Dict[str, Any]] = {}
+        # all POST and FORGET messages, oldest first
+        self.messages: List[Dict[str, Any]] = []
+        self._new_messages: Optional[asyncio.Event] = None
+        self._by_ref: Dict[str, List[str]] = {}
+        self._last_time = 0.0
+        # the result of the last query, reused while paginating through it, until the posts change
+        self._last_query = None
+        self._version = 0
+
+    @property
+    def address(self) -> str:
+        return self.account.get_address() if self.account is not None else '0x' + '0' * 40
+
+    async def close(self):
+        pass
+
+    async def get_posts(self,
+                        types: Iterable[str] = None,
+                        refs: Iterable[str] = None,
+                        addresses: Iterable[str] = None,
+                        hashes: Iterable[str] = None,
+                        channels: Iterable[str] = None,
+                        start_date: float = None,
+                        pagination: int = 200,
+                        page: int = 1) -> Dict[str, Any]:
+        await self._call('get_posts')
+        query = tuple(None if values is None else tuple(sorted(values))
+                      for values in (types, refs, addresses, hashes, channels)) + (start_date, self._version)
+        if self._last_query is None or self._last_query[0] != query:
+            self._last_query = query, self._filter(types, refs, addresses, hashes, channels, start_date)
+        posts = self._last_query[1]
+        pagination = min(pagination, self.max_page_size)
+        return {
+            'posts': [dict(post) for post in posts[(page - 1) * pagination:page * pagination]],
+            'pagination_page': page,
+            'pagination_total': len(posts),
+            'pagination_per_page': pagination,
+            'pagination_item': 'posts',
+        }
+
+    def _filter(self, types, refs, addresses, hashes, channels, start_date) -> List[Dict[str, Any]]:
+        if hashes is not None:
+            candidates = [self.posts[item_hash] for item_hash in set(hashes) if item_hash in self.posts]
+        elif refs is not None:
+            candidates = [self.posts[item_hash] for ref in set(refs) for item_hash in self._by_ref.get(ref, ())]
+        else:
+            candidates = self.posts.values()
+        types, refs, addresses, channels = (None if values is None else set(values)
+                                            for values in (types, refs, addresses, channels))
+        posts = [post for post in candidates
+                 if (types is None or post['type'] in types)
+                 and (refs is None or post['ref'] in refs)
+                 and (addresses is None or post['address'] in addresses)
+                 and (channels is None or post['channel'] in channels)
+                 and (start_date is None or post['time'] >= start_date)]
+        posts.sort(key=lambda post: post['time'], reverse=True)
+        return posts
+
+    async def create_post(self,
+                          post_content: Any,
+                          post_type: str,
+                          ref: str = None,
+                          account: 'Account' = None,
+                          channel: str = None) -> LocalPostMessage:
+        await self._call('create_post')
+        address = account.get_address() if account is not None else self.address
+        # posts in the same process may be faster than the clock's resolution, but their times must be distinct
+        self._last_time = max(self.clock(), self._last_time + 1e-6)
+        content = {'type': post_type, 'address': address, 'content': post_content, 'time': self._last_time, 'ref': ref}
+        sender = address
+        if self.signer is not None:
+            message = await self._sign('POST', content, account, channel)
+            item_hash, sender = message['item_hash'], message['sender']
+            # content which is too large to be inline has been pushed to the storage instead
+            item_content = message.get('item_content') or json.dumps(content, separators=(',', ':'))
+        else:
+            # serialized like aleph_client does, so that content it rejects is rejected here too
+            item_content = json.dumps(content, separators=(',', ':'))
+            item_hash = hashlib.sha256(item_content.encode()).hexdigest()
+        message_content = json.loads(item_content)
+        self.posts[item_hash] = {
+            'item_hash': item_hash,
+            'type': post_type,
+            'ref': ref,
+            'address': address,
+            'channel': channel or self.channel,
+            'content': message_content['content'],
+            'time': self._last_time,
+        }
+        if ref is not None:
+            self._by_ref.setdefault(ref, []).append(item_hash)
+        self._version += 1
+        self._publish({'item_hash': item_hash, 'type': 'POST', 'sender': sender, 'channel': channel or self.channel,
+                       'time': self._last_time, 'content': message_content})
+        return LocalPostMessage(item_hash=item_hash, item_content=item_content, channel=channel or self.channel,
+                                sender=sender, time=self._last_time)
+
+    async def _storage_push(self, content: Dict[str, Any]) -> str:
+        await self._call('storage_push')
+        return hashlib.sha256(json.dumps(content, separators=(',', ':')).encode()).hexdigest()
+
+    async def forget(self,
+                     hashes: List[str],
+                     reason: str = None,
+                     account: 'Account' = None,
+                     channel: str = None):
+        await self._call('forget')
+        for item_hash in hashes:
+            post = self.posts.pop(item_hash, None)
+            if post is not None and post['ref'] is not None:
+                self._by_ref[post['ref']].remove(item_hash)
+        self._version += 1
+        address = account.get_address() if account is not None else self.address
+        self._last_time = max(self.clock(), self._last_time + 1e-6)
+        content = {'address': address, 'hashes': list(hashes), 'reason': reason, 'time': self._last_time}
+        if self.signer is not None:
+            message = await self._sign('FORGET', content, account, channel)
+            item_hash, sender = message['item_hash'], message['sender']
+        else:
+            item_hash, sender = hashlib.sha256(json.dumps(content, separators=(',', ':')).encode()).hexdigest(), address
+        self._publish({'item_hash': item_hash, 'type': 'FORGET', 'sender': sender, 'channel': channel or self.channel,
+                       'time': self._last_time, 'content': content})
+
+    async def get_messages(self,
+                           message_types: Iterable[str] = None,
+                           channels: Iterable[str] = None,
+                           start_date: float = None,
+                           pagination: int = 200,
+                           page: int = 1) -> Dict[str, Any]:
+        await self._call('get_messages')
+        messages = [message for message in reversed(self.messages)
+                    if self._matches(message, message_types, channels, start_date)]
+        pagination = min(pagination, self.max_page_size)
+        return {
+            'messages': [dict(message) for message in messages[(page - 1) * pagination:page * pagination]],
+            'pagination_page': page,
+            'pagination_total': len(messages),
+            'pagination_per_page': pagination,
+            'pagination_item': 'messages',
+        }
+
+    async def watch_messages(self,
+                             channels: Iterable[str] = None,
+                             start_date: float = None) -> AsyncIterator[Dict[str, Any]]:
+        await self._call('watch_messages')
+        position = 0
+        while True:
+            while position < len(self.messages):
+                message = self.messages[position]
+                position += 1
+                if self._matches(message, None, channels, start_date):
+                    yield dict(message)
+            if self._new_messages is None:
+                self._new_messages = asyncio.Event()
+            self._new_messages.clear()
+            await self._new_messages.wait()
+
+    def _publish(self, message: Dict[str, Any]):
+        self.messages.append(message)
+        if self._new_messages is not None:
+            self._new_messages.set()
+
+    @staticmethod
+    def _matches(message: Dict[str, Any], message_types, channels, start_date) -> bool:
+        return (message_types is None or message['type'] in message_types) \
+            and (channels is None or message['channel'] in channels) \
+            and (start_date is None or message['time'] >= start_date)
+
+    async def _call(self, method: str):
+        self.calls[method] += 1
+        self.stats.requests += 1
+        start = time.perf_counter()
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency:
+            await asyncio.sleep(latency)
+        else:
+            # yield to the event loop, like a network call would
+            await asyncio.sleep(0)
+        record_remote_call(method, time.perf_counter() - start)
@@ -1,5 +1,9 @@
+import asyncio
 import operator
+import random
+from collections import deque
 from itertools import *
+from operator import itemgetter
 
 
 def subslices(seq):
@@ -23,3 +27,168 @@ def possible_index_names(seq):
         list(possible_index_names(['A', 'B', 'C'])) == [['A'], ['A.B'], ['A.B.C'], ['B'], ['B.C'], ['C']]
     """
     return map('.'.join, subslices(seq))
+
+
+def chunks(iterable, size):
+    """
+    Split an iterable into consecutive lists of at most `size` elements. The iterable is consumed lazily.
+
+    Example:
+        list(chunks([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+    """
+    iterator = iter(iterable)
+    return iter(lambda: list(islice(iterator, size)), [])
+
+
+async def prefetch(awaitables, max_in_flight):
+    """
+    Await an iterable of awaitables in order, scheduling up to `max_in_flight` of them ahead of the one currently
+    consumed. The iterable is consumed lazily, so it may be a generator of coroutines.
+    """
+    pending = deque()
+    try:
+        for awaitable in awaitables:
+            pending.append(asyncio.ensure_future(awaitable))
+            if len(pending) >= max_in_flight:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def retry(func, retries=3, base_delay=0.5, max_delay=10.0, should_retry=lambda error: True):
+    """
+    Call the coroutine function `func` until it succeeds, at most `retries` + 1 times. Between attempts, wait for a
+    random time of up to `base_delay` * 2^attempt seconds (exponential backoff with full jitter), capped at
+    `max_delay`. Errors for which `should_retry` is false are raised immediately.
+
+    Returns the result of `func` and the number of attempts it took. If it fails, the number of attempts is set as
+    the `attempts` attribute of the raised error.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return await func(), attempt
+        except Exception as error:
+            if attempt > retries or not should_retry(error):
+                error.attempts = attempt
+                raise
+            await asyncio.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1))))
+
+
+async def map_bounded(func, iterable, max_in_flight):
+    """
+    Apply the coroutine function `func` to each element of a (sync or async) iterable, with at most `max_in_flight`
+    calls running at the same time. The iterable is consumed lazily, so that it is never materialized.
+
+    Returns the results in the order of the iterable.
+    """
+    done = object()
+    results = []
+    positions = count()
+    lock = asyncio.Lock()
+    if hasattr(iterable, '__aiter__'):
+        iterator = iterable.__aiter__()
+
+        async def next_item():
+            async with lock:
+                try:
+                    return next(positions), await iterator.__anext__()
+                except StopAsyncIteration:
+                    return None, done
+    else:
+        iterator = iter(iterable)
+
+        async def next_item():
+            item = next(iterator, done)
+            return (None, done) if item is done else (next(positions), item)
+
+    async def worker():
+        while True:
+            position, item = await next_item()
+            if item is done:
+                return
+            results.append((position, await func(item)))
+
+    await asyncio.gather(*[worker() for _ in range(max_in_flight)])
+    return [result for _, result in sorted(results, key=itemgetter(0))]
+
+
+class BatchLoader:
+    """
+    Coalesces concurrent loads of keys into batches, like a DataLoader. The keys requested within `delay` seconds, or
+    within the same iteration of the event loop if it is 0, are deduplicated and passed to the coroutine function
+    `batch` in chunks of at most `max_batch_size` keys. It returns a dict of the found keys to their values, which are
+    handed out to all callers. Loads of keys that are already being fetched share the pending result.
+
+    A loader belongs to the event loop in which it is used first.
+
+    Example:
+        loader = BatchLoader(fetch_users, max_batch_size=100)
+        users = await asyncio.gather(loader.load(1), loader.load(2), loader.load(1))  # one call of fetch_users([1, 2])
+    """
+
+    def __init__(self, batch, max_batch_size=200, delay=0.0):
+        self.batch = batch
+        self.max_batch_size = max_batch_size
+        self.delay = delay
+        self.loads = 0
+        self.batches = 0
+        self.deduplicated = 0
+        self._queued = {}
+        self._in_flight = {}
+        self._dispatch_scheduled = False
+
+    async def load(self, key):
+        """Returns the value of `key`, or None if it was not found."""
+        # shielded, as other callers may wait for the same future
+        return await asyncio.shield(self._future(key))
+
+    async def load_many(self, keys):
+        """Returns a dict of the found keys to their values."""
+        futures = {key: self._future(key) for key in keys}
+        values = await asyncio.gather(*(asyncio.shield(future) for future in futures.values()))
+        return {key: value for key, value in zip(futures, values) if value is not None}
+
+    def _future(self, key):
+        self.loads += 1
+        future = self._queued.get(key) or self._in_flight.get(key)
+        if future is not None:
+            self.deduplicated += 1
+            return future
+        loop = asyncio.get_running_loop()
+        future = self._queued[key] = loop.create_future()
+        if not self._dispatch_scheduled:
+            self._dispatch_scheduled = True
+            if self.delay:
+                loop.call_later(self.delay, self._dispatch)
+            else:
+                loop.call_soon(self._dispatch)
+        return future
+
+    def _dispatch(self):
+        self._dispatch_scheduled = False
+        queued, self._queued = self._queued, {}
+        for chunk in chunks(queued.items(), self.max_batch_size):
+            asyncio.ensure_future(self._run(dict(chunk)))
+
+    async def _run(self, futures):
+        self.batches += 1
+        self._in_flight.update(futures)
+        try:
+            values = await self.batch(list(futures))
+        except Exception as error:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            for key, future in futures.items():
+                if not future.done():
+                    future.set_result(values.get(key))
+        finally:
+            for key, future in futures.items():
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
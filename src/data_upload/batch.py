@@ -1,13 +1,28 @@
 import asyncio
 import io
 import ssl
+from typing import AsyncIterator, List, Optional
 
 import aiohttp
-import aleph_client.asynchronous
 import certifi
 import pandas as pd
 
 from data_utils import clean_time_duplicates
+from ohlcv import post_ohlcv_async
+
+# rows of the CSV files which are parsed, cleaned and posted at once in streaming mode
+DEFAULT_CHUNK_ROWS = 100_000
+READ_SIZE = 1 << 16
+
+_ssl_context: Optional[ssl.SSLContext] = None
+
+
+def get_ssl_context() -> ssl.SSLContext:
+    """The SSL context of all downloads, as loading the certificates for each one is slow."""
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context(cafile=certifi.where())
+    return _ssl_context
 
 
 def get_download_url(symbol, interval="hourly"):
@@ -20,38 +35,121 @@ def get_download_url(symbol, interval="hourly"):
     return f"https://www.cryptodatadownload.com/cdd/Binance_{symbol}USDT_{interval}.csv"
 
 
+async def iter_csv_blocks(stream: aiohttp.StreamReader, chunk_rows: int = DEFAULT_CHUNK_ROWS,
+                          skip_rows: int = 1) -> AsyncIterator[bytes]:
+    """
+    Splits a CSV file from a stream, as it is read, into blocks of about `chunk_rows` complete rows. Each block starts
+    with the header line, so that it can be parsed on its own with `parse_csv_block()`, e.g. in another process. At
+    most the text of one block is held in memory.
+    :param stream: The body of the response to read from.
+    :param chunk_rows: Number of rows per block.
+    :param skip_rows: Number of lines before the header, like the link at the top of cryptodatadownload.com files.
+    """
+    header = None
+    blocks: List[bytes] = []
+    lines = 0
+    rest = b''
+    yielded = False
+    async for block in stream.iter_chunked(READ_SIZE):
+        # only complete lines are split off, the incomplete last line is kept for the next block
+        end = block.rfind(b'\n') + 1
+        if not end:
+            rest += block
+            continue
+        blocks.append(rest + block[:end])
+        rest = block[end:]
+        lines += blocks[-1].count(b'\n')
+        if header is None:
+            if lines <= skip_rows:
+                continue
+            text = b''.join(blocks).split(b'\n', skip_rows + 1)
+            header = text[skip_rows] + b'\n'
+            blocks, lines = [text[-1]], lines - skip_rows - 1
+        if lines >= chunk_rows:
+            yield header + b''.join(blocks)
+            blocks, lines, yielded = [], 0, True
+    if rest.strip():
+        blocks.append(rest)
+    if header is None:
+        # the file ends within the lines before the first row
+        text = b''.join(blocks).split(b'\n', skip_rows + 1)
+        if len(text) > skip_rows and text[skip_rows].strip():
+            yield text[skip_rows]
+    elif any(blocks) or not yielded:
+        yield header + b''.join(blocks)
+
+
+def parse_csv_block(block: bytes) -> pd.DataFrame:
+    with io.BytesIO(block) as data:
+        return pd.read_csv(data)
+
+
+async def iter_csv_chunks(stream: aiohttp.StreamReader, chunk_rows: int = DEFAULT_CHUNK_ROWS,
+                          skip_rows: int = 1) -> AsyncIterator[pd.DataFrame]:
+    """
+    Parses a CSV file from a stream as it is read, in DataFrames of about `chunk_rows` rows. At most the text of one
+    chunk is held in memory.
+    :param stream: The body of the response to read from.
+    :param chunk_rows: Number of rows to parse at once.
+    :param skip_rows: Number of lines before the header, like the link at the top of cryptodatadownload.com files.
+    """
+    async for block in iter_csv_blocks(stream, chunk_rows, skip_rows):
+        yield parse_csv_block(block)
+
+
+async def stream_to_aleph_async(account, response, symbol, interval="hourly", chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Posts a CSV response chunk by chunk as it is downloaded, one post per chunk, so that the memory per symbol is
+    bounded by the chunk size instead of the file size.
+    """
+    responses = []
+    previous: Optional[pd.Series] = None
+    async for df in iter_csv_chunks(response.content, chunk_rows):
+        failed = clean_time_duplicates(df)
+        if failed:
+            print(f"{symbol}: {failed} rows with unparseable dates")
+        if previous is not None:
+            # files are ordered by time, so duplicates of other chunks are at the boundary with the previous one
+            df = df[~df['timestamp'].isin(previous)].reset_index(drop=True)
+        if df.empty:
+            continue
+        previous = df['timestamp']
+        responses.append(await post_ohlcv_async(account, df, symbol, interval, extra={'part': len(responses)}))
+    return responses
+
+
 # Code for all async
 # responses = asyncio.get_event_loop().run_until_complete(post_all_to_aleph_async(currencies))
 # hashes = [resp['item_hash'] for resp in responses]
-async def post_to_aleph_async(account, client, symbol, interval="hourly"):
+async def post_to_aleph_async(account, client, symbol, interval="hourly", chunk_rows=None):
+    """
+    Downloads, cleans and posts the history of a symbol. If `chunk_rows` is given, it is streamed in posts of that many
+    rows and the list of their responses is returned, see `stream_to_aleph_async()`.
+    """
     url = get_download_url(symbol, interval)
-    sslcontext = ssl.create_default_context(cafile=certifi.where())
-    async with client.get(url, ssl=sslcontext) as response:
+    async with client.get(url, ssl=get_ssl_context()) as response:
+        if chunk_rows is not None:
+            return await stream_to_aleph_async(account, response, symbol, interval, chunk_rows)
         with io.StringIO(await response.text()) as text_io:
             df = pd.read_csv(text_io, header=1)
             clean_time_duplicates(df)
             print(df.describe())
-            return await aleph_client.asynchronous.create_post(account=account,
-                                                               post_content=df.to_dict(),
-                                                               post_type="ohlcv_timeseries",
-                                                               channel="TEST-CRYPTODATADOWNLOAD")
+            return await post_ohlcv_async(account, df, symbol, interval)
 
 
-async def post_all_to_aleph_async(account, symbols: list, interval="hourly"):
+async def post_all_to_aleph_async(account, symbols: list, interval="hourly", chunk_rows=None):
     async with aiohttp.ClientSession(trust_env=True, connector=aiohttp.TCPConnector(limit_per_host=4)) as client:
-        futures = [post_to_aleph_async(account, client, symbol, interval) for symbol in symbols]
+        futures = [post_to_aleph_async(account, client, symbol, interval, chunk_rows) for symbol in symbols]
         return await asyncio.gather(*futures)
 
 
-def post_to_aleph(account, url, amend_hash=None):
+def post_to_aleph(account, url, symbol, interval="hourly", amend_hash=None):
     df = pd.read_csv(url, header=1)
+    clean_time_duplicates(df)
     print(df.describe())
     post_type = 'ohlcv_timeseries' if amend_hash is None else 'amend'
-    return aleph_client.create_post(account=account,
-                                    post_content=df.describe().to_dict(),
-                                    post_type=post_type,
-                                    channel="TEST-CRYPTODATADOWNLOAD",
-                                    ref=amend_hash)
+    return asyncio.get_event_loop().run_until_complete(post_ohlcv_async(account, df, symbol, interval,
+                                                                        post_type=post_type, ref=amend_hash))
 
 
 def post_all_to_aleph(account, symbols: list, amend_hashes=None, interval="hourly"):
@@ -59,10 +157,10 @@ def post_all_to_aleph(account, symbols: list, amend_hashes=None, interval="hourl
     for symbol in symbols:
         url = get_download_url(symbol, interval)
         if amend_hashes:
-            resp = post_to_aleph(account, url, amend_hashes[symbol])
+            resp = post_to_aleph(account, url, symbol, interval, amend_hashes[symbol])
             print(f"Amended {symbol}: {amend_hashes[symbol]}")
         else:
-            resp = post_to_aleph(account, url)
+            resp = post_to_aleph(account, url, symbol, interval)
             print(f"Posted {symbol}: {resp['item_hash']}")
         hashes[symbol] = resp['item_hash']
     return hashes
@@ -1,21 +1,52 @@
-from datetime import datetime
+import pandas as pd
+from pandas import DataFrame, Series
 
-from pandas import DataFrame
+# formats of the date column in cryptodatadownload.com files, by the masks of the rows they apply to
+AM_PM_FORMAT = '%Y-%m-%d %I-%p'
+SLASH_TIME_FORMAT = '%Y/%m/%d %H:%M:%S'
+SLASH_FORMAT = '%Y/%m/%d'
+ISO_FORMAT = 'ISO8601'
 
 
-def clean_time_duplicates(df: DataFrame):
-    for i in range(len(df)):
-        if 'AM' in df.date.iloc[i] or 'PM' in df.date.iloc[i]:
-            df.at[i, 'date'] = datetime.strptime(df.date.iloc[i], '%Y-%m-%d %I-%p')
-        elif '/' in df.date.iloc[i]:
-            if ':' in df.date.iloc[i]:
-                df.at[i, 'date'] = datetime.strptime(df.date.iloc[i], '%Y/%m/%d %H:%M:%S')
-            else:
-                df.at[i, 'date'] = datetime.strptime(df.date.iloc[i], '%Y/%m/%d')
-        else:
-            df.at[i, 'date'] = datetime.fromisoformat(df.date.iloc[i])
-    df.drop_duplicates(subset=['date'], inplace=True)
+def parse_dates(dates: Series) -> Series:
+    """
+    Parses a column of dates in mixed formats. Rows are grouped by their format with column-wide string masks, and
+    each group is parsed in one pass. Dates with a UTC offset are converted to UTC, dates without one are taken as
+    UTC. Rows which cannot be parsed are NaT, and so are all rows of a group which fails as a whole.
+    """
+    dates = dates.astype(str).str.strip()
+    am_pm = dates.str.contains('AM', regex=False) | dates.str.contains('PM', regex=False)
+    slash = ~am_pm & dates.str.contains('/', regex=False)
+    slash_time = slash & dates.str.contains(':', regex=False)
+    groups = [(am_pm, AM_PM_FORMAT), (slash_time, SLASH_TIME_FORMAT), (slash & ~slash_time, SLASH_FORMAT),
+              (~am_pm & ~slash, ISO_FORMAT)]
+    parsed = pd.Series(pd.NaT, index=dates.index, dtype='datetime64[ms]')
+    for mask, date_format in groups:
+        if not mask.any():
+            continue
+        try:
+            group = pd.to_datetime(dates[mask], format=date_format, errors='coerce', utc=True)
+        except (ValueError, TypeError, OverflowError):
+            continue
+        parsed[mask] = group.dt.tz_localize(None).astype('datetime64[ms]')
+    return parsed
+
+
+def clean_time_duplicates(df: DataFrame) -> int:
+    """
+    Replaces the date column by an int64 `timestamp` column of epoch milliseconds, drops rows with duplicate or
+    unparseable dates and sorts the rows by time, oldest first.
+    :return: Number of rows whose date could not be parsed.
+    """
+    parsed = parse_dates(df['date'])
+    failed = parsed.isna()
+    df.drop(index=df.index[failed.to_numpy()], inplace=True)
+    df['timestamp'] = parsed[~failed].astype('int64')
+    df.drop_duplicates(subset=['timestamp'], inplace=True)
+    df.sort_values('timestamp', inplace=True, kind='stable')
+    df.reset_index(drop=True, inplace=True)
     del df['date']
+    return int(failed.sum())
 
 
 def save_to_file(filename, content):
@@ -0,0 +1,206 @@
+import asyncio
+import copy
+import json
+import os
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import aiohttp
+import aleph_client.asynchronous
+import pandas as pd
+
+from batch import DEFAULT_CHUNK_ROWS, get_download_url, get_ssl_context, iter_csv_chunks
+from data_utils import clean_time_duplicates
+from ohlcv import CHANNEL, post_ohlcv_async, read_ohlcv_async
+
+CURSOR_FILE = 'cursors.json'
+MANIFEST_POST_TYPE = 'ohlcv_manifest'
+SHARD_POST_TYPE = 'ohlcv_shard'
+# months with more parts are compacted even if they are not complete yet
+MAX_SHARD_PARTS = 8
+
+
+def load_cursors(filename=CURSOR_FILE) -> Dict[str, Any]:
+    """
+    Loads the state of incremental ingestion: per symbol and interval, the hash and content of its manifest, whose
+    `last_timestamp` is the last ingested candle.
+    """
+    try:
+        with open(filename, "r") as file:
+            return json.loads(file.read())
+    except OSError:
+        return {}
+
+
+def save_cursors(cursors: Dict[str, Any], filename=CURSOR_FILE):
+    # written to a temporary file first, so that an interrupted run does not leave a truncated file
+    with open(filename + '.tmp', "w") as file:
+        file.write(json.dumps(cursors))
+    os.replace(filename + '.tmp', filename)
+
+
+def month_of(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc).strftime('%Y-%m')
+
+
+def shards_for_window(manifest: Dict[str, Any], start: int = None, end: int = None) -> List[str]:
+    """Returns the hashes of the shard posts of a manifest with candles between the `start` and `end` timestamps."""
+    return [part['item_hash'] for month in sorted(manifest['shards']) for part in manifest['shards'][month]
+            if (start is None or part['last_timestamp'] >= start) and (end is None or part['first_timestamp'] <= end)]
+
+
+async def iter_new_rows(response, last_timestamp: Optional[int],
+                        chunk_rows=DEFAULT_CHUNK_ROWS) -> AsyncIterator[pd.DataFrame]:
+    """
+    Yields the cleaned rows of a CSV response which are newer than `last_timestamp`. As cryptodatadownload.com files
+    are ordered newest first, the download stops at the first chunk which reaches back to `last_timestamp`.
+    """
+    async for df in iter_csv_chunks(response.content, chunk_rows):
+        clean_time_duplicates(df)
+        if last_timestamp is None:
+            yield df
+            continue
+        new = df[df['timestamp'] > last_timestamp].reset_index(drop=True)
+        if not new.empty:
+            yield new
+        if len(new) < len(df):
+            break
+
+
+async def post_manifest(account, state: Dict[str, Any], session=None):
+    """Posts the manifest of a symbol, or amends it if it has been posted before."""
+    if state.get('manifest_hash') is None:
+        resp = await aleph_client.asynchronous.create_post(account=account, post_content=state['manifest'],
+                                                           post_type=MANIFEST_POST_TYPE, channel=CHANNEL,
+                                                           session=session)
+        state['manifest_hash'] = resp['item_hash']
+    else:
+        await aleph_client.asynchronous.create_post(account=account, post_content=state['manifest'],
+                                                    post_type='amend', ref=state['manifest_hash'], channel=CHANNEL,
+                                                    session=session)
+
+
+async def post_shards(account, df: pd.DataFrame, state: Dict[str, Any], session=None) -> int:
+    """Posts new rows as one shard part per month and adds the parts to the manifest. Returns the number of parts."""
+    manifest = state['manifest']
+    months = df['timestamp'].map(month_of)
+    for month, rows in df.groupby(months, sort=True):
+        rows = rows.reset_index(drop=True)
+        resp = await post_ohlcv_async(account, rows, manifest['symbol'], manifest['interval'], extra={'month': month},
+                                      post_type=SHARD_POST_TYPE, session=session)
+        manifest['shards'].setdefault(month, []).append({
+            'item_hash': resp['item_hash'],
+            'first_timestamp': int(rows['timestamp'].iloc[0]),
+            'last_timestamp': int(rows['timestamp'].iloc[-1]),
+            'rows': len(rows),
+        })
+    return months.nunique()
+
+
+async def ingest_symbol(account, client, symbol, interval="hourly", cursors: Dict[str, Any] = None,
+                        chunk_rows=DEFAULT_CHUNK_ROWS, ssl_context=None) -> Dict[str, Any]:
+    """
+    Posts the candles of a symbol which are newer than its cursor as monthly shards, and updates its manifest and
+    cursor. Returns the state of the symbol. The cursor only advances once the manifest has been posted.
+    """
+    cursors = cursors if cursors is not None else {}
+    key = f"{symbol}/{interval}"
+    state = copy.deepcopy(cursors.get(key) or {
+        'manifest_hash': None,
+        'manifest': {'symbol': symbol, 'interval': interval, 'last_timestamp': None, 'shards': {}},
+    })
+    manifest = state['manifest']
+    url = get_download_url(symbol, interval)
+    ssl_context = ssl_context or get_ssl_context()
+    rows = parts = 0
+    async with client.get(url, ssl=ssl_context) as response:
+        response.raise_for_status()
+        async for df in iter_new_rows(response, manifest['last_timestamp'], chunk_rows):
+            parts += await post_shards(account, df, state, session=client)
+            rows += len(df)
+            last = int(df['timestamp'].iloc[-1])
+            manifest['last_timestamp'] = last if manifest['last_timestamp'] is None \
+                else max(manifest['last_timestamp'], last)
+    if parts:
+        await post_manifest(account, state, session=client)
+    cursors[key] = state
+    print(f"{key}: {rows} new rows in {parts} shard parts")
+    return state
+
+
+async def compact(account, client, state: Dict[str, Any], max_parts=MAX_SHARD_PARTS, forget=True) -> int:
+    """
+    Merges the parts of each month into one shard, once the month is complete, or once it has more than `max_parts`
+    parts. The merged parts, and their STORE objects, are forgotten if `forget` is set. A month is skipped if not all
+    of its parts can be read back or the merged shard cannot be posted, so that no rows are lost and the other months
+    are still compacted. Returns the number of compacted months.
+    """
+    manifest = state['manifest']
+    if manifest['last_timestamp'] is None:
+        return 0
+    current_month = month_of(manifest['last_timestamp'])
+    months = [month for month, month_parts in manifest['shards'].items()
+              if len(month_parts) > 1 and (month != current_month or len(month_parts) > max_parts)]
+    compacted = 0
+    for month in months:
+        # the state only changes once the month has been compacted
+        work = copy.deepcopy(state)
+        manifest = work['manifest']
+        key = f"{manifest['symbol']}/{manifest['interval']}"
+        parts = manifest['shards'][month]
+        hashes = [part['item_hash'] for part in parts]
+        try:
+            resp = await aleph_client.asynchronous.get_posts(hashes=hashes, pagination=len(hashes), session=client)
+            if {post['item_hash'] for post in resp['posts']} != set(hashes):
+                print(f"{key} {month}: not all parts found, not compacted")
+                continue
+            frames = [await read_ohlcv_async(post['content'], client) for post in resp['posts']]
+            if sum(len(frame) for frame in frames) != sum(part['rows'] for part in parts):
+                print(f"{key} {month}: parts have missing rows, not compacted")
+                continue
+            df = pd.concat(frames, ignore_index=True)
+            df.drop_duplicates(subset=['timestamp'], inplace=True)
+            df.sort_values('timestamp', inplace=True, kind='stable')
+            df.reset_index(drop=True, inplace=True)
+            del manifest['shards'][month]
+            await post_shards(account, df, work, session=client)
+            await post_manifest(account, work, session=client)
+        except Exception as error:
+            print(f"{key} {month}: {type(error).__name__}: {error}, not compacted")
+            continue
+        state.update(work)
+        compacted += 1
+        if forget:
+            stores = [post['content']['store']['message_hash'] for post in resp['posts']
+                      if 'message_hash' in post['content'].get('store', {})]
+            try:
+                await aleph_client.asynchronous.forget(account, hashes + stores, reason="compacted",
+                                                       channel=CHANNEL, session=client)
+            except Exception as error:
+                # the month is compacted, the parts are only left over
+                print(f"{key} {month}: parts not forgotten: {type(error).__name__}: {error}")
+    return compacted
+
+
+async def ingest_all_async(account, symbols: list, interval="hourly", cursor_file=CURSOR_FILE,
+                           chunk_rows=DEFAULT_CHUNK_ROWS, max_parts=MAX_SHARD_PARTS):
+    """
+    Ingests the new candles of all symbols, saving their cursors after each symbol. Months are compacted in the
+    background while the other symbols are ingested. A symbol which fails does not stop the others.
+    :return: The cursors, and the error of each failed symbol.
+    """
+    cursors = load_cursors(cursor_file)
+    ssl_context = get_ssl_context()
+    async with aiohttp.ClientSession(trust_env=True, connector=aiohttp.TCPConnector(limit_per_host=4)) as client:
+
+        async def ingest(symbol):
+            state = await ingest_symbol(account, client, symbol, interval, cursors, chunk_rows, ssl_context)
+            save_cursors(cursors, cursor_file)
+            if await compact(account, client, state, max_parts):
+                save_cursors(cursors, cursor_file)
+
+        results = await asyncio.gather(*[ingest(symbol) for symbol in symbols], return_exceptions=True)
+    errors = {symbol: result for symbol, result in zip(symbols, results) if isinstance(result, BaseException)}
+    for symbol, error in errors.items():
+        print(f"{symbol}/{interval}: failed: {type(error).__name__}: {error}")
+    return cursors, errors
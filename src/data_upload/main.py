@@ -1,6 +1,8 @@
+import argparse
 import asyncio
 import ssl
 import json
+import sys
 from typing import Union
 
 import certifi
@@ -9,7 +11,8 @@ import pandas as pd
 import aleph_client
 import aleph_client.asynchronous
 from aleph_client.chains.ethereum import get_fallback_account
-from batch import post_all_to_aleph_async
+from incremental import ingest_all_async
+from pipeline import PipelineConfig, run_pipeline
 from data_utils import save_to_file
 
 
@@ -26,7 +29,7 @@ account = get_fallback_account()
 
 currencies = ["BTC", "ETH", "LTC", "NEO", "BNB", "XRP", "LINK",
               "EOS", "TRX", "ETC", "XLM", "ZEC", "ADA", "QTUM",
-              "DASH", "XMR", "BAT", "BTT", "ZEC", "USDC", "TUSD",
+              "DASH", "XMR", "BAT", "BTT", "USDC", "TUSD",
               "MATIC", "PAX", "CELR", "ONE", "DOT", "UNI", "ICP",
               "SOL", "VET", "FIL", "AAVE", "DAI", "MKR", "ICX",
               "CVC", "SC", "LRC"]
@@ -42,9 +45,15 @@ def get_lookup() -> Union[None, dict]:
     return lookup_dict
 
 
-def main():
-    responses = asyncio.get_event_loop().run_until_complete(post_all_to_aleph_async(account, currencies))
-    hashes = [resp['item_hash'] for resp in responses]
+def main_incremental(interval="hourly") -> int:
+    """Posts only the candles since the last run, see `ingest_all_async()`. Returns 1 if any symbol failed."""
+    _, errors = asyncio.get_event_loop().run_until_complete(ingest_all_async(account, currencies, interval))
+    return 1 if errors else 0
+
+
+def main(interval="hourly", config: PipelineConfig = None):
+    results = asyncio.get_event_loop().run_until_complete(run_pipeline(account, currencies, interval, config))
+    hashes = [result.item_hash for result in results.values() if result.item_hash is not None]
     save_to_file("aleph-response.txt", hashes)
 
     resp = aleph_client.create_post(account=account, post_content=hashes, post_type="lookup", channel="TEST-CRYPTODATADOWNLOAD")
@@ -58,5 +67,16 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--incremental', action='store_true',
+                        help='post only the candles since the last run, as monthly shards of per-symbol manifests')
+    parser.add_argument('--interval', default='hourly', choices=['daily', 'hourly', 'minutely'])
+    parser.add_argument('--downloads', type=int, default=PipelineConfig.downloads, help='concurrent downloads')
+    parser.add_argument('--parsers', type=int, default=PipelineConfig.parsers, help='parsing processes')
+    parser.add_argument('--uploads', type=int, default=PipelineConfig.uploads, help='concurrent uploads')
+    args = parser.parse_args()
+    if args.incremental:
+        sys.exit(main_incremental(args.interval))
+    else:
+        main(args.interval, PipelineConfig(downloads=args.downloads, parsers=args.parsers, uploads=args.uploads))
 
@@ -0,0 +1,203 @@
+import base64
+import io
+import json
+import zlib
+from typing import Any, Dict, Optional, Sequence
+
+import aleph_client.asynchronous
+import numpy as np
+import pandas as pd
+
+SCHEMA = 'ohlcv'
+VERSION = 1
+# integer columns which are ordered by time, and compress much better as differences of consecutive values
+DELTA_COLUMNS = ('timestamp', 'unix')
+# encoded payloads above this size are uploaded as a STORE object, and the post only holds its reference
+MAX_INLINE_BYTES = 1_000_000
+CHANNEL = "TEST-CRYPTODATADOWNLOAD"
+# Parquet has no plain zlib codec, its gzip codec is the same deflate compression
+PARQUET_COMPRESSION = {None: 'none', 'zlib': 'gzip'}
+
+
+def compress(data: bytes, compression: Optional[str]) -> bytes:
+    if compression is None:
+        return data
+    if compression == 'zlib':
+        return zlib.compress(data)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError(f"Unknown compression {compression}")
+
+
+def decompress(data: bytes, compression: Optional[str]) -> bytes:
+    if compression is None:
+        return data
+    if compression == 'zlib':
+        return zlib.decompress(data)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown compression {compression}")
+
+
+def encode_ohlcv(df: pd.DataFrame, float32=False, compression: Optional[str] = 'zlib',
+                 delta_columns: Sequence[str] = DELTA_COLUMNS) -> Dict[str, Any]:
+    """
+    Encodes a cleaned OHLCV frame column by column: numeric columns as base64 encoded binary arrays, integer time
+    columns as differences of consecutive values, and string columns with a single value, like the symbol, only once.
+    :param df: The frame to encode, e.g. as cleaned by `clean_time_duplicates()`.
+    :param float32: Whether to store floats in single precision, which halves their size.
+    :param compression: 'zlib', 'zstd' (requires the zstandard package) or None.
+    :param delta_columns: Integer columns to delta encode.
+    """
+    columns = {}
+    constants = {}
+    for name in df.columns:
+        series = df[name]
+        if pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+            values = series.to_numpy()
+            if float32 and values.dtype.kind == 'f':
+                values = values.astype(np.float32)
+            delta = name in delta_columns and values.dtype.kind in 'iu' and len(values) > 0
+            if delta:
+                values = np.diff(values, prepend=values.dtype.type(0))
+            columns[name] = {
+                'dtype': values.dtype.str,
+                'delta': delta,
+                'data': base64.b64encode(compress(np.ascontiguousarray(values).tobytes(), compression)).decode(),
+            }
+        elif series.nunique(dropna=False) == 1:
+            constants[name] = series.iloc[0]
+        else:
+            columns[name] = {'dtype': 'json', 'data': series.tolist()}
+    return {
+        'schema': SCHEMA,
+        'version': VERSION,
+        'rows': len(df),
+        'compression': compression,
+        'order': list(df.columns),
+        'constants': constants,
+        'columns': columns,
+    }
+
+
+def decode_ohlcv(payload: Dict[str, Any]) -> pd.DataFrame:
+    """Decodes a payload of `encode_ohlcv()` into a DataFrame with the columns in their original order."""
+    if payload.get('schema') != SCHEMA or payload.get('version', 0) > VERSION:
+        raise ValueError(f"Unsupported payload {payload.get('schema')} version {payload.get('version')}")
+    rows = payload['rows']
+    data = {}
+    for name in payload['order']:
+        if name in payload['constants']:
+            data[name] = np.full(rows, payload['constants'][name], dtype=object)
+            continue
+        column = payload['columns'][name]
+        if column['dtype'] == 'json':
+            data[name] = column['data']
+            continue
+        values = np.frombuffer(decompress(base64.b64decode(column['data']), payload['compression']),
+                               dtype=np.dtype(column['dtype']))
+        data[name] = np.cumsum(values, dtype=values.dtype) if column.get('delta') else values
+    return pd.DataFrame(data, columns=payload['order'])
+
+
+def summarize(df: pd.DataFrame) -> Dict[str, Any]:
+    """Summary of a series which is posted with it, to be read without downloading the data."""
+    summary: Dict[str, Any] = {'rows': len(df)}
+    if len(df) and 'timestamp' in df:
+        summary['first_timestamp'] = int(df['timestamp'].iloc[0])
+        summary['last_timestamp'] = int(df['timestamp'].iloc[-1])
+    for name in ('open', 'high', 'low', 'close'):
+        if len(df) and name in df:
+            summary[name] = {'min': float(df[name].min()), 'max': float(df[name].max()),
+                             'mean': float(df[name].mean())}
+    return summary
+
+
+def to_store_file(df: pd.DataFrame, float32=False, compression: Optional[str] = 'zlib', encoded: str = None):
+    """
+    Serializes a series for a STORE object: as Parquet if pyarrow is installed, otherwise as the JSON of its
+    `encode_ohlcv()` payload, which may be given as `encoded`.
+    :return: The format and the content of the file.
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        if encoded is None:
+            encoded = json.dumps(encode_ohlcv(df, float32, compression), separators=(',', ':'))
+        return 'ohlcv+json', encoded.encode()
+    if float32:
+        df = df.astype({name: np.float32 for name in df.columns if df[name].dtype.kind == 'f'})
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, index=False, compression=PARQUET_COMPRESSION.get(compression, compression))
+    return 'parquet', buffer.getvalue()
+
+
+def from_store_file(file_format: str, content: bytes) -> pd.DataFrame:
+    if file_format == 'parquet':
+        return pd.read_parquet(io.BytesIO(content))
+    if file_format == 'ohlcv+json':
+        return decode_ohlcv(json.loads(content))
+    raise ValueError(f"Unknown file format {file_format}")
+
+
+def prepare_ohlcv(df: pd.DataFrame, symbol, interval, float32=False, compression='zlib',
+                  max_inline_bytes=MAX_INLINE_BYTES, extra: Optional[Dict[str, Any]] = None):
+    """
+    Encodes a series for `upload_ohlcv_async()`, without any I/O, so that it can run in a process pool.
+    :return: The content of the post, and the format and content of its STORE file, if it is too large to be inline.
+    """
+    content = {'symbol': symbol, 'interval': interval, 'summary': summarize(df), **(extra or {})}
+    payload = encode_ohlcv(df, float32, compression)
+    encoded = json.dumps(payload, separators=(',', ':'))
+    if len(encoded) <= max_inline_bytes:
+        content['data'] = payload
+        return content, None
+    return content, to_store_file(df, float32, compression, encoded)
+
+
+async def store_ohlcv_async(account, content: Dict[str, Any], store_file, session=None) -> Dict[str, Any]:
+    """
+    Uploads the STORE object of a series prepared by `prepare_ohlcv()`, and returns the content referencing it: the
+    hash of the file, by which it is downloaded, and the hash of the STORE message, by which it is forgotten.
+    """
+    file_format, file_content = store_file
+    store = await aleph_client.asynchronous.create_store(account=account, file_content=file_content, channel=CHANNEL,
+                                                         session=session)
+    return {**content, 'store': {'item_hash': store['content']['item_hash'], 'message_hash': store['item_hash'],
+                                 'format': file_format}}
+
+
+async def upload_ohlcv_async(account, content: Dict[str, Any], store_file=None, post_type="ohlcv_timeseries",
+                             **kwargs):
+    """Uploads a series prepared by `prepare_ohlcv()`, with its STORE object first if it has one."""
+    if store_file is not None:
+        content = await store_ohlcv_async(account, content, store_file, kwargs.get('session'))
+    return await aleph_client.asynchronous.create_post(account=account, post_content=content,
+                                                       post_type=post_type, channel=CHANNEL, **kwargs)
+
+
+async def post_ohlcv_async(account, df: pd.DataFrame, symbol, interval, float32=False, compression='zlib',
+                           max_inline_bytes=MAX_INLINE_BYTES, extra: Optional[Dict[str, Any]] = None,
+                           post_type="ohlcv_timeseries", **kwargs):
+    """
+    Posts a series with the encoded data, or, if it is larger than `max_inline_bytes`, uploads it as a STORE object
+    and posts only its reference and summary.
+    :param extra: Additional fields of the post content.
+    :param kwargs: Passed on to aleph_client, e.g. `ref` to amend a post, or `session`.
+    """
+    content, store_file = prepare_ohlcv(df, symbol, interval, float32, compression, max_inline_bytes, extra)
+    return await upload_ohlcv_async(account, content, store_file, post_type, **kwargs)
+
+
+async def read_ohlcv_async(content: Dict[str, Any], session, api_server=None) -> pd.DataFrame:
+    """Returns the series of the content of an `ohlcv_timeseries` post, downloading its STORE object if needed."""
+    if 'data' in content:
+        return decode_ohlcv(content['data'])
+    if api_server is None:
+        from aleph_client.conf import settings
+        api_server = settings.API_HOST
+    async with session.get(f"{api_server}/api/v0/storage/raw/{content['store']['item_hash']}") as response:
+        response.raise_for_status()
+        return from_store_file(content['store']['format'], await response.read())
@@ -0,0 +1,252 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+import pandas as pd
+
+from batch import DEFAULT_CHUNK_ROWS, get_download_url, get_ssl_context, iter_csv_blocks, parse_csv_block
+from data_utils import clean_time_duplicates
+from ohlcv import prepare_ohlcv, store_ohlcv_async, upload_ohlcv_async
+
+SUMMARY_FILE = 'run_summary.json'
+
+
+@dataclass
+class PipelineConfig:
+    """
+    :param downloads: Number of files downloaded at the same time.
+    :param parsers: Number of processes parsing, cleaning and encoding files.
+    :param uploads: Number of posts uploaded at the same time.
+    :param queue_size: Number of chunks which may wait to be parsed, and of encoded files which may wait to be
+        uploaded, which bounds the memory of a run.
+    :param chunk_rows: Number of rows of the chunks which files are downloaded and parsed in.
+    :param retries: Number of retries of the download and upload of a symbol.
+    :param retry_delay: Seconds before the first retry, doubled for each further one.
+    """
+    downloads: int = 4
+    parsers: int = 2
+    uploads: int = 4
+    queue_size: int = 4
+    chunk_rows: int = DEFAULT_CHUNK_ROWS
+    retries: int = 3
+    retry_delay: float = 1.0
+    float32: bool = False
+    compression: Optional[str] = 'zlib'
+
+
+@dataclass
+class StageStats:
+    items: int = 0
+    failed: int = 0
+    retries: int = 0
+    bytes: int = 0
+    rows: int = 0
+    # seconds spent in the stage, summed over its concurrent workers
+    busy_seconds: float = 0.0
+
+
+@dataclass
+class SymbolResult:
+    symbol: str
+    item_hash: Optional[str] = None
+    rows: int = 0
+    unparseable_rows: int = 0
+    error: Optional[str] = None
+    # of the download and the upload together
+    attempts: int = 0
+
+
+def parse_chunk(block: bytes):
+    """Parses and cleans a block of `iter_csv_blocks()`. Runs in the process pool, like `encode_symbol()`."""
+    df = parse_csv_block(block)
+    failed = clean_time_duplicates(df)
+    return df, failed
+
+
+def encode_symbol(frames: List[pd.DataFrame], symbol, interval, float32=False, compression='zlib'):
+    """
+    Merges the cleaned chunks of a file and encodes them. As a symbol is posted as one series, this is the only step
+    which holds the whole series in memory, but only its numeric columns instead of the text of the file.
+    """
+    if not frames:
+        raise ValueError("Empty file")
+    df = pd.concat(frames, ignore_index=True)
+    # chunks are cleaned on their own, so duplicates across chunks are left
+    df.drop_duplicates(subset=['timestamp'], inplace=True)
+    df.sort_values('timestamp', inplace=True, kind='stable')
+    df.reset_index(drop=True, inplace=True)
+    content, store_file = prepare_ohlcv(df, symbol, interval, float32, compression)
+    return content, store_file, len(df)
+
+
+async def _with_retries(stats: StageStats, result: SymbolResult, config: PipelineConfig, func):
+    for attempt in range(config.retries + 1):
+        result.attempts += 1
+        try:
+            return await func()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as error:
+            # client errors, like a missing file, are not worth retrying
+            client_error = isinstance(error, aiohttp.ClientResponseError) and error.status < 500 and error.status != 429
+            if attempt == config.retries or client_error:
+                raise
+            stats.retries += 1
+            await asyncio.sleep(config.retry_delay * 2 ** attempt)
+
+
+async def run_pipeline(account, symbols: List[str], interval="hourly", config: PipelineConfig = None,
+                       summary_file=SUMMARY_FILE) -> Dict[str, SymbolResult]:
+    """
+    Downloads, parses and uploads the history of each symbol in three stages, which are connected by bounded queues,
+    so that downloads and uploads overlap with the parsing of other files. Files are streamed to the parsers in
+    chunks of `config.chunk_rows` rows. Parsing runs in a process pool, so that it does not block the event loop.
+    A failing symbol is retried on its own and does not stop the others. Downloads are retried until their response
+    arrives, a download which fails while streaming fails its symbol.
+
+    A summary of the run, with the throughput of each stage, is written to `summary_file`.
+    :return: The result of each symbol, in the order of `symbols` without duplicates.
+    """
+    config = config or PipelineConfig()
+    symbols = list(dict.fromkeys(symbols))
+    results = {symbol: SymbolResult(symbol) for symbol in symbols}
+    stats = {'download': StageStats(), 'parse': StageStats(), 'upload': StageStats()}
+    downloaded: asyncio.Queue = asyncio.Queue(config.queue_size)
+    parsed: asyncio.Queue = asyncio.Queue(config.queue_size)
+    pending: asyncio.Queue = asyncio.Queue()
+    # the cleaned chunks of each symbol which is being parsed, by their position in the file
+    chunks: Dict[str, Dict[str, Any]] = {}
+    for symbol in symbols:
+        pending.put_nowait(symbol)
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+
+    def fail(stage: str, symbol: str, error: Exception):
+        # only the first error of a symbol, as its download may fail after one of its chunks
+        if results[symbol].error is None:
+            stats[stage].failed += 1
+            results[symbol].error = f"{stage}: {type(error).__name__}: {error}"
+
+    async def download(client: aiohttp.ClientSession):
+        while not pending.empty():
+            symbol = pending.get_nowait()
+            began = time.perf_counter()
+            waited = 0.0
+            position = 0
+
+            async def get():
+                response = await client.get(get_download_url(symbol, interval), ssl=get_ssl_context())
+                try:
+                    response.raise_for_status()
+                except aiohttp.ClientResponseError:
+                    response.release()
+                    raise
+                return response
+
+            try:
+                async with await _with_retries(stats['download'], results[symbol], config, get) as response:
+                    async for block in iter_csv_blocks(response.content, config.chunk_rows):
+                        stats['download'].bytes += len(block)
+                        put = time.perf_counter()
+                        await downloaded.put((symbol, position, block))
+                        waited += time.perf_counter() - put
+                        position += 1
+                stats['download'].items += 1
+            except Exception as error:
+                fail('download', symbol, error)
+            finally:
+                stats['download'].busy_seconds += time.perf_counter() - began - waited
+            # tells the parsers how many chunks the file has, or that it failed
+            await downloaded.put((symbol, position, None))
+
+    async def parse(executor: ProcessPoolExecutor):
+        while True:
+            symbol, position, block = await downloaded.get()
+            began = time.perf_counter()
+            waited = 0.0
+            try:
+                if results[symbol].error is not None:
+                    chunks.pop(symbol, None)
+                    continue
+                state = chunks.setdefault(symbol, {'frames': {}, 'count': None, 'failed': 0})
+                if block is None:
+                    state['count'] = position
+                else:
+                    state['frames'][position], failed = await loop.run_in_executor(executor, parse_chunk, block)
+                    state['failed'] += failed
+                # the last parsed chunk of a file encodes it, as its chunks are parsed concurrently
+                if state['count'] is None or len(state['frames']) < state['count'] or results[symbol].error:
+                    continue
+                del chunks[symbol]
+                frames = [state['frames'][i] for i in range(state['count'])]
+                content, store_file, rows = await loop.run_in_executor(
+                    executor, encode_symbol, frames, symbol, interval, config.float32, config.compression)
+                results[symbol].rows, results[symbol].unparseable_rows = rows, state['failed']
+                stats['parse'].items += 1
+                stats['parse'].rows += rows
+                # done only once it is queued for upload, so that the uploads are awaited after the last parse
+                put = time.perf_counter()
+                await parsed.put((symbol, content, store_file))
+                waited = time.perf_counter() - put
+            except Exception as error:
+                chunks.pop(symbol, None)
+                fail('parse', symbol, error)
+            finally:
+                stats['parse'].busy_seconds += time.perf_counter() - began - waited
+                downloaded.task_done()
+
+    async def upload(client: aiohttp.ClientSession):
+        while True:
+            symbol, content, store_file = await parsed.get()
+            began = time.perf_counter()
+            try:
+                # the STORE object and the post are retried on their own, so that a failed post does not upload the
+                # STORE object again
+                if store_file is not None:
+                    content = await _with_retries(stats['upload'], results[symbol], config,
+                                                  lambda: store_ohlcv_async(account, content, store_file, client))
+                resp = await _with_retries(stats['upload'], results[symbol], config,
+                                           lambda: upload_ohlcv_async(account, content, session=client))
+                results[symbol].item_hash = resp['item_hash']
+                stats['upload'].items += 1
+                stats['upload'].rows += results[symbol].rows
+            except Exception as error:
+                fail('upload', symbol, error)
+            finally:
+                stats['upload'].busy_seconds += time.perf_counter() - began
+                parsed.task_done()
+
+    connector = aiohttp.TCPConnector(limit_per_host=max(config.downloads, config.uploads))
+    async with aiohttp.ClientSession(trust_env=True, connector=connector) as client:
+        with ProcessPoolExecutor(config.parsers) as executor:
+            parsers = [asyncio.ensure_future(parse(executor)) for _ in range(config.parsers)]
+            uploaders = [asyncio.ensure_future(upload(client)) for _ in range(config.uploads)]
+            await asyncio.gather(*[download(client) for _ in range(config.downloads)])
+            await downloaded.join()
+            await parsed.join()
+            for worker in parsers + uploaders:
+                worker.cancel()
+            await asyncio.gather(*parsers, *uploaders, return_exceptions=True)
+
+    write_summary(summary_file, symbols, interval, config, stats, results, time.perf_counter() - start)
+    return results
+
+
+def write_summary(filename, symbols, interval, config: PipelineConfig, stats: Dict[str, StageStats],
+                  results: Dict[str, SymbolResult], seconds: float):
+    rows = stats['upload'].rows
+    summary: Dict[str, Any] = {
+        'interval': interval,
+        'symbols': len(symbols),
+        'succeeded': sum(result.item_hash is not None for result in results.values()),
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(rows / seconds, 2) if seconds else None,
+        'download_mb_per_sec': round(stats['download'].bytes / 2 ** 20 / seconds, 3) if seconds else None,
+        'config': asdict(config),
+        'stages': {name: asdict(stage) for name, stage in stats.items()},
+        'results': [asdict(result) for result in results.values()],
+    }
+    with open(filename, "w") as file:
+        file.write(json.dumps(summary, indent=2))
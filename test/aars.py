@@ -1,7 +1,18 @@
 import asyncio
+import json
+import os
+import subprocess
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from typing import List
 
-from src.aars import Record, Index, AlreadyForgottenError
+from src.aars import Record, Index, RangeIndex, AlreadyForgottenError, AlephClient, RecordCache, \
+    set_cache, PostStore, set_store, set_default_client, metrics, set_call_budget, set_trusted_reads, Ref, \
+    resolve_refs, set_coalescing, AccountPool
+from src.aars.exceptions import CallBudgetExceeded
+from src.aars.testing import LocalAlephClient
 import pytest
 
 
@@ -15,6 +26,15 @@ def event_loop():
     loop.close()
 
 
+@pytest.fixture(scope="session", autouse=True)
+def local_aleph():
+    """Runs the tests against an in-process stand-in of Aleph if AARS_LOCAL is set, otherwise against the network."""
+    if os.environ.get('AARS_LOCAL'):
+        set_default_client(LocalAlephClient())
+    yield
+    set_default_client(None)
+
+
 class Book(Record):
     title: str
     author: str
@@ -25,6 +45,16 @@ class Library(Record):
     books: List[Book]
 
 
+class Shelf(Record):
+    name: str
+    books: List[Ref[Book]]
+
+
+class Candle(Record):
+    timestamp: datetime
+    volume: float
+
+
 @pytest.mark.asyncio
 async def test_store_and_index():
     Index(Book, 'title')
@@ -43,12 +73,112 @@ async def test_multi_index():
     assert new_book == fetched_book
 
 
+@pytest.mark.asyncio
+async def test_multi_valued_index():
+    Index(Book, 'author')
+    first = await Book.create(title='Dune', author='Frank Herbert')
+    second = await Book.create(title='Dune Messiah', author='Frank Herbert')
+    fetched = await Book.query(author='Frank Herbert')
+    assert first in fetched and second in fetched
+    second.author = 'Brian Herbert'
+    await second.upsert()
+    assert second.item_hash not in {book.item_hash for book in await Book.query(author='Frank Herbert')}
+
+
+@pytest.mark.asyncio
+async def test_index_snapshot():
+    index = Index(Book, 'title')
+    await Book.create(title='Hyperion', author='Dan Simmons')
+    restored = Index(Book, 'title')
+    restored.load_snapshot(index.snapshot())
+    assert restored.hashmap == index.hashmap
+
+
+@pytest.mark.asyncio
+async def test_range_index():
+    RangeIndex(Candle, 'timestamp')
+    start = datetime(2022, 1, 1)
+    await asyncio.gather(*[Candle.create(timestamp=start + timedelta(hours=i), volume=i) for i in range(10)])
+    window = await Candle.query_range('timestamp', lo=start + timedelta(hours=2), hi=start + timedelta(hours=5))
+    assert [candle.volume for candle in window] == [2, 3, 4, 5]
+    latest = await Candle.query_range('timestamp', limit=1, reverse=True)
+    assert latest[0].volume == 9
+
+
+def test_content_and_snapshot_are_json_serializable():
+    class Reading(Record):
+        taken: datetime
+        value: float
+
+    reading = Reading(taken=datetime(2022, 1, 1, 12), value=1.5, item_hash='a' * 64)
+    content = json.loads(json.dumps(reading.content))
+    assert Reading(**content).taken == reading.taken
+    index = Index(Reading, 'taken')
+    index.add(reading)
+    replica = Index(Reading, 'taken')
+    replica.load_snapshot(json.loads(json.dumps(index.snapshot())))
+    assert replica.lookup(OrderedDict(taken=reading.taken)) == {reading.item_hash}
+
+
+def test_range_index_bulk_changes():
+    class Tick(Record):
+        value: int
+
+    index = RangeIndex(Tick, 'value')
+    ticks = [Tick(value=(i * 7919) % 1000, item_hash=f'{i:064x}') for i in range(1000)]
+    index.add_many(ticks)
+    index.add_many(ticks[:10])
+    assert list(index.range()) == [tick.item_hash for tick in sorted(ticks, key=lambda tick: tick.value)]
+    index.discard([tick.item_hash for tick in ticks[:600]])
+    index.remove(ticks[600])
+    assert list(index.range()) == [tick.item_hash for tick in sorted(ticks[601:], key=lambda tick: tick.value)]
+
+
+@pytest.mark.asyncio
+async def test_index_intersection():
+    Index(Book, 'title')
+    Index(Book, 'author')
+    new_book = await Book.create(title='Ubik', author='Philip K. Dick')
+    await Book.create(title='Ubik', author='Someone Else')
+    plan = await Book.explain(title='Ubik', author='Philip K. Dick')
+    assert set(plan.indices) <= {'Book.author', 'Book.title', 'Book.author.title'}
+    assert plan.residual == []
+    assert plan.actual_rows == plan.estimated_rows
+    assert new_book in await Book.query(title='Ubik', author='Philip K. Dick')
+
+
 @pytest.mark.asyncio
 async def test_fetch_all():
     books = await Book.fetch_all()
     assert len(books) > 0
 
 
+@pytest.mark.asyncio
+async def test_iter_all():
+    books = [book async for book in Book.iter_all(page_size=2)]
+    assert len(books) == len(await Book.fetch_all())
+
+
+@pytest.mark.asyncio
+async def test_trusted_reads_and_projection():
+    library = await Library.create(name='Babel', books=[Book(title='Ficciones', author='Jorge Luis Borges')])
+    set_trusted_reads(True)
+    try:
+        fetched = (await Library.get(library.item_hash))[0]
+    finally:
+        set_trusted_reads(False)
+    assert isinstance(fetched.books[0], Book)
+    assert fetched.content == library.content
+    projected = (await Library.get(library.item_hash, fields=['name']))[0]
+    assert projected.name == 'Babel'
+    assert 'books' not in projected.__dict__
+    with pytest.raises(ValueError):
+        await projected.upsert()
+    results = await Library.upsert_many([projected])
+    assert isinstance(results[0].error, ValueError)
+    assert projected.revision_hashes == [library.item_hash]
+
+
 @pytest.mark.asyncio
 async def test_amending_record():
     book = await Book.create(title='Neurodancer', author='William Gibson')
@@ -61,6 +191,69 @@ async def test_amending_record():
     assert book.revision_hashes[1] != book.item_hash
 
 
+@pytest.mark.asyncio
+async def test_revision_history():
+    book = await Book.create(title='Neurodancer', author='William Gibson')
+    book.title = 'Neuromancer'
+    await book.upsert()
+    book.title = 'Neuromancer (2nd edition)'
+    await book.upsert()
+    await book.fetch_revision(rev_no=0)
+    assert book.title == 'Neurodancer'
+    await book.fetch_revision(rev_hash=book.revision_hashes[1])
+    assert book.title == 'Neuromancer'
+    assert book.current_revision == 1
+    revisions = [revision async for revision in book.iter_revisions(page_size=2)]
+    assert [revision.title for revision in revisions] == ['Neurodancer', 'Neuromancer', 'Neuromancer (2nd edition)']
+    assert [revision.current_revision for revision in revisions] == [0, 1, 2]
+
+
+@pytest.mark.asyncio
+async def test_fetch_amended_records():
+    book = await Book.create(title='Neurodancer', author='William Gibson')
+    book.title = 'Neuromancer'
+    await book.upsert()
+    other = await Book.create(title='Count Zero', author='William Gibson')
+    fetched = await Book.get([book.item_hash, other.item_hash])
+    by_hash = {record.item_hash: record for record in fetched}
+    assert by_hash[book.item_hash].revision_hashes == book.revision_hashes
+    assert by_hash[other.item_hash].revision_hashes == [other.item_hash]
+
+
+@pytest.mark.asyncio
+async def test_cached_get():
+    cache = RecordCache()
+    set_cache(cache)
+    try:
+        book = await Book.create(title='Snow Crash', author='Neal Stephenson')
+        first = (await Book.get(book.item_hash))[0]
+        hits = cache.stats.hits
+        second = (await Book.get(book.item_hash))[0]
+        assert first == second
+        assert cache.stats.hits > hits
+        book.title = 'Snow Crash (2nd edition)'
+        await book.upsert()
+        assert (await Book.get(book.item_hash))[0].revision_hashes == book.revision_hashes
+    finally:
+        set_cache(None)
+
+
+@pytest.mark.asyncio
+async def test_persistent_store(tmp_path):
+    store = PostStore(str(tmp_path / 'aars.db'))
+    set_store(store)
+    try:
+        book = await Book.create(title='Solaris', author='Stanislaw Lem')
+        books = await Book.fetch_all()
+        assert book in books
+        assert store.last_synced('Book', ['AARS_TEST']) is not None
+        offline_store = PostStore(str(tmp_path / 'aars.db'), offline=True)
+        set_store(offline_store)
+        assert len(await Book.fetch_all()) == len(books)
+    finally:
+        set_store(None)
+
+
 @pytest.mark.asyncio
 async def test_store_and_index_record_of_records():
     Index(Library, on='name')
@@ -73,6 +266,310 @@ async def test_store_and_index_record_of_records():
     assert new_library == fetched_library
 
 
+@pytest.mark.asyncio
+async def test_create_many():
+    Index(Book, 'author')
+    items = ({'title': f'Volume {i}', 'author': 'Bulk Writer'} for i in range(5))
+    results = await Book.create_many(items, max_in_flight=2)
+    assert all(result.ok for result in results)
+    assert [result.record.title for result in results] == [f'Volume {i}' for i in range(5)]
+    fetched = await Book.query(author='Bulk Writer')
+    assert {result.record.item_hash for result in results} <= {book.item_hash for book in fetched}
+
+
+@pytest.mark.asyncio
+async def test_upsert_many_of_mixed_types():
+    index = Index(Book, 'author')
+    book = Book(title='Kindred', author='Octavia Butler')
+    results = await Record.upsert_many([book, Shelf(name='Fiction', books=[])])
+    assert all(result.ok and result.attempts == 1 for result in results)
+    assert book.item_hash in index.lookup(OrderedDict(author='Octavia Butler'))
+
+
+@pytest.mark.asyncio
+async def test_create_many_reports_invalid_items():
+    results = await Book.create_many([{'title': 'No Author'}])
+    assert not results[0].ok
+    assert results[0].record is None
+
+
+@pytest.mark.asyncio
+async def test_bound_client():
+    class Magazine(Record):
+        title: str
+
+    local = bool(os.environ.get('AARS_LOCAL'))
+    if local:
+        client = LocalAlephClient()
+    else:
+        # imported here, as the fallback account creates its key file when it is first loaded
+        from src.aars import FALLBACK_ACCOUNT
+        client = AlephClient(FALLBACK_ACCOUNT, channel='AARS_TEST')
+    async with client:
+        Magazine.bind(client)
+        magazine = await Magazine.create(title='Wired')
+        magazine.title = 'WIRED'
+        await magazine.upsert()
+        assert (await Magazine.get(magazine.item_hash))[0].item_hash == magazine.item_hash
+        assert client.stats.requests >= 3
+        if not local:
+            assert client.stats.connections_reused > 0
+
+
+
+def test_client_session_per_event_loop():
+    client = AlephClient(None, channel='AARS_TEST', api_server='http://localhost')
+
+    async def open_session():
+        return client.session
+
+    first = asyncio.run(open_session())
+    second = asyncio.run(open_session())
+    assert first.closed and second is not first
+    asyncio.run(client.close())
+    assert second.closed
+
+
+@pytest.mark.asyncio
+async def test_client_releases_connections_during_backoff():
+    from aiohttp import ClientConnectionError
+    client = AlephClient(None, channel='AARS_TEST', api_server='http://localhost', max_connections=1)
+    attempts = []
+
+    async def flaky():
+        attempts.append('flaky')
+        if len(attempts) == 1:
+            raise ClientConnectionError()
+        return 'retried'
+
+    async def other():
+        attempts.append('other')
+        return 'answered'
+
+    async with client:
+        results = await asyncio.gather(client._request('flaky', flaky, retries=1), client._request('other', other))
+    assert results == ['retried', 'answered']
+    # answered while the first request waits for its retry
+    assert attempts == ['flaky', 'other', 'flaky']
+    assert client.stats.retries == 1
+
+@pytest.mark.asyncio
+async def test_metrics_and_call_budget():
+    book = await Book.create(title='Dune', author='Frank Herbert')
+    await Book.get(book.item_hash)
+    exported = metrics.to_prometheus()
+    assert '# TYPE aars_remote_calls_total counter' in exported
+    assert 'aars_operation_seconds_count{operation="fetch_records"}' in exported
+    set_call_budget(0, strict=True)
+    try:
+        with pytest.raises(CallBudgetExceeded):
+            await Book.get(book.item_hash)
+    finally:
+        set_call_budget(None)
+
+
+@pytest.mark.asyncio
+async def test_referenced_records():
+    books = [await Book.create(title=title, author='Ursula K. Le Guin')
+             for title in ('The Dispossessed', 'The Lathe of Heaven')]
+    shelf = await Shelf.create(name='Hainish', books=books)
+    assert shelf.content['books'] == [book.item_hash for book in books]
+    fetched = (await Shelf.get(shelf.item_hash))[0]
+    assert not fetched.books[0].resolved
+    assert (await fetched.books[0].fetch()).title == 'The Dispossessed'
+    resolved = await Shelf.get(shelf.item_hash, resolve=1)
+    assert [book.record.title for book in resolved[0].books] == ['The Dispossessed', 'The Lathe of Heaven']
+
+
+@pytest.mark.asyncio
+async def test_resolve_nested_refs():
+    class Tome(Record):
+        title: str
+
+    class Case(Record):
+        tomes: List[Ref[Tome]]
+
+    class Room(Record):
+        cases: List[Ref[Case]]
+
+    client = LocalAlephClient()
+    for datatype in (Tome, Case, Room):
+        datatype.bind(client)
+    tomes = [await Tome.create(title=f'Tome {i}') for i in range(3)]
+    cases = [await Case.create(tomes=tomes[:2]), await Case.create(tomes=tomes[1:])]
+    room = (await Room.get((await Room.create(cases=cases)).item_hash))[0]
+    calls = client.calls['get_posts']
+    await resolve_refs([room], depth=2)
+    # the cases, then all their tomes together, each with a request for the posts and one for their revisions
+    assert client.calls['get_posts'] - calls == 4
+    assert [[tome.record.title for tome in case.record.tomes] for case in room.cases] == \
+        [['Tome 0', 'Tome 1'], ['Tome 1', 'Tome 2']]
+
+
+@pytest.mark.asyncio
+async def test_coalesced_get():
+    class Pamphlet(Record):
+        title: str
+
+    client = LocalAlephClient()
+    Pamphlet.bind(client)
+    pamphlets = [await Pamphlet.create(title=f'Pamphlet {i}') for i in range(10)]
+    calls = client.calls['get_posts']
+    fetched = await asyncio.gather(*(Pamphlet.get(pamphlets[i % 10].item_hash) for i in range(50)))
+    assert [records[0].item_hash for records in fetched] == [pamphlets[i % 10].item_hash for i in range(50)]
+    # one request for the posts and one for their revisions
+    assert client.calls['get_posts'] - calls == 2
+    set_coalescing(None)
+    try:
+        calls = client.calls['get_posts']
+        await asyncio.gather(*(Pamphlet.get(pamphlet.item_hash) for pamphlet in pamphlets))
+        assert client.calls['get_posts'] - calls == 20
+    finally:
+        set_coalescing(0)
+
+
+@pytest.mark.asyncio
+async def test_server_page_size_cap():
+    class Flyer(Record):
+        title: str
+
+    Flyer.bind(LocalAlephClient(max_page_size=10))
+    index = Index(Flyer, 'title')
+    flyers = [await Flyer.create(title=f'Flyer {i}') for i in range(25)]
+    assert len([flyer async for flyer in Flyer.iter_all(page_size=20)]) == 25
+    hashes = [flyer.item_hash for flyer in flyers]
+    assert [flyer.item_hash for flyer in await Flyer.get(hashes)] == hashes
+    set_coalescing(None)
+    try:
+        assert [flyer.item_hash for flyer in await Flyer.get(hashes)] == hashes
+    finally:
+        set_coalescing(0)
+    await index.rebuild(page_size=20)
+    assert len(index.lookup()) == 25
+
+
+@pytest.mark.asyncio
+async def test_watch():
+    class Leaflet(Record):
+        title: str
+
+    Leaflet.bind(LocalAlephClient())
+    index = Index(Leaflet, 'title')
+    draft = await Leaflet.create(title='Draft')
+    async with Leaflet.watch(stream=False, poll_interval=0.01) as feed:
+        assert (await feed.__anext__()).record.title == 'Draft'
+        draft.title = 'Final'
+        await draft.upsert()
+        await draft.forget()
+        changes = [await asyncio.wait_for(feed.__anext__(), 1) for _ in range(2)]
+    assert [change.kind for change in changes] == ['amend', 'forget']
+    assert draft.item_hash in changes[1].forgotten
+    assert index.lookup() == set()
+    await Leaflet.create(title='Reprint')
+    async with Leaflet.watch(cursor=feed.cursor) as resumed:
+        assert (await asyncio.wait_for(resumed.__anext__(), 1)).record.title == 'Reprint'
+
+
+@pytest.mark.asyncio
+async def test_watch_amends_carry_revision_chain():
+    class Notice(Record):
+        title: str
+
+    Notice.bind(LocalAlephClient())
+    notice = await Notice.create(title='Draft 0')
+    async with Notice.watch(stream=False, poll_interval=0.01) as feed:
+        await asyncio.wait_for(feed.__anext__(), 1)
+        for i in range(1, 4):
+            notice.title = f'Draft {i}'
+            await notice.upsert()
+        changes = [await asyncio.wait_for(feed.__anext__(), 1) for _ in range(3)]
+    assert [len(change.record.revision_hashes) for change in changes] == [4, 4, 4]
+    assert changes[-1].record.revision_hashes == notice.revision_hashes
+    assert [change.record.current_revision for change in changes] == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_publish_and_bootstrap_index_snapshot():
+    class Zine(Record):
+        title: str
+
+    Zine.bind(LocalAlephClient())
+    index = Index(Zine, 'title')
+    zines = [await Zine.create(title=f'Zine {i % 3}') for i in range(7)]
+    await index.rebuild()
+    snapshot = await index.publish_snapshot(chunk_size=3)
+    assert len(snapshot.chunks) == 3
+    assert snapshot.entries == 7
+    zines[0].title = 'Zine 9'
+    await zines[0].upsert()
+    replica = Index(Zine, 'title')
+    replica._reset()
+    await replica.bootstrap(snapshot.item_hash)
+    assert replica.lookup(OrderedDict(title='Zine 9')) == {zines[0].item_hash}
+    assert len(replica.lookup()) == 7
+
+
+@pytest.mark.asyncio
+async def test_array_field():
+    np = pytest.importorskip('numpy')
+    from src.aars.arrays import Array, ArrayField
+
+    class Series(Record):
+        timestamps: ArrayField(dtype='int64', delta=True, compression='zlib')
+        values: ArrayField(dtype='float32', shape=(None,))
+        matrix: Array = None
+
+    timestamps = np.arange(1000, dtype=np.int64) * 60_000 + 1_600_000_000_000
+    series = await Series.create(timestamps=timestamps, values=np.linspace(0, 1, 1000), matrix=[[1, 2], [3, 4]])
+    assert series.content['timestamps']['delta'] is True
+    assert series.content['values']['dtype'] == '<f4'
+    fetched = (await Series.get(series.item_hash))[0]
+    assert fetched.timestamps.dtype == np.int64 and (fetched.timestamps == timestamps).all()
+    assert (fetched.values == np.linspace(0, 1, 1000, dtype=np.float32)).all()
+    assert fetched.matrix.shape == (2, 2) and fetched.matrix[1, 0] == 3
+    with pytest.raises(ValueError):
+        Series(timestamps=timestamps, values=np.zeros((2, 2)))
+    with pytest.raises(ValueError):
+        ArrayField(dtype='float64', delta=True)
+
+
+@pytest.mark.asyncio
+async def test_signing_executor_and_account_pool():
+    from aleph_client.chains.common import generate_key, get_verification_buffer
+    from aleph_client.chains.ethereum import ETHAccount
+    from eth_account import Account
+    from eth_account.messages import encode_defunct
+
+    class Leaflet(Record):
+        title: str
+
+    accounts = [ETHAccount(generate_key()) for _ in range(2)]
+    with ThreadPoolExecutor(2) as executor:
+        client = LocalAlephClient(account=AccountPool(accounts), signing_executor=executor)
+        Leaflet.bind(client)
+        leaflets = [result.record for result in await Leaflet.create_many({'title': f'Leaflet {i}'} for i in range(4))]
+        await leaflets[0].forget()
+        message = await client._sign('POST', {'title': 'Leaflet'})
+        # rejected like by aleph_client, instead of being posted as a string
+        with pytest.raises(TypeError):
+            await client._sign('POST', {'published': datetime(2022, 1, 1)})
+    senders = [message['sender'] for message in client.messages]
+    assert sorted(senders[:4]) == sorted([account.get_address() for account in accounts] * 2)
+    assert all(post['address'] == accounts[0].get_address() for post in client.posts.values())
+    signer = Account.recover_message(encode_defunct(text=get_verification_buffer(message).decode()),
+                                     signature=message['signature'])
+    assert signer == message['sender']
+    assert len(await Leaflet.fetch_all()) == 3
+
+
+def test_lazy_import():
+    script = 'import sys, src.aars; print(" ".join(sorted({"aiohttp", "eth_account", "pkg_resources"} & set(sys.modules))))'
+    loaded = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout.split()
+    assert loaded == []
+    from src.aars import __version__
+    assert __version__
+
+
 @pytest.mark.asyncio
 async def test_forget_object():
     forgettable_book = await Book.create(title="The Forgotten Book", author="Mechthild Gläser")  # I'm sorry.
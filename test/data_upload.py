@@ -0,0 +1,133 @@
+import copy
+import functools
+import hashlib
+import os
+import sys
+
+import aiohttp
+import aleph_client.asynchronous
+import aleph_client.conf
+import numpy as np
+import pandas as pd
+import pytest
+import pytest_asyncio
+from aiohttp import web
+
+# the scripts of data_upload import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'data_upload'))
+
+import incremental  # noqa: E402
+from ohlcv import from_store_file, post_ohlcv_async, prepare_ohlcv, read_ohlcv_async, store_ohlcv_async, \
+    to_store_file  # noqa: E402
+
+
+def candles(rows=48, start='2022-01-01'):
+    dates = pd.date_range(start, periods=rows, freq='h', tz='UTC')
+    return pd.DataFrame({
+        'timestamp': (dates - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1),
+        'symbol': 'BTC/USDT',
+        'open': np.linspace(100, 200, rows),
+        'close': np.linspace(101, 201, rows),
+    })
+
+
+@pytest_asyncio.fixture
+async def aleph(monkeypatch):
+    """
+    Stand-in for the posts, STORE messages and storage of an API server: `create_store` keeps files by their hash,
+    which differs from the hash of the message, and they are served at /api/v0/storage/raw/.
+    """
+    files = {}
+    posts = {}
+    forgotten = []
+
+    async def create_post(account, post_content, post_type, ref=None, channel=None, session=None, **kwargs):
+        item_hash = f'post{len(posts)}'
+        posts[item_hash] = {'item_hash': item_hash, 'type': post_type, 'ref': ref,
+                            'content': copy.deepcopy(post_content)}
+        return {'item_hash': item_hash}
+
+    async def get_posts(hashes=None, pagination=200, session=None, **kwargs):
+        return {'posts': [posts[item_hash] for item_hash in hashes if item_hash in posts]}
+
+    async def forget(account, hashes, reason=None, channel=None, session=None, **kwargs):
+        forgotten.extend(hashes)
+
+    async def create_store(account, file_content, channel=None, session=None, **kwargs):
+        file_hash = hashlib.sha256(file_content).hexdigest()
+        files[file_hash] = file_content
+        content = {'address': '0x0', 'item_type': 'storage', 'item_hash': file_hash}
+        return {'item_hash': hashlib.sha256(file_hash.encode()).hexdigest(), 'type': 'STORE', 'channel': channel,
+                'content': content}
+
+    async def raw(request):
+        if request.match_info['item_hash'] not in files:
+            return web.Response(status=404)
+        return web.Response(body=files[request.match_info['item_hash']])
+
+    monkeypatch.setattr(aleph_client.asynchronous, 'create_store', create_store)
+    monkeypatch.setattr(aleph_client.asynchronous, 'create_post', create_post)
+    monkeypatch.setattr(aleph_client.asynchronous, 'get_posts', get_posts)
+    monkeypatch.setattr(aleph_client.asynchronous, 'forget', forget)
+    app = web.Application()
+    app.router.add_get('/api/v0/storage/raw/{item_hash}', raw)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    api_server = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+    monkeypatch.setattr(aleph_client.conf.settings, 'API_HOST', api_server)
+    yield api_server, files, posts, forgotten
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_store_round_trip(aleph):
+    api_server, files, _, _ = aleph
+    df = candles()
+    content, store_file = prepare_ohlcv(df, 'BTC/USDT', 'hourly', max_inline_bytes=0)
+    async with aiohttp.ClientSession() as session:
+        content = await store_ohlcv_async(None, content, store_file, session)
+        assert content['store']['item_hash'] in files
+        assert content['store']['message_hash'] != content['store']['item_hash']
+        read = await read_ohlcv_async(content, session, api_server)
+    pd.testing.assert_frame_equal(read, df, check_dtype=False)
+
+
+@pytest.mark.parametrize('compression', ['zlib', None])
+def test_parquet_store_file(compression):
+    pytest.importorskip('pyarrow')
+    df = candles()
+    file_format, content = to_store_file(df, compression=compression)
+    assert file_format == 'parquet'
+    pd.testing.assert_frame_equal(from_store_file(file_format, content), df, check_dtype=False)
+
+
+@pytest.mark.asyncio
+async def test_compact_store_parts(aleph, monkeypatch):
+    _, files, posts, forgotten = aleph
+    # every shard part is uploaded as a STORE object
+    monkeypatch.setattr(incremental, 'post_ohlcv_async', functools.partial(post_ohlcv_async, max_inline_bytes=0))
+    df = candles(24 * 51, start='2022-01-10')
+    state = {'manifest_hash': None,
+             'manifest': {'symbol': 'BTC/USDT', 'interval': 'hourly', 'last_timestamp': None, 'shards': {}}}
+    async with aiohttp.ClientSession() as session:
+        for start in range(0, len(df), 17 * 24):
+            await incremental.post_shards(None, df.iloc[start:start + 17 * 24].reset_index(drop=True), state, session)
+        state['manifest']['last_timestamp'] = int(df['timestamp'].iloc[-1])
+        await incremental.post_manifest(None, state, session)
+        shards = state['manifest']['shards']
+        assert [len(shards[month]) for month in sorted(shards)] == [2, 2, 1]
+        january, february = copy.deepcopy(shards['2022-01']), shards['2022-02']
+        february_posts = [posts[part['item_hash']] for part in february]
+        # the file of a January part is gone, which only skips January
+        del files[posts[january[0]['item_hash']]['content']['store']['item_hash']]
+
+        assert await incremental.compact(None, session, state) == 1
+        assert state['manifest']['shards']['2022-01'] == january
+        [shard] = state['manifest']['shards']['2022-02']
+        compacted = await read_ohlcv_async(posts[shard['item_hash']]['content'], session)
+    expected = df[df['timestamp'].map(incremental.month_of) == '2022-02'].reset_index(drop=True)
+    pd.testing.assert_frame_equal(compacted, expected, check_dtype=False)
+    assert sorted(forgotten) == sorted([post['item_hash'] for post in february_posts] +
+                                       [post['content']['store']['message_hash'] for post in february_posts])